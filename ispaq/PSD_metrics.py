@@ -12,6 +12,7 @@ from __future__ import (absolute_import, division, print_function)
 
 import os
 import math
+import collections
 import pandas as pd
 
 from obspy.clients.fdsn import Client
@@ -22,6 +23,8 @@ from .concierge import NoAvailableDataError
 from . import utils
 from . import irisseismic
 from . import irismustangmetrics
+from . import numpymetrics
+from .pdf_histogram import PDFHistogram
 
 def PSD_metrics(concierge):
     """
@@ -37,6 +40,22 @@ def PSD_metrics(concierge):
 
     TODO:  doctest examples
     """
+    return utils.finish_pass(PSD_metrics_days(concierge))
+
+
+def PSD_metrics_days(concierge):
+    """
+    Generate *PSD* metrics one day at a time.
+
+    This generator yields the ``(starttime, endtime)`` window of each day
+    before the metrics of that day are submitted and finally yields the
+    dataframe of PSD metrics or None. It is run to the end by
+    :func:`PSD_metrics` or advanced in step with other day based business
+    logic by :func:`~ispaq.ispaq.run_pass`.
+
+    :type concierge: :class:`~ispaq.concierge.Concierge`
+    :param concierge: Data access expediter.
+    """
     # Get the logger from the concierge
     logger = concierge.logger
     
@@ -50,14 +69,24 @@ def PSD_metrics(concierge):
     # Container for all of the metrics dataframes generated
     dataframes = []
 
+    # PDF histograms of each SNCL summed over all days
+    histograms = {}
+
+    # PSD metrics and plots requested
+    run_PSD = any(key in function_metadata for key in ("PSD","PSDText"))
+
+    # Local RESP files are read by the job that calculates the metric
+    evalresp_source = None
+
     if (concierge.resp_dir):   # if resp_dir: run evalresp on local RESP file instead of web service
         logger.info("Searching for response files in '%s'" % concierge.resp_dir)
+        evalresp_source = utils.EvalrespSource(concierge.resp_dir, logger.name)
     else:                   # try to connect to irisws/evalresp
         try:
             resp_url = Client("IRIS")
         except Exception as e:
             logger.error("Could not connect to 'http:/service.iris.edu/irisws/evalresp/1'")
-            return None
+            return
 
     # ----- All available SNCLs -------------------------------------------------
 
@@ -75,45 +104,23 @@ def PSD_metrics(concierge):
             raise
         except Exception as e:
             logger.error("concierge.get_availability() failed: '%s'" % e)
-            return None
-
-    for day in range(nday):
-        # On the first and last days, use the hour provided, otherwise use 00:00:00
-        starttime = (start + day * 86400)
-        starttime = UTCDateTime(starttime.strftime("%Y-%m-%d") +"T00:00:00Z")
-        endtime = starttime + 86400
-
-        if starttime == end:
-            continue
-
-        try:
-            availability = concierge.get_availability(starttime=starttime,endtime=endtime)
-        except NoAvailableDataError as e:
-            raise
-        except Exception as e:
-            logger.debug(e)
-            logger.error('concierge.get_availability() failed')
-            return None
-
-
-        # If the day has no data, then skip it (used to raise NoAvailableDataError)
-        if availability is None:
-            continue
+            return
 
-        # Apply the channelFilter and drop multiple metadata epochs
-        availability = availability[availability.channel.str.contains(channelFilter)].drop_duplicates(['snclId'])      
+    # Day-sized work units and the days whose jobs have not been gathered yet
+    days = concierge.day_windows()
+    pending_days = collections.deque()
 
-        # Loop over rows of the availability dataframe
-        logger.info('Calculating PSD metrics for %d SNCLs on %s' % (availability.shape[0],str(starttime).split('T')[0]))
-
-        for (index, av) in availability.iterrows():
-            logger.info('%03d Calculating PSD metrics for %s' % (index, av.snclId))
+    def gather_day(day, starttime, endtime, jobs):
+        """
+        Gather the results of one day in the order the jobs were submitted.
+        """
+        for (av, job) in jobs:
 
-            # Get the data ----------------------------------------------
+            # Periodically release R objects from previous SNCLs
+            concierge.memory.tick()
 
-            # NOTE:  Use the requested starttime and endtime
             try:
-                r_stream = concierge.get_dataselect(av.network, av.station, av.location, av.channel,starttime,endtime)
+                (PSD_result, plot_result) = job.get()
             except Exception as e:
                 logger.debug(e)
                 if str(e).lower().find('no data') > -1:
@@ -124,24 +131,39 @@ def PSD_metrics(concierge):
                     logger.warning('No data available for %s from %s' % (av.snclId, concierge.dataselect_url))
                 continue
 
-            # Run the PSD metric ----------------------------------------
+            # Save the PSD metric ---------------------------------------
 
-            if any(key in function_metadata for key in ("PSD","PSDText")) :
+            if run_PSD:
                 try:
-                    evalresp = None
-                    if (concierge.resp_dir):   # if resp_dir: run evalresp on local RESP file instead of web service
-                        sampling_rate = utils.get_slot(r_stream, 'sampling_rate')
-                        evalresp = utils.getSpectra(r_stream, sampling_rate, concierge)
-
-                    # get corrected PSDs
-                    try:
-                        (df, PSDcorrected, PDF) = irismustangmetrics.apply_PSD_metric(r_stream, evalresp=evalresp)
-                    except Exception as e:
-                        raise
+                    if isinstance(PSD_result, Exception):
+                        raise PSD_result
+                    (df, PSDcorrected, PDF) = PSD_result
 
                     if not df.empty:
                         dataframes.append(df)
 
+                    if "pdf_text" in concierge.metric_names :
+                        # Save this day's PDF histogram so that PDFs for longer periods can be summed from them
+                        filename = '%s_%s_PDF.npz' % (av.snclId, starttime.date)
+                        filepath = concierge.csv_dir + '/' + filename
+                        histogram = None
+                        try:
+                            histogram = PDFHistogram.from_df(av.snclId, PSDcorrected)
+                            histogram.save(filepath)
+                        except Exception as e:
+                            logger.debug(e)
+                            logger.warning('Unable to save PDF histogram %s' % (filepath))
+
+                        if histogram is not None:
+                            try:
+                                if av.snclId in histograms:
+                                    histograms[av.snclId].merge(histogram)
+                                else:
+                                    histograms[av.snclId] = histogram
+                            except Exception as e:
+                                logger.debug(e)
+                                logger.warning('Unable to add the %s PDF histogram for %s to the period PDF: %s' % (av.snclId, starttime.date, e))
+
                     if "psd_corrected" in concierge.metric_names :
                         # Write out the corrected PSDs
                         # Do it this way to have each individual day file properly named with starttime.date
@@ -166,8 +188,8 @@ def PSD_metrics(concierge):
                         try:
                             # Add target, start- and endtimes
                             PDF['target'] = av.snclId
-                            PDF['starttime'] = starttime
-                            PDF['endtime'] = endtime
+                            PDF['starttime'] = starttime.datetime
+                            PDF['endtime'] = endtime.datetime
                             PDF = PDF[['target','starttime','endtime','freq','power','hits']]
                             utils.write_numeric_df(PDF, filepath, sigfigs=concierge.sigfigs)  
                         except Exception as e:
@@ -188,30 +210,113 @@ def PSD_metrics(concierge):
 
 
 
-            # Run the PSD plot ------------------------------------------
+            # Report the PSD plot --------------------------------------
 
-            if 'PSDPlot' in function_metadata :
-                try:  
-                    filename = '%s_%s_PDF.png' % (av.snclId, starttime.date)
-                    filepath = concierge.png_dir + '/' + filename
-                    evalresp = None
-                    if (concierge.resp_dir):   # if resp_dir: run evalresp on local RESP file instead of web service
-                        sampling_rate = utils.get_slot(r_stream, 'sampling_rate')
-                        evalresp = utils.getSpectra(r_stream, sampling_rate, concierge)
-                    status = irismustangmetrics.apply_PSD_plot(r_stream, filepath, evalresp=evalresp)
-                    logger.info('Writing PDF plot %s' % os.path.basename(filepath))
-                except Exception as e:
-                    if str(e).lower().find('no psds returned') > -1:
+            if plot_result is not None:
+                if isinstance(plot_result, Exception):
+                    if str(plot_result).lower().find('no psds returned') > -1:
                         logger.warning("IRISMustangMetrics: No PSDs returned for %s" % (av.snclId))
                     else:
-                        logger.warning(e)
+                        logger.warning(plot_result)
                     logger.warning('"PSD" plot generation failed for %s' % (av.snclId))
+                else:
+                    logger.info('Writing PDF plot %s' % os.path.basename(plot_result))
+
+        # Release this day's R objects and report memory use
+        concierge.memory.log_usage('PSD metrics on %s' % starttime.date)
+        logger.info('Finished PSD metrics on %s, day %d of %d' % (starttime.date, day + 1, len(days)))
+
+    for (day, (starttime, endtime)) in enumerate(days):
+
+        # Let a fused day pass bring other business logic to this day first
+        yield (starttime, endtime)
+
+        try:
+            availability = concierge.get_availability(starttime=starttime,endtime=endtime)
+        except NoAvailableDataError as e:
+            raise
+        except Exception as e:
+            logger.debug(e)
+            logger.error('concierge.get_availability() failed')
+            return
+
+
+        # If the day has no data, then skip it (used to raise NoAvailableDataError)
+        if availability is None:
+            continue
+
+        # Apply the channelFilter and drop multiple metadata epochs
+        availability = availability[availability.channel.str.contains(channelFilter)].drop_duplicates(['snclId'])      
+
+        # Loop over rows of the availability dataframe
+        logger.info('Calculating PSD metrics for %d SNCLs on %s' % (availability.shape[0],str(starttime).split('T')[0]))
+
+        # Metric calculations are submitted to the executor and gathered in SNCL order
+        jobs = []
+
+        for (index, av) in availability.iterrows():
+            logger.info('%03d Calculating PSD metrics for %s' % (index, av.snclId))
+
+            # Get the data ----------------------------------------------
+
+            # NOTE:  Use the requested starttime and endtime
+            try:
+                waveform = concierge.get_waveform(av.network, av.station, av.location, av.channel,starttime,endtime)
+            except Exception as e:
+                logger.debug(e)
+                if str(e).lower().find('no data') > -1:
+                    logger.info('No data available for %s' % (av.snclId))
+                elif str(e).lower().find('multiple epochs') :
+                    logger.info('Skipping %s because multiple metadata epochs found' % (av.snclId))
+                else:
+                    logger.warning('No data available for %s from %s' % (av.snclId, concierge.dataselect_url))
+                continue
+
+            use_numpy = 'PSD' in concierge.numpy_functions and waveform.py_stream is not None
+            plot_filepath = None
+            if 'PSDPlot' in function_metadata:
+                filename = '%s_%s_PDF.png' % (av.snclId, starttime.date)
+                plot_filepath = concierge.png_dir + '/' + filename
+
+            job = concierge.executor.submit(_PSD_metrics_job, waveform, use_numpy, run_PSD, plot_filepath,
+                                            evalresp_source=evalresp_source)
+            jobs.append((av, job))
+
+        pending_days.append((day, starttime, endtime, jobs))
+
+        # NOTE:  Jobs of the next days are submitted before earlier days are gathered so that
+        # NOTE:  workers stay busy across day boundaries
+        while len(pending_days) > concierge.workers:
+            gather_day(*pending_days.popleft())
+
+    # Gather results of the remaining days -------------------------------
+
+    while pending_days:
+        gather_day(*pending_days.popleft())
+
+    # Write out PDFs for the whole requested period --------------------------
+
+    if nday > 1:
+        for (snclId, histogram) in sorted(histograms.items()):
+            filename = '%s_%s_%s_PDF.csv' % (snclId, histogram.starttime.date, histogram.endtime.date)
+            filepath = concierge.csv_dir + '/' + filename
+            logger.info('Writing PDF text for %d PSDs to %s' % (histogram.psd_count, os.path.basename(filepath)))
+            try:
+                PDF = histogram.to_df()
+                PDF['target'] = snclId
+                PDF['starttime'] = histogram.starttime.datetime
+                PDF['endtime'] = histogram.endtime.datetime
+                PDF = PDF[['target','starttime','endtime','freq','power','hits']]
+                utils.write_numeric_df(PDF, filepath, sigfigs=concierge.sigfigs)
+            except Exception as e:
+                logger.debug(e)
+                logger.error('Unable to write %s' % (filepath))
                     
     # Concatenate and filter dataframes before returning -----------------------
 
     if len(dataframes) == 0 and 'PSD' in function_metadata:
         logger.warning('"PSD" metric calculation generated zero metrics')
-        return None
+        return
 
     else:
         # make a dummy data frame in the case of just creating PSDPlots with no supporting DF statistics
@@ -228,7 +333,66 @@ def PSD_metrics(concierge):
             result = result[(mask)]
             result.reset_index(drop=True, inplace=True)
             
-        return(result)
+        yield result
+
+
+def _PSD_metrics_job(waveform, use_numpy, run_PSD, plot_filepath=None, evalresp_source=None):
+    """
+    Calculate the PSD metric and PSD plot of a single waveform.
+
+    This is submitted to the concierge executor and may run in a worker process.
+
+    :type waveform: :class:`~ispaq.concierge.Waveform`
+    :param waveform: Waveform for one SNCL-day.
+    :param use_numpy: Calculate the PSD metric with :mod:`~ispaq.numpymetrics`.
+    :param run_PSD: Calculate the PSD metric.
+    :param plot_filepath: Path of the PSD plot or `None` for no plot.
+    :type evalresp_source: :class:`~ispaq.utils.EvalrespSource`
+    :param evalresp_source: Directory of local RESP files or `None` to use
+        the default instrument response of the PSD metric function.
+
+    :rtype: tuple
+    :return: The (df, PSDcorrected, PDF) tuple of the PSD metric and the
+        path of the PSD plot. Each is `None` when not requested or the
+        exception that was raised.
+    """
+    r_stream = None
+    if not use_numpy or plot_filepath is not None:
+        r_stream = waveform.R_Stream()
+
+    PSD_result = None
+    if run_PSD:
+        try:
+            evalresp = None
+            if use_numpy:
+                if evalresp_source is not None:
+                    sampling_rate = waveform.py_stream[0].stats.sampling_rate
+                    evalresp = utils.getSpectra(waveform, sampling_rate, evalresp_source)
+                # get corrected PSDs without R
+                PSD_result = numpymetrics.apply_PSD_metric(waveform, evalresp=evalresp)
+            else:
+                if evalresp_source is not None:
+                    sampling_rate = utils.get_slot(r_stream, 'sampling_rate')
+                    evalresp = utils.getSpectra(r_stream, sampling_rate, evalresp_source)
+                # get corrected PSDs
+                PSD_result = irismustangmetrics.apply_PSD_metric(r_stream, evalresp=evalresp)
+        except Exception as e:
+            # NOTE:  No plot is made when the PSD metric fails
+            return (e, None)
+
+    plot_result = None
+    if plot_filepath is not None:
+        try:
+            evalresp = None
+            if evalresp_source is not None:
+                sampling_rate = utils.get_slot(r_stream, 'sampling_rate')
+                evalresp = utils.getSpectra(r_stream, sampling_rate, evalresp_source)
+            irismustangmetrics.apply_PSD_plot(r_stream, plot_filepath, evalresp=evalresp)
+            plot_result = plot_filepath
+        except Exception as e:
+            plot_result = e
+
+    return (PSD_result, plot_result)
 
 
 # ------------------------------------------------------------------------------
@@ -10,6 +10,7 @@ ISPAQ Business Logic for SNR Metrics.
 
 from __future__ import (absolute_import, division, print_function)
 
+import collections
 import math
 import numpy as np
 import pandas as pd
@@ -19,6 +20,7 @@ from .concierge import NoAvailableDataError
 from . import utils
 from . import irisseismic
 from . import irismustangmetrics
+from . import numpymetrics
 
 
 def SNR_metrics(concierge):
@@ -35,6 +37,22 @@ def SNR_metrics(concierge):
 
     TODO:  doctest examples
     """
+    return utils.finish_pass(SNR_metrics_events(concierge))
+
+
+def SNR_metrics_events(concierge):
+    """
+    Generate *SNR* metrics one event at a time.
+
+    This generator yields the ``(halfHourStart, halfHourEnd)`` window around
+    each event before the metrics of that event are submitted and finally
+    yields the dataframe of SNR metrics or None. It is run to the end by
+    :func:`SNR_metrics` or advanced in step with other event based business
+    logic by :func:`~ispaq.ispaq.run_pass`.
+
+    :type concierge: :class:`~ispaq.concierge.Concierge`
+    :param concierge: Data access expediter.
+    """
     # Get the logger from the concierge
     logger = concierge.logger
         
@@ -50,11 +68,11 @@ def SNR_metrics(concierge):
     # Sanity checck
     if events is None or events.shape[0] == 0:
         logger.info('No events found for SNR metrics')
-        return None
+        return
         
     if concierge.station_url is None:
         logger.warning('No station metadata found for SNR metrics')
-        return None
+        return
 
     # Container for all of the metrics dataframes generated
     dataframes = []
@@ -65,7 +83,52 @@ def SNR_metrics(concierge):
 
     logger.info('Calculating SNR metrics for %d events.' % (events.shape[0]))
 
+    # Events whose jobs have not been gathered yet
+    pending_events = collections.deque()
+
+    def gather_event(jobs, batch, batch_job):
+        """
+        Gather the results of one event in the order the jobs were submitted.
+        """
+        # Gather R results in the order the jobs were submitted
+        for (av, job) in jobs:
+            try:
+                if isinstance(job, Exception):
+                    raise job
+                result = job.get()
+            except Exception as e:
+                dataframes.append(_no_data_df(concierge, av, e))
+                continue
+
+            if isinstance(result, Exception):
+                logger.warning('"SNR" metric calculation failed for %s: %s' % (av.snclId, result))
+            elif isinstance(result, pd.DataFrame):
+                logger.info('Calculating SNR metrics for %s' % (av.snclId))
+                dataframes.append(result)
+            else:
+                logger.info('Skipping %s because %s' % (av.snclId, result))
+
+        # SNR for every station window of this event is calculated in a single call
+        if batch_job is not None:
+            try:
+                results = batch_job.get()
+            except Exception as e:
+                results = [e] * len(batch)
+            for (av, df) in zip(batch, results):
+                if isinstance(df, Exception):
+                    logger.warning('"SNR" metric calculation failed for %s: %s' % (av.snclId, df))
+                else:
+                    dataframes.append(df)
+
     for (index, event) in events.iterrows():
+
+        # Window around the event used for metadata and data requests
+        halfHourStart = event.time - 60 * 2
+        halfHourEnd = event.time + 60 * 28
+
+        # Let a fused event pass bring other business logic to this event first
+        yield (halfHourStart, halfHourEnd)
+
         logger.info('%03d Magnitude %3.1f Time %s event: %s' % (index, event.magnitude, event.time.strftime("%Y-%m-%dT%H:%M:%S"), event.eventLocationName))
         
         # Sanity check
@@ -81,9 +144,6 @@ def SNR_metrics(concierge):
         # Get the data availability around this event
         # NOTE:  Get availability from 2 minutes before event until 28 minutes after
         # Get the data availability using spatial search parameters
-        halfHourStart = event.time - 60 * 2
-        halfHourEnd = event.time + 60 * 28
-
         logger.debug("Looking for metadata from %s to %s" % (halfHourStart.strftime("%Y-%m-%dT%H:%M:%S"),halfHourEnd.strftime("%Y-%m-%dT%H:%M:%S")))
         try:        
             availability = concierge.get_availability(starttime=halfHourStart, endtime=halfHourEnd,
@@ -115,6 +175,12 @@ def SNR_metrics(concierge):
 
         # function metadata dictionary
         function_metadata = concierge.function_by_logic['SNR']
+
+        # Waveforms for the NumPy engine are collected and processed together after the loop
+        batch = []
+
+        # Calculations with R are submitted to the executor and gathered in SNCL order
+        jobs = []
     
         # Loop over rows of the availability dataframe
         for (index, av) in availability.iterrows():
@@ -125,8 +191,8 @@ def SNR_metrics(concierge):
 
             # get the travel time between the event and the station
             try:
-                tt = irisseismic.getTraveltime(event.latitude, event.longitude, event.depth, 
-                                               av.latitude, av.longitude)
+                tt = concierge.get_traveltime(event.latitude, event.longitude, event.depth, 
+                                              av.latitude, av.longitude)
             except Exception as e:
                 logger.warning('Skipping because getTravelTime failed: %s' % (e))
                 continue
@@ -146,43 +212,45 @@ def SNR_metrics(concierge):
             # Get the data
             # NOTE:  Expand the window by an extra second to guarantee that 
             # NOTE:  windowStart < tr.stats.starttime and windowEnd > tr.stats.endtime
+            # NOTE:  In a fused event pass the window is sliced from the half hour read for other metrics
             try:
-                r_stream = concierge.get_dataselect(av.network, av.station, av.location, av.channel, windowStart-1, windowEnd+1, inclusiveEnd=False)
+                waveform = concierge.get_waveform(av.network, av.station, av.location, av.channel, windowStart-1, windowEnd+1, inclusiveEnd=False,
+                                                  within=(halfHourStart-1, halfHourEnd+1))
             except Exception as e:
-                if str(e).lower().find('no data') > -1:
-                    logger.info('No data found for %s' % (av.snclId))
-                elif str(e).lower().find('multiple epochs') :
-                    logger.info('Skipping %s because multiple metadata epochs are found' % (av.snclId))
-                else:
-                    logger.warning('No data found for %s from %s: %s' % (av.snclId, concierge.dataselect_url, e))
-                # TODO:  Create appropriate empty dataframe
-                df = pd.DataFrame({'metricName': 'SNR',
-                                   'value': 0,
-                                   'snclq': av.snclId+'.M',
-                                   'starttime': concierge.requested_starttime,
-                                   'endtime': concierge.requested_endtime,
-                                   'qualityFlag': -9},
-                                  index=[0]) 
-                dataframes.append(df)
+                # NOTE:  The exception is kept in place of the job so that the
+                # NOTE:  missing data dataframe is added in SNCL order
+                jobs.append((av, e))
                 continue
 
             # Run the SNR metric
-            if len(r_stream.do_slot('traces')) > 1:
-                logger.info('Skipping %s because it has gaps' % (av.snclId)) 
-                continue
-            
-            else:
-                if (utils.get_slot(r_stream, 'starttime') > windowStart) or (utils.get_slot(r_stream,'endtime') < windowEnd):
-                    logger.info('Skipping %s because it is missing data in the SNR window' % (av.snclId)) 
-                    continue
+            if 'SNR' in concierge.numpy_functions and waveform.py_stream is not None:
+                if len(waveform.py_stream) > 1:
+                    logger.info('Skipping %s because it has gaps' % (av.snclId))
+                elif (waveform.py_stream[0].stats.starttime > windowStart) or (waveform.py_stream[0].stats.endtime < windowEnd):
+                    logger.info('Skipping %s because it is missing data in the SNR window' % (av.snclId))
                 else:
-                    logger.info('Calculating SNR metrics for %s' % (av.snclId))
-                    try:
-                        df = irismustangmetrics.apply_simple_metric(r_stream, 'SNR', algorithm="splitWindow", windowSecs=windowSecs)
-                        dataframes.append(df)
-                    except Exception as e:
-                        logger.warning('"SNR" metric calculation failed for %s: %s' % (av.snclId, e))
-                    
+                    batch.append((av, waveform))
+                continue
+
+            job = concierge.executor.submit(_SNR_metrics_job, waveform, windowStart, windowEnd, windowSecs)
+            jobs.append((av, job))
+
+        # Calculate SNR for every station window of this event in a single call
+        batch_job = None
+        if len(batch) > 0:
+            logger.info('Calculating SNR metrics for %d SNCLs' % len(batch))
+            batch_job = concierge.executor.submit(numpymetrics.SNRMetric_batch, [waveform for (av, waveform) in batch],
+                                                  algorithm="splitWindow", windowSecs=windowSecs)
+
+        pending_events.append((jobs, [av for (av, waveform) in batch], batch_job))
+
+        # NOTE:  Jobs of the next events are submitted before earlier events are gathered so that
+        # NOTE:  workers stay busy across events
+        while len(pending_events) > concierge.workers:
+            gather_event(*pending_events.popleft())
+
+    while pending_events:
+        gather_event(*pending_events.popleft())
                 
 
     # Concatenate and filter dataframes before returning -----------------------
@@ -193,13 +261,65 @@ def SNR_metrics(concierge):
         
     if len(dataframes) == 0:
         logger.warn('"SNR" metric calculation generated zero metrics')
-        return None
+        return
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         mask = result.metricName.apply(valid_metric)
         result = result[(mask)]
         result.reset_index(drop=True, inplace=True)        
-        return(result)
+        yield result
+
+
+def _no_data_df(concierge, av, e):
+    """
+    Log why no data was found for a SNCL and return the SNR dataframe used
+    in its place.
+    """
+    logger = concierge.logger
+    if str(e).lower().find('no data') > -1:
+        logger.info('No data found for %s' % (av.snclId))
+    elif str(e).lower().find('multiple epochs') :
+        logger.info('Skipping %s because multiple metadata epochs are found' % (av.snclId))
+    else:
+        logger.warning('No data found for %s from %s: %s' % (av.snclId, concierge.dataselect_url, e))
+    # TODO:  Create appropriate empty dataframe
+    df = pd.DataFrame({'metricName': 'SNR',
+                       'value': 0,
+                       'snclq': av.snclId+'.M',
+                       'starttime': concierge.requested_starttime.datetime,
+                       'endtime': concierge.requested_endtime.datetime,
+                       'qualityFlag': -9},
+                      index=[0]) 
+    return df
+
+
+def _SNR_metrics_job(waveform, windowStart, windowEnd, windowSecs):
+    """
+    Calculate the SNR metric of a single waveform with R.
+
+    This is submitted to the concierge executor and may run in a worker process.
+
+    :type waveform: :class:`~ispaq.concierge.Waveform`
+    :param waveform: Waveform around the first arrival.
+    :param windowStart: ObsPy UTCDateTime of the start of the SNR window.
+    :param windowEnd: ObsPy UTCDateTime of the end of the SNR window.
+    :param windowSecs: Length of the SNR window in seconds.
+
+    :return: Dataframe of SNR metrics, the exception raised by the metric
+        function or the reason the SNCL was skipped.
+    """
+    r_stream = waveform.R_Stream()
+
+    if len(r_stream.do_slot('traces')) > 1:
+        return 'it has gaps'
+
+    if (utils.get_slot(r_stream, 'starttime') > windowStart) or (utils.get_slot(r_stream,'endtime') < windowEnd):
+        return 'it is missing data in the SNR window'
+
+    try:
+        return irismustangmetrics.apply_simple_metric(r_stream, 'SNR', algorithm="splitWindow", windowSecs=windowSecs)
+    except Exception as e:
+        return e
 
 
 # ------------------------------------------------------------------------------
@@ -15,6 +15,7 @@ import sys
 import re
 import glob
 import math
+import struct
 import fileinput
 import fnmatch
 import tempfile
@@ -31,13 +32,225 @@ from obspy import UTCDateTime
 from .user_request import UserRequest
 from . import irisseismic
 from . import utils
+from . import executor
 
 
 # Custom exceptions
 
 class NoAvailableDataError(Exception):
     """No matching data are available."""
-    
+
+
+class Waveform(object):
+    """
+    Waveform data for a single SNCL and time range.
+
+    Unlike an R Stream, a Waveform can be pickled and handed to a worker
+    process. Local miniSEED data are carried as an ObsPy Stream along with the
+    metadata needed by :func:`~ispaq.irisseismic.R_Stream`. Data from FDSN web
+    services are carried as the arguments to
+    :func:`~ispaq.irisseismic.R_getDataselect` and are only requested when
+    :meth:`R_Stream` is called.
+
+    Waveforms are created by :meth:`Concierge.get_waveform`.
+    """
+    def __init__(self, snclId, starttime, endtime,
+                 py_stream=None, trace_info=None, dataselect_request=None,
+                 headonly=False):
+        self.snclId = snclId
+        self.starttime = starttime
+        self.endtime = endtime
+        self.py_stream = py_stream
+        self.trace_info = trace_info
+        self.dataselect_request = dataselect_request
+        self.headonly = headonly
+        # R Stream kept so that business logic sharing this waveform converts it only once
+        self.r_stream = None
+
+    def __getstate__(self):
+        # NOTE:  R objects cannot be pickled, worker processes create their own R Stream
+        state = self.__dict__.copy()
+        state['r_stream'] = None
+        return state
+
+    def R_Stream(self):
+        """
+        Returns the IRISSeismic Stream for this waveform.
+        """
+        if self.headonly:
+            raise Exception("%s: waveform was read without sample values" % self.snclId)
+        if self.r_stream is None:
+            self.r_stream = self._R_Stream()
+        return self.r_stream
+
+    def slice(self, starttime, endtime, inclusiveEnd=False):
+        """
+        Returns a :class:`Waveform` with the data of this local waveform
+        between `starttime` and `endtime`.
+
+        Samples are selected as :meth:`Concierge.get_waveform` would select
+        them from the miniSEED file. State-of-health flags and metadata are
+        those of this waveform.
+        """
+        if self.py_stream is None or self.headonly:
+            raise Exception("%s: only local waveforms with sample values can be sliced" % self.snclId)
+        if not inclusiveEnd:
+            endtime = endtime - 0.000001
+        py_stream = self.py_stream.slice(starttime, endtime, nearest_sample=False)
+        if len(py_stream) == 0:
+            raise Exception("no data available")
+        return Waveform(self.snclId, starttime, endtime, py_stream=py_stream, trace_info=self.trace_info)
+
+    def _R_Stream(self):
+        if self.py_stream is not None:
+            return irisseismic.R_Stream(self.py_stream, self.starttime, self.endtime, **self.trace_info)
+
+        # R getDataselect() seems to capture awkward error reports when there is no data
+        # we want to suppress the stderr channel briefly to block the unwanted feedback from R
+        orig_stderr = sys.stderr
+        sys.stderr = open(os.devnull, "w")
+        try:
+            r_stream = irisseismic.R_getDataselect(*self.dataselect_request)
+        finally:
+            sys.stderr.close()
+            sys.stderr = orig_stderr
+
+        # Some FDSN web services cut on record boundaries instead of samples, so make sure we have correct start/end times
+        return irisseismic.R_slice(r_stream, self.starttime, self.endtime)
+
+
+def _slice_headers(py_stream, starttime, endtime):
+    """
+    Equivalent of ``Stream.slice(starttime, endtime, nearest_sample=False)``
+    for a Stream read with ``headonly=True``.
+
+    ObsPy trims traces by removing samples from the data array, which header
+    only traces do not have, so start times and sample counts are adjusted
+    here with the same arithmetic.
+    """
+    sliced = obspy.Stream()
+    for tr in py_stream:
+        stats = tr.stats.copy()
+        first = 0
+        last = stats.npts - 1
+        if stats.starttime < starttime:
+            first = -int(math.floor(round((stats.starttime - starttime) * stats.sampling_rate, 7)))
+        if stats.endtime > endtime:
+            last = int(math.floor(round((endtime - stats.starttime) * stats.sampling_rate, 7)))
+        npts = last - first + 1
+        if npts <= 0:
+            continue
+        stats.starttime = stats.starttime + first * stats.delta
+        trace = obspy.Trace(header=stats)
+        trace.stats.npts = npts
+        sliced.append(trace)
+    return sliced
+
+
+def _record_sampling_rate(factor, multiplier):
+    """
+    Return the sampling rate of a miniSEED record from its rate factor and
+    multiplier as defined by the SEED manual.
+    """
+    if factor == 0 or multiplier == 0:
+        return 0.0
+    if factor > 0 and multiplier > 0:
+        return float(factor * multiplier)
+    if factor > 0:
+        return -float(factor) / multiplier
+    if multiplier > 0:
+        return -float(multiplier) / factor
+    return 1.0 / (factor * multiplier)
+
+
+def _read_flags(datafile, starttime, endtime):
+    """
+    Count the state-of-health flags of the miniSEED records that overlap
+    starttime to endtime as IRISSeismic::readMiniseed does for a dataselect
+    request.
+
+    Only the fixed section of each data header and blockettes 1000 and 1001
+    are read so that sample values are never decoded.
+    :param datafile: Path or open file object of miniSEED records.
+    :param starttime: ObsPy UTCDateTime of the first sample of interest.
+    :param endtime: ObsPy UTCDateTime of the last sample of interest.
+    :return: Dictionary of act_flags, io_flags and dq_flags with the number
+        of records that set each bit and timing_qual, the total timing quality
+        divided by the number of records or `None` without blockette 1001.
+    """
+    if hasattr(datafile, 'read'):
+        f = datafile
+    else:
+        f = open(datafile, 'rb')
+
+    counts = np.zeros((3, 8), dtype=np.int64)
+    bits = np.array([0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80])
+    (records, timing_records, timing_total) = (0, 0, 0)
+    try:
+        offset = 0
+        while True:
+            f.seek(offset)
+            header = f.read(48)
+            if len(header) < 48:
+                break
+            # NOTE:  libmseed skips 256 bytes when a record cannot be parsed
+            if header[6:7] not in (b'D', b'R', b'Q', b'M'):
+                offset += 256
+                continue
+            # Byte order is detected from a sensible year
+            order = '>' if 1900 <= struct.unpack('>H', header[20:22])[0] <= 2100 else '<'
+            (year, julday, hour, minute, second, _, fract, nsamples, factor, multiplier,
+             act, io, dq, nblockettes, correction, _, next_blockette) = struct.unpack(order + 'HHBBBBHHhhBBBBiHH', header[20:48])
+
+            # Blockette 1000 has the record length and blockette 1001 the timing quality
+            reclen = None
+            timing_qual = None
+            for i in range(nblockettes):
+                if next_blockette < 48:
+                    break
+                f.seek(offset + next_blockette)
+                blockette = f.read(8)
+                if len(blockette) < 8:
+                    break
+                (blockette_type, following) = struct.unpack(order + 'HH', blockette[:4])
+                if blockette_type == 1000:
+                    reclen = 2 ** struct.unpack('B', blockette[6:7])[0]
+                elif blockette_type == 1001:
+                    timing_qual = struct.unpack('B', blockette[4:5])[0]
+                next_blockette = following
+            if reclen is None:
+                reclen = obspy.io.mseed.util.get_record_information(f, offset)['record_length']
+
+            record_start = UTCDateTime(year=year, julday=julday, hour=hour, minute=minute,
+                                       second=min(second, 59)) + fract * 0.0001
+            # Time corrections that have not been applied yet
+            if not act & 0x02:
+                record_start += correction * 0.0001
+            sampling_rate = _record_sampling_rate(factor, multiplier)
+            record_end = record_start
+            if nsamples > 0 and sampling_rate > 0:
+                record_end += (nsamples - 1) / sampling_rate
+
+            if record_start <= endtime and record_end >= starttime:
+                records += 1
+                counts += (np.array([[act], [io], [dq]]) & bits) > 0
+                if timing_qual is not None:
+                    timing_records += 1
+                    timing_total += timing_qual
+
+            offset += reclen
+    finally:
+        if f is not datafile:
+            f.close()
+
+    flags = {'act_flags': [int(n) for n in counts[0]],
+             'io_flags': [int(n) for n in counts[1]],
+             'dq_flags': [int(n) for n in counts[2]],
+             'timing_qual': None}
+    if timing_records > 0:
+        flags['timing_qual'] = timing_total / records
+    return flags
+
 
 class Concierge(object):
     """
@@ -103,6 +316,18 @@ class Concierge(object):
         self.locOrder = int(int(self.sncl_format.index("L"))/2)
         self.chanOrder = int(int(self.sncl_format.index("C"))/2)
  
+        # Executor used by business logic to run metric calculations, created when first used
+        self.workers = user_request.workers
+        self.gc_interval = user_request.gc_interval
+        self._executor = None
+
+        # Periodic release of R objects created for each SNCL
+        self.memory = utils.MemoryManager(self.gc_interval, logger=self.logger)
+
+        # Metric functions calculated with NumPy instead of R
+        self.engine = user_request.engine
+        self.numpy_functions = user_request.numpy_functions
+
         # Keep a /dev/null pipe handy in case we want to bit-dump output
         self.dev_null = open(os.devnull,"w")
         
@@ -307,6 +532,17 @@ class Concierge(object):
         # Filtered availability dataframe is stored for potential reuse
         self.filtered_availability = None
 
+        # Availability dataframes by query so that event windows are only searched once
+        self.availability_cache = {}
+
+        # Waveforms by request while a fused pass shares them between business logic groups
+        self.waveform_cache = None
+
+        # Event catalogs by query, the local QuakeML catalog and event-station geometry are only read once
+        self.event_cache = {}
+        self.event_catalog = None
+        self.geometry_cache = {}
+
         # Add local response files if used
         if user_request.resp_dir is None:                  # use irisws/evalresp
             self.resp_dir = None                           # use irisws/evalresp
@@ -332,6 +568,35 @@ class Concierge(object):
         self.logger.debug("png_dir %s", self.png_dir)
         self.logger.debug("sigfigs %s", self.sigfigs)
         self.logger.debug("sncl_format %s", self.sncl_format)
+        self.logger.debug("workers %s", self.workers)
+        self.logger.debug("gc_interval %s", self.gc_interval)
+        self.logger.debug("engine %s", self.engine)
+        self.logger.debug("numpy_functions %s", self.numpy_functions)
+
+    @property
+    def executor(self):
+        """
+        Executor for metric calculations with :attr:`workers` workers.
+
+        The executor is only created when business logic first submits a job
+        so that runs which fork metric groups do not start and discard a pool
+        of R worker processes.
+        """
+        if self._executor is None:
+            self._executor = executor.create_executor(self.workers, gc_interval=self.gc_interval, logger=self.logger)
+        return self._executor
+
+    @executor.setter
+    def executor(self, value):
+        self._executor = value
+
+    def close_executor(self):
+        """
+        Shut down the executor, if one was created, so that the next job starts a new one.
+        """
+        if self._executor is not None:
+            self._executor.close()
+            self._executor = None
 
     def get_sncl_pattern(self, netIn, staIn, locIn, chanIn):  
         snclList = list()
@@ -343,10 +608,54 @@ class Concierge(object):
         sncl_pattern = "%s.%s.%s.%s" % tuple(snclList)
         return(sncl_pattern)
 
+    def day_windows(self, starttime=None, endtime=None):
+        """
+        Split a time range into the day-sized work units used by business logic.
+
+        Each day starts at 00:00:00 UTC. A day that starts at the end of the
+        range is dropped so that a range ending at midnight covers whole days.
+
+        :type starttime: :class:`~obspy.UTCDateTime`
+        :param starttime: Start of the range, defaults to the requested starttime.
+        :type endtime: :class:`~obspy.UTCDateTime`
+        :param endtime: End of the range, defaults to the requested endtime.
+        :rtype: list
+        :return: List of (starttime, endtime) tuples, one per day.
+        """
+        if starttime is None:
+            starttime = self.requested_starttime
+        if endtime is None:
+            endtime = self.requested_endtime
+
+        nday = int((endtime - starttime) / 86400) + 1
+
+        windows = []
+        for day in range(nday):
+            dayStart = UTCDateTime((starttime + day * 86400).strftime("%Y-%m-%d") + "T00:00:00Z")
+            if dayStart == endtime:
+                continue
+            windows.append((dayStart, dayStart + 86400))
+        return windows
+
+    def get_component_sncl_patterns(self):
+        """
+        Return the sncl_patterns with the orientation code of complete channel
+        codes replaced by '?' so that all components are found, e.g.
+        TA.109C..BHZ becomes TA.109C..BH?.
+        """
+        component_patterns = []
+        for sncl_pattern in self.sncl_patterns:
+            UR = sncl_pattern.split('.')
+            if len(UR[self.chanOrder]) == 3:
+                UR[self.chanOrder] = UR[self.chanOrder][:-1] + '?'
+            component_patterns.append(".".join(UR))
+        return component_patterns
+
     def get_availability(self,
                          network=None, station=None, location=None, channel=None,
                          starttime=None, endtime=None, includerestricted=None,
-                         latitude=None, longitude=None, minradius=None, maxradius=None):
+                         latitude=None, longitude=None, minradius=None, maxradius=None,
+                         sncl_patterns=None):
         """
         ################################################################################
         # getAvailability method returns a dataframe with information from the output
@@ -421,6 +730,12 @@ class Concierge(object):
         :param maxradius: Limit results to stations within the specified
             maximum number of degrees from the geographic point defined by the
             latitude and longitude parameters.
+        :type sncl_patterns: list
+        :param sncl_patterns: SNCL patterns to search instead of the
+            `sncl_patterns` of the `user_request`.
+
+        Results are cached by query and a copy is returned so that business
+        logic for several metrics can search the same event window once.
 
         #.. rubric:: Example
 
@@ -444,6 +759,18 @@ class Concierge(object):
         #    self.filtered_availability is not None):
         #    return(self.filtered_availability)
         
+        if sncl_patterns is None:
+            sncl_patterns = self.sncl_patterns
+
+        cache_key = tuple(str(arg) for arg in (network, station, location, channel, starttime, endtime,
+                                               includerestricted, latitude, longitude, minradius, maxradius))
+        cache_key += tuple(sncl_patterns)
+        if cache_key in self.availability_cache:
+            availability = self.availability_cache[cache_key]
+            if availability is None:
+                return None
+            return availability.copy()
+
         # Read from a local StationXML file one time only -- IE, once this section has been run once in a job, don't run it again... so availability2 wont run this section.
 
         if self.station_client is None:
@@ -504,7 +831,7 @@ class Concierge(object):
                 # Loop through all sncl_patterns in the preferences file ---------------
                 self.logger.debug("Searching for data in %s" % self.dataselect_url)
 
-                for sncl_pattern in self.sncl_patterns:
+                for sncl_pattern in sncl_patterns:
                     try: 
                         UR_network = sncl_pattern.split('.')[self.netOrder]
                         UR_station = sncl_pattern.split('.')[self.staOrder]
@@ -575,7 +902,7 @@ class Concierge(object):
         loopCounter = 0		# For crossCorrelation when we look for all sn.ls
 
         # Loop through all sncl_patterns ---------------------------------------
-        for sncl_pattern in self.sncl_patterns:
+        for sncl_pattern in sncl_patterns:
             # We only want to do this one time if we are looking for *.*.*.chan
             # For example, during crossCorrelation.  Otherwise it creates a bloated
             # availability dataframe with the same sncls repeating #sncl_patterns times
@@ -749,8 +1076,9 @@ class Concierge(object):
         # END of sncl_patterns loop --------------------------------------------
  
         if len(sncl_pattern_dataframes) == 0:
-            err_msg = "No available waveforms for %s matching " % _starttime.strftime('%Y-%m-%d') + str(self.sncl_patterns)
+            err_msg = "No available waveforms for %s matching " % _starttime.strftime('%Y-%m-%d') + str(sncl_patterns)
             self.logger.info(err_msg)
+            self.availability_cache[cache_key] = None
             #raise NoAvailableDataError(err_msg)
         else:
 	    # Those dataframes become availability
@@ -763,13 +1091,219 @@ class Concierge(object):
             availability = availability.drop('start', 1)
 
             if availability.shape[0] == 0:              
-                err_msg = "No available waveforms matching" + str(self.sncl_patterns)
+                err_msg = "No available waveforms matching" + str(sncl_patterns)
                 self.logger.info(err_msg)
+                self.availability_cache[cache_key] = None
             else:
                 # The concierge should remember this dataframe for metrics that
                 # make multiple calls to get_availability with all defaults.
                 self.filtered_availability = availability
-                return availability
+                self.availability_cache[cache_key] = availability
+                return availability.copy()
+
+    def get_waveform(self,
+                     network=None, station=None, location=None, channel=None,
+                     starttime=None, endtime=None, quality=None, repository=None,
+                     inclusiveEnd=False, ignoreEpoch=False, headonly=False, within=None):
+        """
+        Returns a :class:`~ispaq.concierge.Waveform` that can be converted into
+        an R Stream in this or in a worker process.
+
+        Local miniSEED files are read, sliced and combined with station metadata
+        immediately. Requests to FDSN web services are only described and are
+        sent when :meth:`Waveform.R_Stream` is called.
+
+        With ``headonly=True`` only the record headers of local miniSEED files
+        are read. Traces then have correct start times, sample rates and sample
+        counts but no data, which is all that header based metrics need.
+
+        While :attr:`waveform_cache` is a dictionary, waveforms are kept there
+        and returned again for the same SNCL and time range. A waveform with
+        sample values is also returned for a ``headonly=True`` request.
+
+        `within` is an optional (starttime, endtime) window around the
+        requested one, e.g. the half hour around an event. While waveforms are
+        cached, local data for the whole of `within` are read once and each
+        requested window is sliced from them with :meth:`Waveform.slice`.
+        Windows crossing midnight are not shared.
+
+        Other arguments are the same as for :meth:`get_dataselect`.
+        """
+
+        # Allow arguments to override UserRequest parameters
+        if starttime is None:
+            _starttime = self.requested_starttime
+        else:
+            _starttime = starttime
+        if endtime is None:
+            _endtime = self.requested_endtime
+        else:
+            _endtime = endtime
+
+        _sncl_pattern = self.get_sncl_pattern(network, station, location, channel)
+
+        # NOTE:  `within` is only used when it lies in a single day file. Otherwise, or if
+        # NOTE:  reading it fails, the requested window is read directly as it would be
+        # NOTE:  without a waveform cache.
+        if (within is not None and self.waveform_cache is not None and self.dataselect_client is None and
+                not headonly and within[0] <= _starttime and _endtime <= within[1] and
+                within[0].date == (within[1] - .00001).date):
+            try:
+                waveform = self.get_waveform(network, station, location, channel, within[0], within[1],
+                                             quality, repository, ignoreEpoch=ignoreEpoch)
+                return waveform.slice(_starttime, _endtime, inclusiveEnd)
+            except Exception as e:
+                self.logger.debug("Reading %s from %s to %s directly: %s" % (_sncl_pattern, _starttime, _endtime, e))
+
+        # NOTE:  ignoreEpoch only decides whether multiple metadata epochs are an error so
+        # NOTE:  it is not part of the key and the number of epochs is cached instead
+        cache_key = None
+        if self.waveform_cache is not None:
+            cache_key = tuple(str(arg) for arg in (network, station, location, channel, _starttime, _endtime,
+                                                   quality, repository, inclusiveEnd))
+            for key in [cache_key + (str(False),), cache_key + (str(headonly),)]:
+                if key in self.waveform_cache:
+                    (waveform, epochs) = self.waveform_cache[key]
+                    if not ignoreEpoch and epochs > 1:
+                        raise Exception("Multiple metadata epochs found for %s" % _sncl_pattern)
+                    return waveform
+            cache_key += (str(headonly),)
+
+        if self.dataselect_client is not None:
+            # Data will be read from FDSN web services by IRISSeismic::getDataselect
+            dataselect_request = (self.dataselect_url, network, station, location, channel,
+                                  _starttime, _endtime, quality, repository, inclusiveEnd, ignoreEpoch)
+            waveform = Waveform(_sncl_pattern, _starttime, _endtime, dataselect_request=dataselect_request)
+            if cache_key is not None:
+                self.waveform_cache[cache_key] = (waveform, 1)
+            return waveform
+
+        # Read local MiniSEED file
+        nday = int((_endtime - .00001).julday - _starttime.julday) + 1   # subtract a short amount of time for 00:00:00 endtimes
+
+        if (nday == 1):
+            fpattern1 = '%s.%s' % (_sncl_pattern,_starttime.strftime('%Y.%j'))
+            fpattern2 = '%s' % (fpattern1 + '.[A-Z]')
+
+            matching_files = []
+            for root, dirnames, fnames in os.walk(self.dataselect_url):
+                for fname in fnmatch.filter(fnames, fpattern1) + fnmatch.filter(fnames, fpattern2):
+                    matching_files.append(os.path.join(root,fname))
+
+            if (len(matching_files) == 0):
+                self.logger.info("No files found matching '%s'" % (fpattern1))
+                raise Exception("no data available")
+
+            filepath = matching_files[0]
+            if (len(matching_files) > 1):
+                self.logger.debug("Multiple files found: %s" % " ".join(matching_files))
+                self.logger.warning("Multiple files found matching " '%s -- using %s' % (fpattern1, filepath))
+
+            datafile = filepath
+
+        else:
+            # create tempfile
+            datafile = tempfile.TemporaryFile()
+
+            # begin day loop
+            for day in range(nday):
+                start = (_starttime + day * 86400)
+                start = start - (start.hour * 3600 + start.minute * 60 + start.second + start.microsecond * .000001)
+                end = start + 86400
+
+                if start <= _starttime:
+                    start = _starttime
+                if end >= _endtime:
+                    end = _endtime
+
+                filename = '%s.%s' % (_sncl_pattern,_starttime.strftime('%Y.%j'))
+                self.logger.debug("read local miniseed file for %s..." % filename)
+                fpattern1 = self.dataselect_url + '/' + filename + '.[12][0-9][0-9][0-9].[0-9][0-9][0-9]'
+                fpattern2 = fpattern1 + '.[A-Z]'
+                matching_files = glob.glob(fpattern1) + glob.glob(fpattern2)
+
+                if (len(matching_files) == 0):
+                    err_msg = "No files found matching '%s'" % (fpattern1)
+                    raise Exception(err_msg)
+
+                else:
+                    filepath = matching_files[0]
+                    if (len(matching_files) > 1):
+                        self.logger.debug("Multiple files found: %s" % " ".join(matching_files))
+                        self.logger.warning("Multiple files found matching" '%s -- using %s' % (fpattern1, filepath))
+
+                    # write miniseed to tempfile
+                    with open(filepath, 'rb') as f:
+                        datafile.write(f.read())
+                        datafile.flush()
+                    f.close()
+
+        try:
+            # Get the ObsPy version of the stream
+            if not inclusiveEnd:
+                _endtime = _endtime - 0.000001
+            if headonly:
+                py_stream = _slice_headers(obspy.read(datafile, headonly=True), _starttime, _endtime)
+            else:
+                py_stream = obspy.read(datafile)
+                py_stream = py_stream.slice(_starttime, _endtime, nearest_sample=False)
+
+            # NOTE:  ObsPy does not store state-of-health flags with each stream.
+            # NOTE:  They are counted from the record headers of the same data.
+            flags = _read_flags(datafile, _starttime, _endtime)
+
+            # NOTE:  ObsPy does not store station metadata with each trace.
+            # NOTE:  We need to read them in separately from station metadata.
+            # NOTE:  This should be consistent for each day of data
+            availability = self.get_availability(network, station, location, channel, _starttime, _endtime)
+
+            if(ignoreEpoch == False):
+                if (len(availability) > 1):
+                    raise Exception("Multiple metadata epochs found for %s" % _sncl_pattern)
+
+            sensor = availability.instrument[0]
+            scale = availability.scale[0]
+            scalefreq = availability.scalefreq[0]
+            scaleunits = availability.scaleunits[0]
+            if sensor is None: sensor = ""           # default from IRISSeismic Trace class prototype
+            if scale is None: scale = 1.0            # default from IRISSeismic Trace class prototype
+            if scalefreq is None: scalefreq = 1.0    # default from IRISSeismic Trace class prototype
+            if scaleunits is None: scaleunits = ""   # default from IRISSeismic Trace class prototype
+
+            # Keyword arguments for irisseismic.R_Stream()
+            trace_info = {'act_flags': flags['act_flags'],
+                          'io_flags': flags['io_flags'],
+                          'dq_flags': flags['dq_flags'],
+                          'timing_qual': flags['timing_qual'],
+                          'sensor': sensor,
+                          'scale': scale,
+                          'scalefreq': scalefreq,
+                          'scaleunits': scaleunits,
+                          'latitude': availability.latitude[0],
+                          'longitude': availability.longitude[0],
+                          'elevation': availability.elevation[0],
+                          'depth': availability.depth[0],
+                          'azimuth': availability.azimuth[0],
+                          'dip': availability.dip[0]}
+
+        except Exception as e:
+            err_msg = "Error reading in local waveform from %s" % filepath
+            self.logger.debug(e)
+            self.logger.debug(err_msg)
+            raise
+
+        finally:
+            if nday > 1:
+                datafile.close()
+
+        if len(py_stream) == 0:
+            raise Exception("no data available")
+
+        waveform = Waveform(_sncl_pattern, _starttime, _endtime, py_stream=py_stream, trace_info=trace_info,
+                            headonly=headonly)
+        if cache_key is not None:
+            self.waveform_cache[cache_key] = (waveform, len(availability))
+        return waveform
 
     def get_dataselect(self,
                        network=None, station=None, location=None, channel=None,
@@ -805,202 +1339,23 @@ class Concierge(object):
             specified end time.
         """
 
-        # Allow arguments to override UserRequest parameters
-        if starttime is None:
-            _starttime = self.requested_starttime
-        else:
-            _starttime = starttime
-        if endtime is None:
-            _endtime = self.requested_endtime
-        else:
-            _endtime = endtime
-
-        if self.dataselect_client is None:
-            # Read local MiniSEED file and convert to R_Stream
-            nday = int((_endtime - .00001).julday - _starttime.julday) + 1   # subtract a short amount of time for 00:00:00 endtimes
-
-            if (nday == 1):
-                _sncl_pattern = self.get_sncl_pattern(network, station, location, channel)
-                fpattern1 = '%s.%s' % (_sncl_pattern,_starttime.strftime('%Y.%j'))
-                fpattern2 = '%s' % (fpattern1 + '.[A-Z]')
-
-                matching_files = []
-                for root, dirnames, fnames in os.walk(self.dataselect_url):
-                    for fname in fnmatch.filter(fnames, fpattern1) + fnmatch.filter(fnames, fpattern2):
-                        matching_files.append(os.path.join(root,fname))
-
-                if (len(matching_files) == 0):
-                    self.logger.info("No files found matching '%s'" % (fpattern1))
-                else:
-                    filepath=matching_files[0]
-
-                    if (len(matching_files) > 1):
-                        self.logger.debug("Multiple files found: %s" % " ".join(matching_files))
-                        self.logger.warning("Multiple files found matching " '%s -- using %s' % (fpattern1, filepath))
-                    
-                    try:
-                        # Get the ObsPy version of the stream
-                        if not inclusiveEnd:
-                            _endtime = _endtime - 0.000001
-                        py_stream = obspy.read(filepath)
-                        py_stream = py_stream.slice(_starttime, _endtime, nearest_sample=False)
-                        flag_dict = obspy.io.mseed.util.get_timing_and_data_quality(filepath)
-                        act_flags = [0,0,0,0,0,0,0,0] # TODO:  Find a way to read act_flags
-                        io_flags = [0,0,0,0,0,0,0,0] # TODO:  Find a way to read io_flags
-                        dq_flags = flag_dict['data_quality_flags']
-                        # NOTE:  ObsPy does not store station metadata with each trace.
-                        # NOTE:  We need to read them in separately from station metadata.
-			availability = self.get_availability(network, station, location, channel, _starttime, _endtime)
-
-                        if(ignoreEpoch == False):
-                            if (len(availability) > 1):
-                                raise Exception("Multiple metadata epochs found for %s" % _sncl_pattern)
-
-			sensor = availability.instrument[0]
-			scale = availability.scale[0]
-			scalefreq = availability.scalefreq[0]
-			scaleunits = availability.scaleunits[0]
-			if sensor is None: sensor = ""           # default from IRISSeismic Trace class prototype
-			if scale is None: scale = 1.0            # default from IRISSeismic Trace class prototype
-			if scalefreq is None: scalefreq = 1.0    # default from IRISSeismic Trace class prototype
-			if scaleunits is None: scaleunits = ""   # default from IRISSeismic Trace class prototype
-			latitude = availability.latitude[0]
-			longitude = availability.longitude[0]
-			elevation = availability.elevation[0]
-			depth = availability.depth[0]
-			azimuth = availability.azimuth[0]
-			dip = availability.dip[0]
-			# Create the IRISSeismic version of the stream
-			r_stream = irisseismic.R_Stream(py_stream, _starttime, _endtime, act_flags, io_flags, dq_flags,
-							sensor, scale, scalefreq, scaleunits, latitude, longitude, elevation, depth, azimuth, dip)
-
-                    except Exception as e:
-                        err_msg = "Error reading in local waveform from %s" % filepath
-                        self.logger.debug(e)
-                        self.logger.debug(err_msg)
-                        raise
-                    if len(utils.get_slot(r_stream, 'traces')) == 0:
-                        raise Exception("no data available") 
-
-
-            else:
-		# create tempfile
-		x = tempfile.TemporaryFile()
-
-                # begin day loop
-		for day in range(nday):
-		    start = (_starttime + day * 86400)
-		    start = start - (start.hour * 3600 + start.minute * 60 + start.second + start.microsecond * .000001)
-		    end = start + 86400
-
-		    if start <= _starttime:
-			start = _starttime
-		    if end >= _endtime:
-			end = _endtime
-
-                    _sncl_pattern = self.get_sncl_pattern(network, station, location, channel)
-                    filename = '%s.%s' % (_sncl_pattern,_starttime.strftime('%Y.%j'))
-                    self.logger.debug("read local miniseed file for %s..." % filename)
-		    fpattern1 = self.dataselect_url + '/' + filename + '.[12][0-9][0-9][0-9].[0-9][0-9][0-9]'
-                    fpattern2 = fpattern1 + '.[A-Z]'
-		    matching_files = glob.glob(fpattern1) + glob.glob(fpattern2)
-		
-		    if (len(matching_files) == 0):
-                        err_msg = "No files found matching '%s'" % (fpattern1)
-                        raise Exception(err_msg)
-		    
-		    else:
-			filepath = matching_files[0]
-			if (len(matching_files) > 1):
-                            self.logger.debug("Multiple files found: %s" % " ".join(matching_files))
-			    self.logger.warning("Multiple files found matching" '%s -- using %s' % (fpattern1, filepath))
-
-                        # write miniseed to tempfile
-                        with open(filepath, 'rb') as f:
-                            x.write(f.read())
-                            x.flush()
-                        f.close()
-
-		try:
-                    py_stream = obspy.read(x)
-                    x.close()
-                    if not inclusiveEnd:
-                            _endtime = _endtime - 0.000001
-                    py_stream = py_stream.slice(_starttime, _endtime, nearest_sample=False) 
-                    # NOTE:  ObsPy does not store state-of-health flags with each stream.
-		    flag_dict = obspy.io.mseed.util.get_timing_and_data_quality(filepath)
-		    act_flags = [0,0,0,0,0,0,0,0] # TODO:  Find a way to read act_flags
-		    io_flags = [0,0,0,0,0,0,0,0] # TODO:  Find a way to read io_flags
-		    dq_flags = flag_dict['data_quality_flags']
-
-		    # NOTE:  ObsPy does not store station metadata with each trace.
-		    # NOTE:  We need to read them in separately from station metadata.
-		    # NOTE:  This should be consistent for each day of data
-		    availability = self.get_availability(network, station, location, channel, _starttime, _endtime)
-
-                    if(ignoreEpoch == False):
-                        if (len(availability) > 1):
-                            raise Exception("Multiple metadata epochs found for %s" % _sncl_pattern)
-
-		    sensor = availability.instrument[0]
-		    scale = availability.scale[0]
-		    scalefreq = availability.scalefreq[0]
-		    scaleunits = availability.scaleunits[0]
-		    if sensor is None: sensor = ""           # default from IRISSeismic Trace class prototype
-		    if scale is None: scale = 1.0            # default from IRISSeismic Trace class prototype
-		    if scalefreq is None: scalefreq = 1.0    # default from IRISSeismic Trace class prototype
-		    if scaleunits is None: scaleunits = ""   # default from IRISSeismic Trace class prototype
-		    latitude = availability.latitude[0]
-		    longitude = availability.longitude[0]
-		    elevation = availability.elevation[0]
-		    depth = availability.depth[0]
-		    azimuth = availability.azimuth[0]
-		    dip = availability.dip[0]
-
-		    # Create the IRISSeismic version of the stream
-		    r_stream = irisseismic.R_Stream(py_stream, _starttime, _endtime, act_flags, io_flags, dq_flags,
-						    sensor, scale, scalefreq, scaleunits, latitude, longitude, elevation, depth, azimuth, dip)
-			
-                except Exception as e:
-                    err_msg = "Error reading in local waveform from %s" % filepath
-                    self.logger.debug(e)
-                    self.logger.debug(err_msg)
-                    raise
-
-                if len(utils.get_slot(r_stream, 'traces')) == 0:
-                        raise Exception("no data available")
-      
-
-        else:
-            # Read from FDSN web services
-            try:
-                # R getDataselect() seems to capture awkward error reports when there is no data
-                # we want to suppress the stderr channel briefly to block the unwanted feedback from R
-                orig_stderr = sys.stderr
-                sys.stderr = self.dev_null
-                r_stream = irisseismic.R_getDataselect(self.dataselect_url, network, station, location, channel, _starttime, _endtime, quality, repository,inclusiveEnd, ignoreEpoch)
-                sys.stderr = orig_stderr
-            except Exception as e:
-                err_msg = "Error reading in waveform from FDSN dataselect webservice client (base url: %s)" % self.dataselect_url
-                self.logger.debug(str(e).strip('\n'))
-                self.logger.debug(err_msg)
-                raise
+        waveform = self.get_waveform(network, station, location, channel, starttime, endtime,
+                                     quality, repository, inclusiveEnd, ignoreEpoch)
 
-            # Some FDSN web services cut on record boundaries instead of samples, so make sure we have correct start/end times
-            try:
-                r_stream = irisseismic.R_slice(r_stream,_starttime, _endtime)
-            except Exception as e:
-                err_msg = "Error cutting R stream for start %s and end %s" % (_starttime, _endtime)
-                self.logger.debug(err_msg)
-                raise
+        if waveform.py_stream is not None:
+            # Create the IRISSeismic version of the local stream
+            return waveform.R_Stream()
 
+        # Read from FDSN web services
+        try:
+            r_stream = waveform.R_Stream()
+        except Exception as e:
+            err_msg = "Error reading in waveform from FDSN dataselect webservice client (base url: %s)" % self.dataselect_url
+            self.logger.debug(str(e).strip('\n'))
+            self.logger.debug(err_msg)
+            raise
 
-        # TODO:  Do we need to test for valid R_Stream.
-        if False:              
-            return None # TODO:  raise an exception
-        else:
-            return r_stream
-
+        return r_stream
 
     def get_event(self,
                   starttime=None, endtime=None,
@@ -1081,7 +1436,14 @@ class Concierge(object):
         else:
             _endtime = endtime
 
-        if self.event_client is None:
+        cache_key = tuple(str(arg) for arg in (_starttime, _endtime, minmag, maxmag, magtype, mindepth, maxdepth))
+        if cache_key in self.event_cache:
+            events = self.event_cache[cache_key]
+            if events is None:
+                return None
+            return events.copy()
+
+        if self.event_client is None and self.event_catalog is None:
             # Read local QuakeML file
             try:
                 event_catalog = obspy.read_events(self.event_url)
@@ -1114,7 +1476,10 @@ class Concierge(object):
                 dataframes.append(df)
                 
             # Concatenate into the events dataframe
-            events = pd.concat(dataframes, ignore_index=True)    
+            self.event_catalog = pd.concat(dataframes, ignore_index=True)
+
+        if self.event_client is None:
+            events = self.event_catalog.copy()
             if _starttime:
                 events = events[events['time'] >= _starttime]
             if _endtime:
@@ -1151,9 +1516,32 @@ class Concierge(object):
                 raise
 
         if events.shape[0] == 0:
+            self.event_cache[cache_key] = None
             return None # TODO:  raise an exception
         else:
-            return events
+            self.event_cache[cache_key] = events
+            return events.copy()
+
+    def get_traveltime(self, latitude, longitude, depth, staLatitude, staLongitude):
+        """
+        Returns :func:`~ispaq.irisseismic.getTraveltime` results for an event
+        and a station. Results are kept so that every business logic group
+        working on the same event asks the web service only once.
+        """
+        cache_key = tuple(str(arg) for arg in ('traveltime', latitude, longitude, depth, staLatitude, staLongitude))
+        if cache_key not in self.geometry_cache:
+            self.geometry_cache[cache_key] = irisseismic.getTraveltime(latitude, longitude, depth, staLatitude, staLongitude)
+        return self.geometry_cache[cache_key].copy()
+
+    def get_distaz(self, latitude, longitude, staLatitude, staLongitude):
+        """
+        Returns :func:`~ispaq.irisseismic.getDistaz` results for an event and
+        a station, kept in the same way as :meth:`get_traveltime`.
+        """
+        cache_key = tuple(str(arg) for arg in ('distaz', latitude, longitude, staLatitude, staLongitude))
+        if cache_key not in self.geometry_cache:
+            self.geometry_cache[cache_key] = irisseismic.getDistaz(latitude, longitude, staLatitude, staLongitude)
+        return self.geometry_cache[cache_key].copy()
 
 
 
@@ -22,11 +22,12 @@ from obspy import taup
 from obspy.taup import TauPyModel
 model = TauPyModel(model="iasp91")
 
-from .concierge import NoAvailableDataError
+from .concierge import NoAvailableDataError, Waveform
 
 from . import utils
 from . import irisseismic
 from . import irismustangmetrics
+from . import numpymetrics
 
 
 def crossCorrelation_metrics(concierge):
@@ -43,6 +44,22 @@ def crossCorrelation_metrics(concierge):
 
     TODO:  doctest examples
     """
+    return utils.finish_pass(crossCorrelation_metrics_events(concierge))
+
+
+def crossCorrelation_metrics_events(concierge):
+    """
+    Generate *crossCorrelation* metrics one event at a time.
+
+    This generator yields the ``(halfHourStart, halfHourEnd)`` window around
+    each event before the metrics of that event are submitted and finally
+    yields the dataframe of crossCorrelation metrics or None. It is run to
+    the end by :func:`crossCorrelation_metrics` or advanced in step with
+    other event based business logic by :func:`~ispaq.ispaq.run_pass`.
+
+    :type concierge: :class:`~ispaq.concierge.Concierge`
+    :param concierge: Data access expediter.
+    """
     # Get the logger from the concierge
     logger = concierge.logger
         
@@ -56,11 +73,14 @@ def crossCorrelation_metrics(concierge):
     snclMaxradius = 15
     windowSecs = 600
     maxLagSecs = 10
+
+    # Cross-correlate channels with local data using numpymetrics
+    use_numpy = 'crossCorrelation' in concierge.numpy_functions
         
     # Sanity check for metadata
     if concierge.station_url is None:
         logger.warning('No station metadata found for crossCorrelation metrics')
-        return None
+        return
 
     # Get the seismic events in this time period
     events = concierge.get_event(minmag=minmag)
@@ -68,7 +88,7 @@ def crossCorrelation_metrics(concierge):
     # Sanity check
     if events is None or events.shape[0] == 0:
         logger.info('No events found for crossCorrelation metrics.')
-        return None
+        return
         
     # Container for all of the metrics dataframes generated
     dataframes = []
@@ -81,6 +101,13 @@ def crossCorrelation_metrics(concierge):
 
     for (index, event) in events.iterrows():
 
+        # Window around the event used for metadata and data requests
+        halfHourStart = event.time - 60 * 2
+        halfHourEnd = event.time + 60 * 28
+
+        # Let a fused event pass bring other business logic to this event first
+        yield (halfHourStart, halfHourEnd)
+
         logger.info('%03d Magnitude %3.1f event: %s %s' % (index, event.magnitude, event.eventLocationName, event.time.strftime("%Y-%m-%dT%H:%M:%S")))
         
         # Sanity check
@@ -96,9 +123,6 @@ def crossCorrelation_metrics(concierge):
         # Get the data availability around this event
         # NOTE:  Get availability from 2 minutes before event until 28 minutes after
         # Get the data availability using spatial search parameters
-        halfHourStart = event.time - 60 * 2
-        halfHourEnd = event.time + 60 * 28
-
         logger.debug("Looking for metadata from %s to %s" % (halfHourStart,halfHourEnd))
         try:        
             availability = concierge.get_availability(starttime=halfHourStart, endtime=halfHourEnd,
@@ -122,6 +146,9 @@ def crossCorrelation_metrics(concierge):
 
         # function metadata dictionary
         function_metadata = concierge.function_by_logic['crossCorrelation']
+
+        # Filtered data and spectra of channels correlated with more than one station
+        spectra = {}
     
         # Loop over rows of the availability dataframe
         for (index, av1) in availability.iterrows():
@@ -150,7 +177,14 @@ def crossCorrelation_metrics(concierge):
             logger.debug("Looking for data for %s from %s to %s" % (av1.snclId, windowStart, windowEnd))
 
             try:
-                r_stream1 = concierge.get_dataselect(av1.network, av1.station, av1.location, av1.channel, windowStart, windowEnd)
+                waveform1 = concierge.get_waveform(av1.network, av1.station, av1.location, av1.channel, windowStart, windowEnd,
+                                                   within=(halfHourStart-1, halfHourEnd+1))
+                if use_numpy and waveform1.py_stream is not None:
+                    stream1 = waveform1
+                    trace_count = len(waveform1.py_stream)
+                else:
+                    stream1 = waveform1.R_Stream()
+                    trace_count = len(utils.get_slot(stream1, 'traces'))
             except Exception as e:
                 if str(e).lower().find('no data') > -1:
                     logger.info('No data available for %s' % (av1.snclId))
@@ -161,13 +195,17 @@ def crossCorrelation_metrics(concierge):
                 continue
             
             # No metric calculation possible if SNCL has more than one trace 
-            if len(utils.get_slot(r_stream1, 'traces')) > 1 :
+            if trace_count > 1 :
                 logger.info('Skipping %s because it has gaps' % (av1.snclId))
                 continue
 
             # If metadata indicates reversed polarity (dip>0), invert the amplitudes 
+            polarity1 = 1.0
             if av1.channel[2] == 'Z' and av1.dip > 0:
-                r_stream1 = irisseismic.multiplyBy(r_stream1, -1.0)
+                if isinstance(stream1, Waveform):
+                    polarity1 = -1.0
+                else:
+                    stream1 = irisseismic.multiplyBy(stream1, -1.0)
 
 
             # ----- Now query again to find ANY SNCL near the SNCL of interest ---------
@@ -255,8 +293,8 @@ def crossCorrelation_metrics(concierge):
 
                 # Get data in a window centered on the event's arrival at station #2
                 try:
-                    tt = irisseismic.getTraveltime(event.latitude, event.longitude, event.depth, 
-                                                   av2.latitude, av2.longitude)
+                    tt = concierge.get_traveltime(event.latitude, event.longitude, event.depth, 
+                                                  av2.latitude, av2.longitude)
                 except Exception as e:
                     logger.warning('Skipping %s:%s because getTravelTime failed: %s' % (av1.snclId, av2.snclId, e))
                     if av2.snclId is lastsncl:
@@ -269,7 +307,14 @@ def crossCorrelation_metrics(concierge):
                 logger.debug("Looking for near neighbor station %s from %s to %s" % (av2.snclId, windowStart, windowEnd))
 
                 try:
-                    r_stream2 = concierge.get_dataselect(av2.network, av2.station, av2.location, av2.channel, windowStart, windowEnd)
+                    waveform2 = concierge.get_waveform(av2.network, av2.station, av2.location, av2.channel, windowStart, windowEnd,
+                                                       within=(halfHourStart-1, halfHourEnd+1))
+                    if use_numpy and waveform2.py_stream is not None:
+                        stream2 = waveform2
+                        trace_count = len(waveform2.py_stream)
+                    else:
+                        stream2 = waveform2.R_Stream()
+                        trace_count = len(utils.get_slot(stream2, 'traces'))
                 except Exception as e:
                     if str(e).lower().find('no data') > -1:
                         logger.debug('No data available for %s' % (av2.snclId))
@@ -282,8 +327,8 @@ def crossCorrelation_metrics(concierge):
                     continue
                    
                 # Check for actual sample rate compatibility
-                sampler1 = utils.get_slot(r_stream1,'sampling_rate')
-                sampler2 = utils.get_slot(r_stream2,'sampling_rate')
+                sampler1 = utils.get_stream_slot(stream1,'sampling_rate')
+                sampler2 = utils.get_stream_slot(stream2,'sampling_rate')
      
                 if sampler1 >= 1 and sampler2 >= 1: 
                     sr1 = int(round(sampler1,1))
@@ -297,7 +342,7 @@ def crossCorrelation_metrics(concierge):
             
                 # NOTE:  This check is missing from IRISMustangUtils/R/generateMetrics_crossCorrelation.R
                 # No metric calculation possible if SNCL has more than one trace
-                if len(utils.get_slot(r_stream2, 'traces')) > 1:
+                if trace_count > 1:
                     logger.debug('Skipping %s because it has gaps' % (av2.snclId))
                     if av2.snclId is lastsncl:
                         testx = 1
@@ -317,7 +362,10 @@ def crossCorrelation_metrics(concierge):
             # Calculate the cross-correlation metrics and append them to the list
             logger.info('Calculating crossCorrelation metrics for %s:%s' % (av1.snclId, av2.snclId))
             try:
-                df = irismustangmetrics.apply_correlation_metric(r_stream1, r_stream2, 'crossCorrelation', maxLagSecs)
+                if isinstance(stream1, Waveform) and isinstance(stream2, Waveform):
+                    df = numpymetrics.crossCorrelationMetric(stream1, stream2, maxLagSecs, polarity1=polarity1, cache=spectra)
+                else:
+                    df = irismustangmetrics.apply_correlation_metric(stream1, stream2, 'crossCorrelation', maxLagSecs)
                 dataframes.append(df)
             except Exception as e:
                 logger.warning('"crossCorrelation" metric calculation failed for %s:%s: %s' % (av1.snclId, av2.snclId, e))
@@ -336,13 +384,13 @@ def crossCorrelation_metrics(concierge):
         
     if len(dataframes) == 0:
         logger.warning('"cross_correlation" metric calculation generated zero metrics')
-        return None
+        return
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         mask = result.metricName.apply(valid_metric)
         result = result[(mask)]
         result.reset_index(drop=True, inplace=True)        
-        return(result)
+        yield result
 
 
 # ------------------------------------------------------------------------------
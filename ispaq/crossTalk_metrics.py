@@ -10,17 +10,19 @@ ISPAQ Business Logic for Cross-Talk Metrics.
 
 from __future__ import (absolute_import, division, print_function)
 
+import collections
 import math
 import numpy as np
 import pandas as pd
 
 from obspy import UTCDateTime
 
-from .concierge import NoAvailableDataError
+from .concierge import NoAvailableDataError, Waveform
 
 from . import utils
 from . import irisseismic
 from . import irismustangmetrics
+from . import numpymetrics
 
 pd.options.mode.chained_assignment = None
 # chained_assignment added to skip "SettingWithCopyWarning: 
@@ -41,6 +43,22 @@ def crossTalk_metrics(concierge):
 
     TODO:  doctest examples
     """
+    return utils.finish_pass(crossTalk_metrics_events(concierge))
+
+
+def crossTalk_metrics_events(concierge):
+    """
+    Generate *crossTalk* metrics one event at a time.
+
+    This generator yields the ``(halfHourStart, halfHourEnd)`` window around
+    each event before the metrics of that event are submitted and finally
+    yields the dataframe of crossTalk metrics or None. It is run to the end
+    by :func:`crossTalk_metrics` or advanced in step with other event based
+    business logic by :func:`~ispaq.ispaq.run_pass`.
+
+    :type concierge: :class:`~ispaq.concierge.Concierge`
+    :param concierge: Data access expediter.
+    """
     # Get the logger from the concierge
     logger = concierge.logger
         
@@ -54,7 +72,7 @@ def crossTalk_metrics(concierge):
     # Sanity check for metadata
     if concierge.station_url is None:
         logger.warning('No station metadata found for crossTalk metrics')
-        return None
+        return
 
     # Get the seismic events in this time period
     events = concierge.get_event(minmag=minmag)
@@ -62,7 +80,7 @@ def crossTalk_metrics(concierge):
     # Sanity check
     if events is None or events.shape[0] == 0:
         logger.info('No events found for crossTalk metrics.')
-        return None
+        return
         
     # Container for all of the metrics dataframes generated
     dataframes = []
@@ -74,8 +92,42 @@ def crossTalk_metrics(concierge):
 
     logger.info('Calculating crossTalk metrics for %d events' % events.shape[0])
 
+    # crossTalk requires 3 channels, look for all 3 even if input SNCL pattern is for one (i.e., TA.109..BHZ will look for TA.109C..BH?)
+    sncl_patterns = concierge.get_component_sncl_patterns()
+
+    # Events whose jobs have not been gathered yet
+    pending_events = collections.deque()
+
+    def gather_event(jobs):
+        """
+        Gather the results of one event in the order the jobs were submitted.
+        """
+        for (sn_lId, job) in jobs:
+            try:
+                results = job.get()
+            except Exception as e:
+                logger.warning('"crossTalk" metric calculation failed for %s: %s' % (sn_lId, e))
+                continue
+
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.warning('"crossTalk" metric calculation failed for %s: %s' % (sn_lId, result))
+                elif isinstance(result, pd.DataFrame):
+                    dataframes.append(result)
+                else:
+                    logger.info(result)
+
+            concierge.memory.tick()
+
     for (index, event) in events.iterrows():
 
+        # Window around the event used for metadata and data requests
+        halfHourStart = event.time - 60 * 2
+        halfHourEnd = event.time + 60 * 28
+
+        # Let a fused event pass bring other business logic to this event first
+        yield (halfHourStart, halfHourEnd)
+
         logger.info('%03d Magnitude %3.1f event: %s %s' % (index, event.magnitude, event.eventLocationName, event.time.strftime("%Y-%m-%dT%H:%M:%S")))
         
         # Sanity check
@@ -91,46 +143,23 @@ def crossTalk_metrics(concierge):
         # Get the data availability around this event
         # NOTE:  Get availability from 2 minutes before event until 28 minutes after
         # Get the data availability using spatial search parameters
-        halfHourStart = event.time - 60 * 2
-        halfHourEnd = event.time + 60 * 28
-  
         logger.debug("Looking for metadata from %s to %s" % (halfHourStart.strftime("%Y-%m-%dT%H:%M:%S"),halfHourEnd.strftime("%Y-%m-%dT%H:%M:%S")))
 
-        # crossTalk requires 3 channels, look for all 3 even if input SNCL pattern is for one (i.e., TA.109..BHZ will look for TA.109C..BH?)
-        original_sncl_patterns = concierge.sncl_patterns
-        new_sncl_patterns = []
-        UR=["temp0","temp1","temp2","temp3"]
-        for sncl_pattern in concierge.sncl_patterns:
-            UR[concierge.netOrder] = sncl_pattern.split('.')[concierge.netOrder]
-            UR[concierge.staOrder] = sncl_pattern.split('.')[concierge.staOrder]
-            UR[concierge.locOrder] = sncl_pattern.split('.')[concierge.locOrder]
-            UR[concierge.chanOrder] = sncl_pattern.split('.')[concierge.chanOrder]
-            if len(UR[concierge.chanOrder]) == 3:
-                UR[concierge.chanOrder]=UR[concierge.chanOrder][:-1] + '?'
-            new_sncl_pattern = ".".join(UR)
-            new_sncl_patterns.append(new_sncl_pattern)
-        concierge.sncl_patterns = new_sncl_patterns    
-
-
         try:        
             availability = concierge.get_availability(starttime=halfHourStart, endtime=halfHourEnd,
                                                       longitude=event.longitude, latitude=event.latitude,
-                                                      minradius=0, maxradius=maxradius)
+                                                      minradius=0, maxradius=maxradius,
+                                                      sncl_patterns=sncl_patterns)
         except NoAvailableDataError as e:
             logger.info('Skipping event with no available data')
-            concierge.sncl_patterns = original_sncl_patterns
             continue
         except Exception as e:
             logger.warning('Skipping event because concierge.get_availability failed: %s' % (e))
-            concierge.sncl_patterns = original_sncl_patterns
             continue
         if availability is None:
             logger.info("Skipping event with no available data")
-            concierge.sncl_patterns = original_sncl_patterns
             continue
 
-        concierge.sncl_patterns = original_sncl_patterns
-                    
         # Apply the channelFilter
         availability = availability[availability.channel.str.contains(channelFilter)]      
 
@@ -148,6 +177,9 @@ def crossTalk_metrics(concierge):
         # Add sn_lId to the availability dataframe for easy detection
         availability.loc[:,'sn_lId'] = sn_lIds
 
+        # Metric calculations are submitted to the executor and gathered in SN.L order
+        jobs = []
+
         # ----- All available SNCLs -------------------------------------------------
 
         for idx, sn_lId in enumerate(sorted(list(set(sn_lIds)))):
@@ -164,7 +196,7 @@ def crossTalk_metrics(concierge):
 
             # NOTE:  Expand the window by an extra second to guarantee that 
             # NOTE:  halfHourStart < tr@stats@starttime and halfHourEnd > tr@stats@endtime
-            streamList = []
+            waveforms = []
 
             # Loop over rows of the availabilitySub dataframe
             for (index2, av) in availabilitySub.iterrows():
@@ -177,7 +209,7 @@ def crossTalk_metrics(concierge):
                 logger.debug("Looking for data for %s from %s to %s" % (av.snclId, halfHourStart.strftime("%Y-%m-%dT%H:%M:%S"), halfHourEnd.strftime("%Y-%m-%dT%H:%M:%S")))
 
                 try:
-                    r_stream = concierge.get_dataselect(av.network, av.station, av.location, av.channel, halfHourStart-1, halfHourEnd+1, inclusiveEnd=False)
+                    waveform = concierge.get_waveform(av.network, av.station, av.location, av.channel, halfHourStart-1, halfHourEnd+1, inclusiveEnd=False)
                 except Exception as e:
                     if str(e).lower().find('no data') > -1:
                         logger.info('No data available for %s' % (av.snclId))
@@ -186,86 +218,31 @@ def crossTalk_metrics(concierge):
                     else:
                         logger.warning('No data available for %s from %s: %s' % (av.snclId, concierge.dataselect_url, e))
                     continue
-                
-                if len(utils.get_slot(r_stream, 'traces')) > 1 :
-                    logger.info('Skipping %s because it has gaps' % (av.snclId))
-                else:
-                    streamList.append(r_stream)
-                    
-            if len(streamList) == 0:
-                logger.info('Skipping %s because it has no usable channels' % (sn_lId))
-                continue
-                
-            if len(streamList) == 1:
-                logger.info('Skipping %s because it only has usable data for one channel' % (sn_lId))
-                continue   
 
-            # Run the correlation metrics -----------------------
+                waveforms.append(waveform)
 
-            # At this point, each stream in streamList has only one trace
-            # and can now be used in the correlation metric.
-            
-            logger.debug('Calculating crossTalk metrics for %d streams' % (len(streamList)))
+            if len(waveforms) == 0:
+                logger.info('Skipping %s because it has no usable channels' % (sn_lId))
+                continue
 
-            # 1-2
-            l0 = utils.get_slot(streamList[0],'npts')
-            c0 = utils.get_slot(streamList[0],'channel')
-            l1 = utils.get_slot(streamList[1],'npts')
-            c1 = utils.get_slot(streamList[1],'channel')
-            
-            if len(streamList) == 2:
-                if( abs(l0 - l1) > 2):
-                    logger.info('Skipping %s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d' % (sn_lId,c0,l0,c1,l1))
-                    continue
-                try:
-                    df = irismustangmetrics.apply_correlation_metric(streamList[0], streamList[1], 'correlation')
-                    dataframes.append(df)
-                except Exception as e:
-                    logger.warning('"crossTalk" metric calculation failed for %s: %s' % (av.snclId, e))
-            
-            if len(streamList) == 3:
-                l2 = utils.get_slot(streamList[2],'npts')
-                c2 = utils.get_slot(streamList[2],'channel')
+            job = concierge.executor.submit(_crossTalk_metrics_job, sn_lId, waveforms,
+                                            'crossTalk' in concierge.numpy_functions)
+            jobs.append((sn_lId, job))
 
-                if( abs(l0 - l1) > 2 and abs(l1-l2) > 2 and abs(l0-l2) > 2):
-                    logger.info('Skipping %s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d, %s=%d' % (sn_lId,c0,l0,c1,l1,c2,l2))
-                    continue
+        # End of sn.lId loop
 
-                # 1-2
-                if( abs(l0 - l1) <= 2):
-                    try:
-                        df = irismustangmetrics.apply_correlation_metric(streamList[0], streamList[1], 'correlation')
-                        dataframes.append(df)
-                    except Exception as e:
-                        logger.warning('"crossTalk" metric calculation failed for %s: %s' % (av.snclId, e))
-                else:
-                    logger.info('Skipping %s %s:%s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d' % (sn_lId,c0,c1,c0,l0,c1,l1))
-
-                # 1-3
-                if( abs(l0 - l2) <= 2):
-                    try:
-                        df = irismustangmetrics.apply_correlation_metric(streamList[0], streamList[2], 'correlation')
-                        dataframes.append(df)
-                    except Exception as e:
-                        logger.warning('"crossTalk" metric calculation failed for %s: %s' % (av.snclId, e))
-                else:
-                    logger.info('Skipping %s %s:%s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d' % (sn_lId,c0,c2,c0,l0,c2,l2))
-                
-                # 2-3
-                if( abs(l1 - l2) <= 2):
-                    try:
-                        df = irismustangmetrics.apply_correlation_metric(streamList[1], streamList[2], 'correlation')
-                        dataframes.append(df)
-                    except Exception as e:
-                        logger.warning('"crossTalk" metric calculation failed for %s: %s' % (av.snclId, e))
-                else:
-                    logger.info('Skipping %s %s:%s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d' % (sn_lId,c1,c2,c1,l1,c2,l2))
-                    
+        pending_events.append(jobs)
 
-        # End of sn.lId loop
+        # NOTE:  Jobs of the next events are submitted before earlier events are gathered so that
+        # NOTE:  workers stay busy across events
+        while len(pending_events) > concierge.workers:
+            gather_event(pending_events.popleft())
 
     # End of event loop
 
+    while pending_events:
+        gather_event(pending_events.popleft())
+
     # Concatenate and filter dataframes before returning -----------------------
     
     # Create a boolean mask for filtering the dataframe
@@ -274,13 +251,117 @@ def crossTalk_metrics(concierge):
         
     if len(dataframes) == 0:
         logger.warning('"cross_talk" metric calculation generated zero metrics')
-        return None
+        return
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         mask = result.metricName.apply(valid_metric)
         result = result[(mask)]
         result.reset_index(drop=True, inplace=True)        
-        return(result)
+        yield result
+
+
+def _crossTalk_metrics_job(sn_lId, waveforms, use_numpy):
+    """
+    Correlate the channels of one SN.L with each other.
+
+    This is submitted to the concierge executor and may run in a worker process.
+
+    :param sn_lId: Network.Station.Location.ChannelType identifier.
+    :param waveforms: List of :class:`~ispaq.concierge.Waveform` for the
+        channels of this SN.L.
+    :param use_numpy: Calculate with :mod:`~ispaq.numpymetrics` when local
+        data are available.
+
+    :rtype: list
+    :return: Dataframes with the correlation metric, exceptions raised by the
+        metric function and messages explaining why channels or pairs of
+        channels were skipped, in the order they occurred.
+    """
+    results = []
+
+    streamList = []
+    for waveform in waveforms:
+        try:
+            if use_numpy and waveform.py_stream is not None:
+                stream = waveform
+                trace_count = len(waveform.py_stream)
+            else:
+                stream = waveform.R_Stream()
+                trace_count = len(utils.get_slot(stream, 'traces'))
+        except Exception as e:
+            results.append('No data available for %s: %s' % (waveform.snclId, e))
+            continue
+
+        if trace_count > 1 :
+            results.append('Skipping %s because it has gaps' % (waveform.snclId))
+        else:
+            streamList.append(stream)
+                    
+    if len(streamList) == 0:
+        results.append('Skipping %s because it has no usable channels' % (sn_lId))
+        return results
+                
+    if len(streamList) == 1:
+        results.append('Skipping %s because it only has usable data for one channel' % (sn_lId))
+        return results
+
+    # Run the correlation metrics -----------------------
+
+    # At this point, each stream in streamList has only one trace
+    # and can now be used in the correlation metric.
+
+    # 1-2
+    l0 = utils.get_stream_slot(streamList[0],'npts')
+    c0 = utils.get_stream_slot(streamList[0],'channel')
+    l1 = utils.get_stream_slot(streamList[1],'npts')
+    c1 = utils.get_stream_slot(streamList[1],'channel')
+
+    # Pairs of channels with compatible lengths
+    pairs = []
+    
+    if len(streamList) == 2:
+        if( abs(l0 - l1) > 2):
+            results.append('Skipping %s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d' % (sn_lId,c0,l0,c1,l1))
+            return results
+        pairs.append((0,1))
+    
+    if len(streamList) == 3:
+        l2 = utils.get_stream_slot(streamList[2],'npts')
+        c2 = utils.get_stream_slot(streamList[2],'channel')
+
+        if( abs(l0 - l1) > 2 and abs(l1-l2) > 2 and abs(l0-l2) > 2):
+            results.append('Skipping %s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d, %s=%d' % (sn_lId,c0,l0,c1,l1,c2,l2))
+            return results
+
+        # 1-2
+        if( abs(l0 - l1) <= 2):
+            pairs.append((0,1))
+        else:
+            results.append('Skipping %s %s:%s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d' % (sn_lId,c0,c1,c0,l0,c1,l1))
+
+        # 1-3
+        if( abs(l0 - l2) <= 2):
+            pairs.append((0,2))
+        else:
+            results.append('Skipping %s %s:%s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d' % (sn_lId,c0,c2,c0,l0,c2,l2))
+        
+        # 2-3
+        if( abs(l1 - l2) <= 2):
+            pairs.append((1,2))
+        else:
+            results.append('Skipping %s %s:%s because the number of data samples differs between channels. Incompatible lengths %s=%d, %s=%d' % (sn_lId,c1,c2,c1,l1,c2,l2))
+
+    # Correlate all pairs of local channels at once, otherwise one pair at a time in R
+    if all(isinstance(stream, Waveform) for stream in streamList):
+        results.extend(numpymetrics.correlationMetric_batch(streamList, pairs))
+    else:
+        for (i, j) in pairs:
+            try:
+                results.append(irismustangmetrics.apply_correlation_metric(utils.as_R_Stream(streamList[i]), utils.as_R_Stream(streamList[j]), 'correlation'))
+            except Exception as e:
+                results.append(e)
+
+    return results
 
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,109 @@
+"""
+ISPAQ Metric Engines.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+
+Every metric function can be calculated by the IRISMustangMetrics R package
+and some of them also by :mod:`~ispaq.numpymetrics`. This module records which
+engines are available for each metric function named in the
+``function_by_logic`` dictionary and turns the ``engine`` preference into the
+list of metric functions that business logic calculates with NumPy.
+
+Engines:
+ * ``r`` -- every metric function is calculated with R
+ * ``numpy`` -- every metric function with a NumPy version is calculated with
+   NumPy and the others with R
+ * ``auto`` -- metric functions listed in the ``numpy_functions`` preference
+   are calculated with NumPy and the others with R
+
+NumPy metric functions only work on local miniSEED data so business logic
+always falls back on R for data from FDSN web services. The orientationCheck
+metric is always calculated with NumPy.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+
+from . import numpymetrics
+from .ispaq import currentispaq
+
+ENGINES = ['numpy', 'r', 'auto']
+
+# Metric functions that share the engine of another metric function
+ALIASES = {'PSDText': 'PSD',
+           'PSDPlot': 'PSD'}
+
+# Metric functions that are only calculated with NumPy
+NUMPY_ONLY = ['orientationCheck']
+
+
+def registry():
+    """
+    Return the engines available for each metric function.
+    :return: Dictionary of lists of engine names by metric function name.
+
+    .. rubric:: Example
+
+    >>> registry()['gaps']
+    ['r', 'numpy']
+    >>> registry()['PSDText']
+    ['r', 'numpy']
+    >>> registry()['orientationCheck']
+    ['numpy']
+    """
+    engines = {}
+    for function_names in currentispaq().values():
+        for function_name in function_names:
+            name = ALIASES.get(function_name, function_name)
+            if name in NUMPY_ONLY:
+                engines[function_name] = ['numpy']
+            elif name in numpymetrics.FUNCTIONS:
+                engines[function_name] = ['r', 'numpy']
+            else:
+                engines[function_name] = ['r']
+    return engines
+
+
+def numpy_functions(engine, requested_functions=(), logger=None):
+    """
+    Return the metric functions to calculate with NumPy.
+    :param engine: One of ``numpy``, ``r`` or ``auto``.
+    :param requested_functions: Metric functions named in the
+        ``numpy_functions`` preference, only used by the ``auto`` engine.
+    :param logger: Optional logger warned about functions without a NumPy version.
+    :return: Sorted list of metric function names.
+
+    .. rubric:: Example
+
+    >>> numpy_functions('r', ['gaps'])
+    []
+    >>> numpy_functions('auto', ['gaps', 'basicStats'])
+    ['basicStats', 'gaps']
+    >>> 'PSD' in numpy_functions('numpy')
+    True
+    """
+    if engine not in ENGINES:
+        raise Exception("numpy_functions: engine '%s' is not one of %s" % (engine, ', '.join(ENGINES)))
+    if engine == 'r':
+        return []
+    if engine == 'numpy':
+        return sorted(numpymetrics.FUNCTIONS)
+
+    function_names = []
+    for function_name in requested_functions:
+        if function_name in numpymetrics.FUNCTIONS:
+            function_names.append(function_name)
+        elif logger is not None:
+            logger.warning('numpy_functions: no NumPy version of "%s", using R' % function_name)
+    return sorted(set(function_names))
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(exclude_empty=True)
@@ -0,0 +1,216 @@
+"""
+ISPAQ Metric Executors.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+
+rpy2 embeds a single R interpreter in each python process so all calls into
+the IRIS R packages made by one ISPAQ process run on a single core.
+
+Business logic hands metric calculations to an executor instead of calling
+them directly. The :class:`SerialExecutor` runs each job immediately in the
+current process. The :class:`RWorkerPool` sends jobs to a pool of worker
+processes, each of which starts R and loads the IRIS packages once and then
+stays warm for the rest of the run.
+
+Both executors share the same interface:
+
+* ``submit(function, *args, **kwargs)`` queues a job and returns a handle
+* ``handle.get()`` returns the job result or raises the job exception
+* ``close()`` waits for all outstanding jobs and shuts down any workers
+
+Job functions and their arguments must be picklable: functions must be
+defined at module level and R objects must not be passed. Waveform data are
+passed as :class:`~ispaq.concierge.Waveform` objects.
+
+Results are always gathered by the business logic in the order in which jobs
+were submitted so that output does not depend on the number of workers.
+
+:func:`run_tasks` runs whole business logic groups concurrently in forked
+processes that inherit the state of the main process.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+
+import collections
+import multiprocessing
+import signal
+import sys
+import time
+import traceback
+
+
+#     Worker process initialization     ----------------------------------------
+
+# Garbage collection in the worker process
+_memory = None
+
+def _initialize_worker(gc_interval):
+    """
+    Initialize a pool worker process.
+
+    Starting R and loading IRISSeismic and IRISMustangMetrics happens once
+    here rather than in every job.
+    """
+    global _memory
+    # Let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from . import rsession
+    from . import utils
+    rsession.load_packages()
+    _memory = utils.MemoryManager(gc_interval)
+
+
+def _run_job(function, args, kwargs):
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _memory.tick()
+
+
+#     Executors     --------------------------------------------------------------
+
+class _Result(object):
+    """
+    Result handle returned by :meth:`SerialExecutor.submit`.
+    """
+    def __init__(self, value=None, exception=None):
+        self.value = value
+        self.exception = exception
+
+    def get(self):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class SerialExecutor(object):
+    """
+    Run every job immediately in the current process.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.workers = 1
+
+    def submit(self, function, *args, **kwargs):
+        try:
+            return _Result(value=function(*args, **kwargs))
+        except Exception as e:
+            return _Result(exception=e)
+
+    def close(self):
+        pass
+
+
+class RWorkerPool(object):
+    """
+    Run jobs on a pool of worker processes, each with its own warm R session.
+
+    :type workers: int
+    :param workers: Number of worker processes.
+    :type gc_interval: int
+    :param gc_interval: Number of jobs each worker runs between python and R
+        garbage collections.
+    :type max_pending: int
+    :param max_pending: Maximum number of submitted jobs that have not yet
+        finished. Waveforms for queued jobs are held in memory by the parent
+        process so :meth:`submit` blocks once this limit is reached.
+        Defaults to twice the number of workers.
+    """
+    def __init__(self, workers, gc_interval=10, max_pending=None, logger=None):
+        self.logger = logger
+        self.workers = workers
+        if max_pending is None:
+            max_pending = 2 * workers
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.pool = multiprocessing.Pool(processes=workers, initializer=_initialize_worker,
+                                         initargs=(gc_interval,))
+        if self.logger is not None:
+            self.logger.debug("Started pool of %d R worker processes" % workers)
+
+    def submit(self, function, *args, **kwargs):
+        # Apply back pressure so that queued waveforms do not accumulate
+        while self.pending and self.pending[0].ready():
+            self.pending.popleft()
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft().wait()
+        result = self.pool.apply_async(_run_job, (function, args, kwargs))
+        self.pending.append(result)
+        return result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.pending.clear()
+
+
+#     Concurrent tasks     ------------------------------------------------------
+
+def _run_task(function, args):
+    try:
+        function(*args)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+    sys.exit(0)
+
+
+def run_tasks(tasks, max_running, poll_interval=0.1, logger=None):
+    """
+    Run independent tasks in forked processes, at most `max_running` at a time.
+
+    Each task runs in a child process forked from the current one so that it
+    shares everything already built, e.g. the concierge and the R session,
+    without any pickling. A task that raises or whose process dies does not
+    affect the others.
+
+    :param tasks: List of (name, function, args) tuples.
+    :param max_running: Maximum number of tasks running at once.
+    :param poll_interval: Seconds between checks for finished tasks.
+    :return: Dictionary of process exit codes by task name, 0 for success.
+    """
+    pending = collections.deque(tasks)
+    running = {}
+    exitcodes = {}
+    while pending or running:
+        while pending and len(running) < max_running:
+            (name, function, args) = pending.popleft()
+            process = multiprocessing.Process(target=_run_task, args=(function, args), name=name)
+            process.start()
+            running[name] = process
+            if logger is not None:
+                logger.debug("Started '%s' in process %d" % (name, process.pid))
+        finished = [name for (name, process) in running.items() if not process.is_alive()]
+        if not finished:
+            time.sleep(poll_interval)
+            continue
+        for name in finished:
+            process = running.pop(name)
+            process.join()
+            exitcodes[name] = process.exitcode
+            if logger is not None:
+                logger.debug("'%s' finished with exit code %s" % (name, process.exitcode))
+    return exitcodes
+
+
+def create_executor(workers=1, gc_interval=10, logger=None):
+    """
+    Return a :class:`SerialExecutor` for a single worker or an
+    :class:`RWorkerPool` for more than one.
+    """
+    if workers is None or int(workers) <= 1:
+        return SerialExecutor(logger=logger)
+    else:
+        return RWorkerPool(int(workers), gc_interval=gc_interval, logger=logger)
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(exclude_empty=True)
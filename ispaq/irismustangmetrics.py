@@ -21,16 +21,16 @@ to know anything about the particular metric function they are calling.
 
 from __future__ import (absolute_import, division, print_function)
 
+import os
+import sys
 import math
 import numpy as np
 import pandas as pd
 import json
 
-from obspy.core import UTCDateTime
+from .rsession import robjects, rinterface, pandas2ri, RFunction
 
-from rpy2 import robjects
-from rpy2 import rinterface
-from rpy2.robjects import pandas2ri
+from . import irisseismic
 
 #   R functions called internally     ------------------------------------------
 
@@ -39,13 +39,79 @@ from rpy2.robjects import pandas2ri
 # NOTE:  R-compatible objects as arguments.
 
 # IRISMustangMetrics helper functions
-_R_metricList2DF = robjects.r('IRISMustangMetrics::metricList2DF')
-_R_getMetricFunctionMetadata = robjects.r('IRISMustangMetrics::getMetricFunctionMetadata')
+_R_metricList2DF = RFunction('IRISMustangMetrics::metricList2DF')
+_R_getMetricFunctionMetadata = RFunction('IRISMustangMetrics::getMetricFunctionMetadata')
+
+# Directory for the cached function metadata catalog
+METADATA_CACHE_DIR = os.path.expanduser('~/.ispaq')
+
+def installed_version(package='IRISMustangMetrics'):
+    """
+    Return the version of an installed R package.
+
+    The DESCRIPTION file is read from the R library directories so that R
+    does not need to be started. R is only asked if the file cannot be found.
+    :param package: Name of the R package.
+    :return: Version string, e.g. '2.1.0'.
+    """
+    libdirs = []
+    for variable in ['R_LIBS', 'R_LIBS_USER', 'R_LIBS_SITE']:
+        if os.environ.get(variable):
+            libdirs.extend(os.environ[variable].split(os.pathsep))
+    if os.environ.get('R_HOME'):
+        libdirs.append(os.path.join(os.environ['R_HOME'], 'library'))
+    # Conda environments install R packages inside the environment
+    libdirs.append(os.path.join(sys.prefix, 'lib', 'R', 'library'))
+    libdirs.extend(['/usr/local/lib/R/site-library', '/usr/lib/R/site-library', '/usr/lib/R/library',
+                    '/Library/Frameworks/R.framework/Resources/library'])
+
+    for libdir in libdirs:
+        description = os.path.join(os.path.expanduser(libdir), package, 'DESCRIPTION')
+        if os.path.isfile(description):
+            with open(description) as f:
+                for line in f:
+                    if line.startswith('Version:'):
+                        return line.split(':', 1)[1].strip()
+
+    r_version = robjects.r('as.character(utils::packageVersion("%s"))' % package)
+    return r_version[0]
+
+
+def function_metadata(refresh=False):
+    """
+    Return the IRISMustangMetrics function metadata as a dictionary.
+
+    The JSON returned by IRISMustangMetrics::getMetricFunctionMetadata is
+    cached in METADATA_CACHE_DIR under a name that includes the installed
+    package version so that R is only started when the package changes.
+    :param refresh: Ignore any cached metadata and ask R again.
+    :return: dictionary of function metadata keyed by function name.
+    """
+    version = installed_version('IRISMustangMetrics')
+    cache_file = os.path.join(METADATA_CACHE_DIR, 'IRISMustangMetrics_%s_functionMetadata.json' % version)
+
+    if not refresh and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            pass  # fall through and regenerate a damaged cache file
 
-def function_metadata():
     r_json = _R_getMetricFunctionMetadata()
     py_json = r_json[0]
     functionMetadata = json.loads(py_json)
+
+    # Write to a temporary file first so that concurrent runs never read a partial file
+    try:
+        if not os.path.isdir(METADATA_CACHE_DIR):
+            os.makedirs(METADATA_CACHE_DIR)
+        tmp_file = '%s.%d' % (cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(py_json)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        pass  # caching is optional
+
     return functionMetadata
 
 #     Functions that return GeneralValueMetrics     -----------------------------
@@ -59,7 +125,7 @@ def apply_simple_metric(r_stream, metric_function_name, *args, **kwargs):
     :param metric_function_name: the name of the set of metrics
     :return:
     """
-    if metric_function_name is 'numSpikes':
+    if metric_function_name == 'numSpikes':
         function = 'IRISMustangMetrics::spikesMetric'
     else:
         function = 'IRISMustangMetrics::' + metric_function_name + 'Metric'
@@ -68,9 +134,9 @@ def apply_simple_metric(r_stream, metric_function_name, *args, **kwargs):
     r_dataframe = _R_metricList2DF(r_metriclist)
     df = pandas2ri.ri2py(r_dataframe)
     
-    # Convert columns from R POSIXct to python UTCDateTime
-    df.starttime = df.starttime.apply(UTCDateTime)
-    df.endtime = df.endtime.apply(UTCDateTime)
+    # Convert columns from R POSIXct to python datetime64
+    df.starttime = irisseismic.POSIXct_to_datetime64(df.starttime).values
+    df.endtime = irisseismic.POSIXct_to_datetime64(df.endtime).values
     return df
 
 
@@ -91,9 +157,9 @@ def apply_correlation_metric(r_stream1, r_stream2, metric_function_name, *args,
     r_dataframe = _R_metricList2DF(r_metriclist)
     df = pandas2ri.ri2py_dataframe(r_dataframe)
     
-    # Convert columns from R POSIXct to pyton UTCDateTime
-    df.starttime = df.starttime.apply(UTCDateTime)
-    df.endtime = df.endtime.apply(UTCDateTime)
+    # Convert columns from R POSIXct to python datetime64
+    df.starttime = irisseismic.POSIXct_to_datetime64(df.starttime).values
+    df.endtime = irisseismic.POSIXct_to_datetime64(df.endtime).values
     return df
 
 
@@ -126,9 +192,9 @@ def apply_transferFunction_metric(r_stream1, r_stream2, evalresp1, evalresp2):
     df = pandas2ri.ri2py_dataframe(r_dataframe)
     pandas2ri.deactivate()
     
-    # Convert columns from R POSIXct to pyton UTCDateTime
-    df.starttime = df.starttime.apply(UTCDateTime)
-    df.endtime = df.endtime.apply(UTCDateTime)
+    # Convert columns from R POSIXct to python datetime64
+    df.starttime = irisseismic.POSIXct_to_datetime64(df.starttime).values
+    df.endtime = irisseismic.POSIXct_to_datetime64(df.endtime).values
     return df
 
 #     Functions for PSDMetrics     ---------------------------------------------
@@ -161,9 +227,9 @@ def apply_PSD_metric(r_stream, *args, **kwargs):
     if r_metriclist:
         r_dataframe = _R_metricList2DF(r_metriclist)
         df = pandas2ri.ri2py(r_dataframe)
-        # Convert columns from R POSIXct to python UTCDateTime
-        df.starttime = df.starttime.apply(UTCDateTime)
-        df.endtime = df.endtime.apply(UTCDateTime)
+        # Convert columns from R POSIXct to python datetime64
+        df.starttime = irisseismic.POSIXct_to_datetime64(df.starttime).values
+        df.endtime = irisseismic.POSIXct_to_datetime64(df.endtime).values
 
     # PSDMetric returns no PSD derived metrics 
     else:    
@@ -173,9 +239,9 @@ def apply_PSD_metric(r_stream, *args, **kwargs):
     r_correctedPSD = r_listOfLists[2]
     PSDCorrected = pandas2ri.ri2py(r_correctedPSD)
     
-    # Convert columns from R POSIXct to python UTCDateTime
-    PSDCorrected.starttime = PSDCorrected.starttime.apply(UTCDateTime)
-    PSDCorrected.endtime = PSDCorrected.endtime.apply(UTCDateTime)
+    # Convert columns from R POSIXct to python datetime64
+    PSDCorrected.starttime = irisseismic.POSIXct_to_datetime64(PSDCorrected.starttime).values
+    PSDCorrected.endtime = irisseismic.POSIXct_to_datetime64(PSDCorrected.endtime).values
 
     r_PDF = r_listOfLists[3]
     PDF = pandas2ri.ri2py(r_PDF)
@@ -12,17 +12,16 @@ from __future__ import (absolute_import, division, print_function)
 from future.types import newint
 import pandas as pd
 from obspy import UTCDateTime
-from rpy2 import robjects
-from rpy2 import rinterface
-from rpy2.robjects import pandas2ri
+from .rsession import robjects, rinterface, pandas2ri, RFunction
+from . import rsession
 import numpy as np
 
 #     R Initialization     -----------------------------------------------------
 
-# Global R options are set here
+# Global R options are set here and evaluated when R is first started
 
 # Do not show error messages generated inside of the R packages
-robjects.r('options(show.error.messages=FALSE)')
+rsession.on_initialize('options(show.error.messages=FALSE)')
 
 
 #     R functions called internally     ----------------------------------------
@@ -31,33 +30,73 @@ robjects.r('options(show.error.messages=FALSE)')
 # NOTE:  R-compatible objects as arguments.
 
 # from base
-_R_assign = robjects.r('base::assign')                                # assign a name to an object
-_R_get = robjects.r('base::get')                                      # get an object from a name
-_R_as_integer = robjects.r('base::as.integer')                        # conversion of python integers to R integer vectors
-_R_as_POSIXct = robjects.r('base::as.POSIXct')                        # conversion of ISO datestrings to R POSIXct
-_R_vector = robjects.r('base::vector')                                # creation of a the list of Traces used in R_Trace
-_R_list = robjects.r('base::list')                                    # creation of the headerList used in R_Trace
+_R_assign = RFunction('base::assign')                                # assign a name to an object
+_R_get = RFunction('base::get')                                      # get an object from a name
+_R_as_integer = RFunction('base::as.integer')                        # conversion of python integers to R integer vectors
+_R_as_POSIXct = RFunction('base::as.POSIXct')                        # conversion of ISO datestrings to R POSIXct
+_R_vector = RFunction('base::vector')                                # creation of a the list of Traces used in R_Trace
+_R_list = RFunction('base::list')                                    # creation of the headerList used in R_Trace
+_R_new_env = RFunction('base::new.env')                              # creation of scoped environments
+_R_eval = RFunction('base::eval')                                    # evaluation of parsed commands in an environment
+_R_parse = RFunction('base::parse')                                  # parsing of command strings
+_R_gc = RFunction('base::gc')                                        # garbage collection
 
 # from IRISSeismic
-_R_initialize = robjects.r('IRISSeismic::initialize')                 # initialization of various objects
-_R_slice = robjects.r('IRISSeismic::slice')
+_R_initialize = RFunction('IRISSeismic::initialize')                 # initialization of various objects
+_R_slice = RFunction('IRISSeismic::slice')
 
 # All webservice functions from IRISSeismic
-_R_getAvailability = robjects.r('IRISSeismic::getAvailability')       #
-_R_getChannel = robjects.r('IRISSeismic::getChannel')                 #
-_R_getDataselect = robjects.r('IRISSeismic::getDataselect')           #
-_R_getDistaz = robjects.r('IRISSeismic::getDistaz')                   #
-_R_getEvalresp = robjects.r('IRISSeismic::getEvalresp')               #
-_R_getEvent = robjects.r('IRISSeismic::getEvent')                     #
-_R_getNetwork = robjects.r('IRISSeismic::getNetwork')                 #
-_R_getRotation = robjects.r('IRISSeismic::getRotation')               # TODO:  This returns 3 Streams
-_R_getSNCL = robjects.r('IRISSeismic::getSNCL')                       #
-_R_getStation = robjects.r('IRISSeismic::getStation')                 #
-_R_getTraveltime = robjects.r('IRISSeismic::getTraveltime')           #
-_R_getUnavailability = robjects.r('IRISSeismic::getUnavailability')   #
+_R_getAvailability = RFunction('IRISSeismic::getAvailability')       #
+_R_getChannel = RFunction('IRISSeismic::getChannel')                 #
+_R_getDataselect = RFunction('IRISSeismic::getDataselect')           #
+_R_getDistaz = RFunction('IRISSeismic::getDistaz')                   #
+_R_getEvalresp = RFunction('IRISSeismic::getEvalresp')               #
+_R_getEvent = RFunction('IRISSeismic::getEvent')                     #
+_R_getNetwork = RFunction('IRISSeismic::getNetwork')                 #
+_R_getRotation = RFunction('IRISSeismic::getRotation')               # TODO:  This returns 3 Streams
+_R_getSNCL = RFunction('IRISSeismic::getSNCL')                       #
+_R_getStation = RFunction('IRISSeismic::getStation')                 #
+_R_getTraveltime = RFunction('IRISSeismic::getTraveltime')           #
+_R_getUnavailability = RFunction('IRISSeismic::getUnavailability')   #
 
 # IRISMustangMetrics helper functions
-_R_metricList2DF = robjects.r('IRISMustangMetrics::metricList2DF')
+_R_metricList2DF = RFunction('IRISMustangMetrics::metricList2DF')
+
+#     R memory management     --------------------------------------------------
+
+
+def R_environment():
+    """
+    Create a new R environment.
+
+    Objects assigned in the returned environment, rather than in the R global
+    environment, become garbage as soon as the environment is no longer
+    referenced from python.
+    :return: R environment.
+    """
+    return _R_new_env()
+
+
+def R_eval(cmd, envir):
+    """
+    Evaluate an R command string in the given environment.
+    :param cmd: R command (string).
+    :param envir: R environment created with R_environment().
+    :return: Result of the R command.
+    """
+    return _R_eval(_R_parse(text=cmd), envir=envir)
+
+
+def R_gc():
+    """
+    Run R garbage collection.
+    :return: Memory in use by R after garbage collection, in Mb.
+    """
+    r_matrix = _R_gc()
+    # NOTE:  gc() returns a matrix with rows "Ncells" and "Vcells" stored by
+    # NOTE:  column. The second column has the Mb in use for each.
+    return r_matrix[2] + r_matrix[3]
+
 
 #     Python --> R conversion functions    -------------------------------------
 
@@ -200,6 +239,37 @@ def R_list(n):
     return _R_vector("list",n)
 
 
+#     R --> Python conversion functions    -------------------------------------
+
+
+def POSIXct_to_datetime64(x):
+    """
+    Converts a column of R POSIXct values to a `numpy.datetime64[ns]` Series.
+    :param x: pandas Series or array of R POSIXct values as returned by `pandas2ri.ri2py`.
+    :return: pandas Series of dtype `datetime64[ns]`.
+
+    .. note::
+
+    R POSIXct values arrive as float seconds since 1970-01-01 UTC. They are
+    converted in a single vectorized step and rounded to the microsecond, which
+    is the precision the previous element-wise `UTCDateTime` conversion kept.
+    Columns that are already `datetime64` are returned as tz-naive UTC.
+
+    .. rubric:: Example
+
+    >>> POSIXct_to_datetime64(pd.Series([1289567655.0, np.nan]))
+    0   2010-11-12 13:14:15
+    1                   NaT
+    dtype: datetime64[ns]
+    """
+    x = pd.Series(x)
+    if x.dtype.kind == 'M':
+        if getattr(x.dt, 'tz', None) is not None:
+            x = x.dt.tz_convert('UTC').dt.tz_localize(None)
+        return x
+    return pd.to_datetime(x.astype('float64'), unit='s').dt.round('us')
+
+
 def R_TraceHeader(stats, latitude, longitude, elevation, depth, azimuth, dip):
     """
     Create an IRISSeismic TraceHeader from and ObsPy Stats object
@@ -265,6 +335,7 @@ def R_Stream(stream,
              act_flags=[0,0,0,0,0,0,0,0],
              io_flags=[0,0,0,0,0,0,0,0],
              dq_flags=[0,0,0,0,0,0,0,0],
+             timing_qual=None,
              sensor="",
              scale=1.0,
              scalefreq=1.0,
@@ -280,6 +351,10 @@ def R_Stream(stream,
     :param stream: ObsPy Stream object.
     :param requestedStarttime: ObsPy UTCDateTime object.
     :param requestedEndtime: ObsPy UTCDateTime object.
+    :param act_flags: Number of records with each activity flag set.
+    :param io_flags: Number of records with each I/O and clock flag set.
+    :param dq_flags: Number of records with each data quality flag set.
+    :param timing_qual: Mean timing quality or `None` when it is unknown.
     :return: IRISSeismic Stream object.
     """
     
@@ -300,13 +375,16 @@ def R_Stream(stream,
         r_listOfTraces[i] = R_Trace(stream.traces[i], sensor, scale, scalefreq, scaleunits, latitude, longitude, elevation, depth, azimuth, dip)
     # Create R Stream object
     r_stream = robjects.r('new("Stream")')
-    r_stream = _R_initialize(r_stream,
-                             requestedStarttime=R_POSIXct(requestedStarttime),
-                             requestedEndtime=R_POSIXct(requestedEndtime),
-                             act_flags=R_integer(act_flags),
-                             io_flags=R_integer(io_flags),
-                             dq_flags=R_integer(dq_flags),
-                             traces=r_listOfTraces)
+    slots = {'requestedStarttime': R_POSIXct(requestedStarttime),
+             'requestedEndtime': R_POSIXct(requestedEndtime),
+             'act_flags': R_integer(act_flags),
+             'io_flags': R_integer(io_flags),
+             'dq_flags': R_integer(dq_flags),
+             'traces': r_listOfTraces}
+    # NOTE:  The Stream prototype has an NA timing_qual
+    if timing_qual is not None:
+        slots['timing_qual'] = R_float(timing_qual)
+    r_stream = _R_initialize(r_stream, **slots)
     return(r_stream) 
 
 
@@ -811,7 +889,7 @@ def butter(x, y):
     
     return(r_filter)
 
-# trim_taper_filter is needed in orientationCheck_metrics.py
+# trim_taper_filter is the R reference for numpymetrics.orientationPreprocess in scripts/test_orientation_scan.py
 def trim_taper_filter(stN, stE, stZ, max_length, taper, filterArgs):
     """
     This function captures some of the functionality from generateMetrics_orientationCheck.R
@@ -820,40 +898,45 @@ def trim_taper_filter(stN, stE, stZ, max_length, taper, filterArgs):
     business logic python code.
     """
     
+    # NOTE:  Names are assigned in a new environment rather than the R global
+    # NOTE:  environment so that everything created here can be garbage
+    # NOTE:  collected once this function returns.
+    env = R_environment()
+
     # Assign names in R
-    _R_assign('stN',stN)
-    _R_assign('stE',stE)
-    _R_assign('stZ',stZ)
+    _R_assign('stN', stN, envir=env)
+    _R_assign('stE', stE, envir=env)
+    _R_assign('stZ', stZ, envir=env)
     
     # Adjust length
-    robjects.r('stN@traces[[1]]@data <- stN@traces[[1]]@data[1:%d]' % (max_length))
-    robjects.r('stE@traces[[1]]@data <- stE@traces[[1]]@data[1:%d]' % (max_length))
-    robjects.r('stZ@traces[[1]]@data <- stZ@traces[[1]]@data[1:%d]' % (max_length))
-    robjects.r('stN@traces[[1]]@stats@npts = as.integer(%d)' % (max_length))
-    robjects.r('stE@traces[[1]]@stats@npts = as.integer(%d)' % (max_length))
-    robjects.r('stZ@traces[[1]]@stats@npts = as.integer(%d)' % (max_length))
+    R_eval('stN@traces[[1]]@data <- stN@traces[[1]]@data[1:%d]' % (max_length), env)
+    R_eval('stE@traces[[1]]@data <- stE@traces[[1]]@data[1:%d]' % (max_length), env)
+    R_eval('stZ@traces[[1]]@data <- stZ@traces[[1]]@data[1:%d]' % (max_length), env)
+    R_eval('stN@traces[[1]]@stats@npts = as.integer(%d)' % (max_length), env)
+    R_eval('stE@traces[[1]]@stats@npts = as.integer(%d)' % (max_length), env)
+    R_eval('stZ@traces[[1]]@stats@npts = as.integer(%d)' % (max_length), env)
     
     # taper and filter traces
-    robjects.r('N <- IRISSeismic::DDT(stN@traces[[1]],TRUE,TRUE,%s)' % (taper))
-    robjects.r('E <- IRISSeismic::DDT(stE@traces[[1]],TRUE,TRUE,%s)' % (taper))
-    robjects.r('Z <- IRISSeismic::DDT(stZ@traces[[1]],TRUE,TRUE,%s)' % (taper))
+    R_eval('N <- IRISSeismic::DDT(stN@traces[[1]],TRUE,TRUE,%s)' % (taper), env)
+    R_eval('E <- IRISSeismic::DDT(stE@traces[[1]],TRUE,TRUE,%s)' % (taper), env)
+    R_eval('Z <- IRISSeismic::DDT(stZ@traces[[1]],TRUE,TRUE,%s)' % (taper), env)
 
-    robjects.r('N <- IRISSeismic::butterworth(N,%s,%s,%s)' % (filterArgs[0],filterArgs[1],filterArgs[2]))
-    robjects.r('E <- IRISSeismic::butterworth(E,%s,%s,%s)' % (filterArgs[0],filterArgs[1],filterArgs[2]))
-    robjects.r('Z <- IRISSeismic::butterworth(Z,%s,%s,%s)' % (filterArgs[0],filterArgs[1],filterArgs[2]))
+    R_eval('N <- IRISSeismic::butterworth(N,%s,%s,%s)' % (filterArgs[0],filterArgs[1],filterArgs[2]), env)
+    R_eval('E <- IRISSeismic::butterworth(E,%s,%s,%s)' % (filterArgs[0],filterArgs[1],filterArgs[2]), env)
+    R_eval('Z <- IRISSeismic::butterworth(Z,%s,%s,%s)' % (filterArgs[0],filterArgs[1],filterArgs[2]), env)
 
     # Now put modified traces back into the Streams so that they can be rotated
-    robjects.r('stN@traces[[1]] <- N')
-    robjects.r('stE@traces[[1]] <- E')
-    robjects.r('stZ@traces[[1]] <- Z')
+    R_eval('stN@traces[[1]] <- N', env)
+    R_eval('stE@traces[[1]] <- E', env)
+    R_eval('stZ@traces[[1]] <- Z', env)
 
     # Hilbert tansform of Z channel
-    HZ = robjects.r('IRISSeismic::hilbert(Z)')
+    HZ = R_eval('IRISSeismic::hilbert(Z)', env)
 
     # Get R objects back into python memory space
-    stN = _R_get('stN')
-    stE = _R_get('stE')
-    stZ = _R_get('stZ')
+    stN = _R_get('stN', envir=env)
+    stE = _R_get('stE', envir=env)
+    stZ = _R_get('stZ', envir=env)
     
     return(stN, stE, stZ, HZ)
 
@@ -887,6 +970,10 @@ def generalValueMetric(snclq, starttime, endtime, metricName, elementNames, elem
     r_dataframe = _R_metricList2DF(r_metricList)
     df = pandas2ri.ri2py(r_dataframe)
 
+    # Convert columns from R POSIXct to python datetime64
+    df.starttime = POSIXct_to_datetime64(df.starttime).values
+    df.endtime = POSIXct_to_datetime64(df.endtime).values
+
     return(df) 
 
 # ------------------------------------------------------------------------------
@@ -29,6 +29,136 @@ def currentispaq():
               'transferFunction': ['transferFunction'] }
     return groups
 
+def run_business_logic(concierge, logic_type, function, file_suffix, label):
+    """
+    Calculate the metrics of one business logic group and write them to a .csv file.
+    :param concierge: Data access expediter.
+    :param logic_type: Business logic name, e.g. 'simple'.
+    :param function: Business logic function returning a dataframe of metrics.
+    :param file_suffix: Appended to the output file base to name the .csv file.
+    :param label: Name of the metrics in log messages.
+    """
+    from .concierge import NoAvailableDataError
+
+    logger = concierge.logger
+    logger.debug('Inside %s business logic ...' % logic_type)
+    try:
+        df = function(concierge)
+    except NoAvailableDataError as e:
+        logger.info("No data available for '%s' metrics" % logic_type)
+        return
+    except Exception as e:
+        logger.debug(e)
+        logger.error("Error calculating '%s' metrics" % logic_type)
+        return
+    write_business_logic(concierge, logic_type, df, file_suffix, label)
+
+
+def write_business_logic(concierge, logic_type, df, file_suffix, label):
+    """
+    Write the metrics of one business logic group to a .csv file.
+    :param concierge: Data access expediter.
+    :param logic_type: Business logic name, e.g. 'simple'.
+    :param df: Dataframe of metrics or None.
+    :param file_suffix: Appended to the output file base to name the .csv file.
+    :param label: Name of the metrics in log messages.
+    """
+    from . import utils
+
+    logger = concierge.logger
+    if df is None:
+        logger.info('No %s metrics were calculated' % logic_type)
+    elif logic_type == 'PSD' and df.metricName[0] == 'PSDPlot':
+        pass
+    else:
+        try:
+            filepath = concierge.output_file_base + file_suffix
+            logger.info('Writing %s metrics to %s' % (label, os.path.basename(filepath)))
+            utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
+        except Exception as e:
+            logger.debug(e)
+            logger.error("Error writing '%s' metric results" % logic_type)
+
+
+def run_pass(concierge, groups):
+    """
+    Calculate the metrics of several day or event based business logic groups
+    in a single pass and write each group to its .csv file.
+
+    Every group yields the window it works on next. Groups waiting at the
+    earliest window are advanced through it together so that each SNCL is
+    read, and converted into an R Stream, only once per window. Waveforms
+    are shared through the concierge waveform cache, which is emptied after
+    each window.
+    :param concierge: Data access expediter.
+    :param groups: List of (logic_type, generator_function, file_suffix, label)
+        tuples where generator_function is e.g.
+        :func:`~ispaq.simple_metrics.simple_metrics_days` or
+        :func:`~ispaq.SNR_metrics.SNR_metrics_events`.
+    """
+    from .concierge import NoAvailableDataError
+
+    logger = concierge.logger
+    logger.debug('Inside %s business logic in a single pass ...' % ', '.join(group[0] for group in groups))
+
+    def advance(group, business_logic):
+        """
+        Return the next window of a group or write its metrics and return None.
+        """
+        (logic_type, function, file_suffix, label) = group
+        try:
+            item = next(business_logic, None)
+        except NoAvailableDataError as e:
+            logger.info("No data available for '%s' metrics" % logic_type)
+            return None
+        except Exception as e:
+            logger.debug(e)
+            logger.error("Error calculating '%s' metrics" % logic_type)
+            return None
+        # Groups yield their next window until they yield their metrics
+        if isinstance(item, tuple):
+            return item
+        write_business_logic(concierge, logic_type, item, file_suffix, label)
+        return None
+
+    concierge.waveform_cache = {}
+    try:
+        # List of [group, generator, next window]
+        running = []
+        for group in groups:
+            business_logic = group[1](concierge)
+            running.append([group, business_logic, advance(group, business_logic)])
+
+        while True:
+            running = [entry for entry in running if entry[2] is not None]
+            if len(running) == 0:
+                break
+
+            # NOTE:  Days are the same for every group but each event group has its own
+            # NOTE:  catalog, so only groups at the earliest event are advanced together
+            window = min(entry[2] for entry in running)
+            for entry in running:
+                if entry[2] == window:
+                    entry[2] = advance(entry[0], entry[1])
+
+            # Every group has moved past the window these waveforms were read for
+            concierge.waveform_cache.clear()
+    finally:
+        concierge.waveform_cache = None
+
+
+def _run_group(concierge, workers, run, args):
+    """
+    Run business logic in a forked process with its own executor.
+    """
+    # Days and events in flight and the executor both use this group's share of the workers
+    concierge.workers = workers
+    try:
+        run(concierge, *args)
+    finally:
+        concierge.close_executor()
+
+
 def main():
     
     # Check our Conda environment ----------------------------------------------
@@ -73,6 +203,10 @@ def main():
                         help='format of SNCL aliases and miniSEED file names, overrides preference file\nexamples:"N.S.L.C","S.N.L.C"\nwhere N=network code, S=station code, L=location code, C=channel code')
     metrics.add_argument('--sigfigs', required=False,
                         help='number of significant figures used for output columns named "value",\noverrides preference file')
+    metrics.add_argument('--engine', required=False, choices=['numpy','r','auto'],
+                        help='metric engine, overrides preference file\nnumpy: NumPy where available, r: R only,\nauto: NumPy for numpy_functions in preference file, default="auto"')
+    metrics.add_argument('--workers', required=False, type=int,
+                        help='number of worker processes calculating metrics for different SNCLs,\noverrides preference file, default=1')
     metrics.add_argument('--log-level', action='store', default='INFO',
                         choices=['DEBUG','INFO','WARNING','ERROR','CRITICAL'],
                         help='log level printed to console, default="INFO"')
@@ -147,6 +281,12 @@ def main():
         df = updater.get_IRIS_package_versions(logger)
         print('\n%s\n' % df)
         updater.update_IRIS_packages(logger)
+        # Rebuild the cached metric function metadata for the installed packages
+        from . import irismustangmetrics
+        try:
+            irismustangmetrics.function_metadata(refresh=True)
+        except Exception as e:
+            logger.warning('Unable to refresh IRISMustangMetrics function metadata: %s' % e)
         sys.exit(0)
 
     if args.list_metrics:
@@ -184,15 +324,16 @@ def main():
     from . import irisseismic
     from . import irismustangmetrics
     from . import utils
+    from . import executor
     
     # Specific ISPAQ business logic
-    from .simple_metrics import simple_metrics
-    from .SNR_metrics import SNR_metrics
-    from .PSD_metrics import PSD_metrics
-    from .crossTalk_metrics import crossTalk_metrics
-    from .pressureCorrelation_metrics import pressureCorrelation_metrics
-    from .crossCorrelation_metrics import crossCorrelation_metrics
-    from .orientationCheck_metrics import orientationCheck_metrics
+    from .simple_metrics import simple_metrics, simple_metrics_days
+    from .SNR_metrics import SNR_metrics, SNR_metrics_events
+    from .PSD_metrics import PSD_metrics, PSD_metrics_days
+    from .crossTalk_metrics import crossTalk_metrics, crossTalk_metrics_events
+    from .pressureCorrelation_metrics import pressureCorrelation_metrics, pressureCorrelation_metrics_days
+    from .crossCorrelation_metrics import crossCorrelation_metrics, crossCorrelation_metrics_events
+    from .orientationCheck_metrics import orientationCheck_metrics, orientationCheck_metrics_events
     from .transferFunction_metrics import transferFunction_metrics
 
 
@@ -227,192 +368,68 @@ def main():
         logger.critical("Failed to create Concierge object")
         raise SystemExit
 
-    # Generate Simple Metrics --------------------------------------------------
-
-    if 'simple' in concierge.logic_types:
-        logger.debug('Inside simple business logic ...')
-        try:
-            df = simple_metrics(concierge)
-            if df is None:
-                logger.info('No simple metrics were calculated')
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_simpleMetrics.csv"
-                    logger.info('Writing simple metrics to %s' % os.path.basename(filepath))
-                    utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'simple' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'simple' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'simple' metrics")
-
-
-    # Generate SNR Metrics -----------------------------------------------------
-
-    if 'SNR' in concierge.logic_types:
-        logger.debug('Inside SNR business logic ...')
-        try:
-            df = SNR_metrics(concierge)
-            if df is None:
-                logger.info('No SNR metrics were calculated')
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_SNRMetrics.csv"
-                    logger.info('Writing SNR metrics to %s' % os.path.basename(filepath))
-                    utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'SNR' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'SNR' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'SNR' metrics")
-
-
-    # Generate PSD Metrics -----------------------------------------------------
-
-    if 'PSD' in concierge.logic_types:
-        logger.debug('Inside PSD business logic ...')
-        try:
-            df = PSD_metrics(concierge)
-            if df is None:
-                logger.info('No PSD metrics were calculated')
-            elif df.metricName[0] == 'PSDPlot':
-                pass
-            else:
-                try:
-                    # Write out the metrics
-                    filepath = concierge.output_file_base + "_PSDMetrics.csv"
-                    logger.info('Writing PSD metrics to %s' % os.path.basename(filepath))
-                    utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'PSD' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'PSD' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'PSD' metrics")
-
-
-    # Generate Cross Talk Metrics ----------------------------------------------
-
-    if 'crossTalk' in concierge.logic_types:
-        logger.debug('Inside crossTalk business logic ...')
-        try:
-            df = crossTalk_metrics(concierge)
-            if df is None:
-                logger.info('No crossTalk metrics were calculated')
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_crossTalkMetrics.csv"
-                    logger.info('Writing crossTalk metrics to %s' % os.path.basename(filepath))
-                    utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'crossTalk' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'crossTalk' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'crossTalk' metrics")
-        
-
-    # Generate Pressure Correlation Metrics ----------------------------------------------
-
-    if 'pressureCorrelation' in concierge.logic_types:
-        logger.debug('Inside pressureCorrelation business logic ...')
-        try:
-            df = pressureCorrelation_metrics(concierge)
-            if df is None:
-                logger.info('No pressureCorrelation metrics were calculated')
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_pressureCorrelationMetrics.csv"
-                    logger.info('Writing pressureCorrelation metrics to %s' % os.path.basename(filepath))
-                    utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'pressureCorrelation' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'pressureCorrelation' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'pressureCorrelation' metrics")
-        
-
-    # Generate Cross Correlation Metrics ---------------------------------------
-
-    if 'crossCorrelation' in concierge.logic_types:
-        logger.debug('Inside crossCorrelation business logic ...')
-        try:
-            df = crossCorrelation_metrics(concierge)
-            if df is None:
-                logger.info('No crossCorrelation metrics were calculated')
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_crossCorrelationMetrics.csv"
-                    logger.info('Writing crossCorrelation metrics to %s' % os.path.basename(filepath))
-                    utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'crossCorrelation' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'crossCorrelation' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'crossCorrelation' metrics")
-                
-
-    # Generate Orientation Check Metrics ---------------------------------------
-
-    if 'orientationCheck' in concierge.logic_types:
-        logger.debug('Inside orientationCheck business logic ...')
-        try:
-            df = orientationCheck_metrics(concierge)
-            if df is None:
-                logger.info('No orientationCheck metrics were calculated')
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_orientationCheckMetrics.csv"
-                    logger.info('Writing orientationCheck metrics to %s' % os.path.basename(filepath))
-                    utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'orientationCheck' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'orientationCheck' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'orientationCheck' metrics")
-                        
-                        
-    # Generate Transfer Function Metrics ---------------------------------------
-
-    if 'transferFunction' in concierge.logic_types:
-        logger.debug('Inside transferFunction business logic ...')
-        try:
-            df = transferFunction_metrics(concierge)
-            if df is None:
-                logger.info('No transferFunction metrics were calculated')
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_transferMetrics.csv"
-                    logger.info('Writing transfer metrics to %s' % os.path.basename(filepath))
-                    utils.write_simple_df(df, filepath, sigfigs=concierge.sigfigs)
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'transferFunction' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'transferFunction' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'transferFunction' metrics")
-
+    # Generate metrics ---------------------------------------------------------
+    #
+    # Business logic groups are independent of each other. With more than one
+    # worker, groups run concurrently in forked processes that share the
+    # workers and each group writes its .csv file as soon as it finishes.
+    #
+    # Day based groups requested together run in a single pass over the days,
+    # and event based groups in a single pass over the events, so that they
+    # share waveforms, event catalogs and event-station geometry.
+
+    business_logic = [('simple', simple_metrics, '_simpleMetrics.csv', 'simple'),
+                      ('SNR', SNR_metrics, '_SNRMetrics.csv', 'SNR'),
+                      ('PSD', PSD_metrics, '_PSDMetrics.csv', 'PSD'),
+                      ('crossTalk', crossTalk_metrics, '_crossTalkMetrics.csv', 'crossTalk'),
+                      ('pressureCorrelation', pressureCorrelation_metrics, '_pressureCorrelationMetrics.csv', 'pressureCorrelation'),
+                      ('crossCorrelation', crossCorrelation_metrics, '_crossCorrelationMetrics.csv', 'crossCorrelation'),
+                      ('orientationCheck', orientationCheck_metrics, '_orientationCheckMetrics.csv', 'orientationCheck'),
+                      ('transferFunction', transferFunction_metrics, '_transferMetrics.csv', 'transfer')]
+
+    day_passes = {'simple': simple_metrics_days,
+                  'PSD': PSD_metrics_days,
+                  'pressureCorrelation': pressureCorrelation_metrics_days}
+
+    event_passes = {'SNR': SNR_metrics_events,
+                    'crossTalk': crossTalk_metrics_events,
+                    'crossCorrelation': crossCorrelation_metrics_events,
+                    'orientationCheck': orientationCheck_metrics_events}
+
+    groups = [group for group in business_logic if group[0] in concierge.logic_types]
+    pass_groups = []
+    for passes in (day_passes, event_passes):
+        pass_groups.append([(logic_type, passes[logic_type], file_suffix, label)
+                            for (logic_type, function, file_suffix, label) in groups if logic_type in passes])
+
+    # List of (name, run, args) where run(concierge, *args) calculates and writes metrics
+    units = []
+    for group in groups:
+        fused = [fused for fused in pass_groups if len(fused) > 1 and group[0] in [g[0] for g in fused]]
+        if len(fused) == 0:
+            units.append((group[0], run_business_logic, group))
+        elif group[0] == fused[0][0][0]:
+            units.append((', '.join(g[0] for g in fused[0]), run_pass, (fused[0],)))
+
+    concurrent_units = min(len(units), concierge.workers)
+
+    if concurrent_units <= 1:
+        for (name, run, args) in units:
+            run(concierge, *args)
+    else:
+        # Each group process starts its own executor with a share of the workers
+        concierge.close_executor()
+        group_workers = max(1, concierge.workers // concurrent_units)
+        logger.info('Running %d metric groups, %d at a time with %d workers each' % (len(units), concurrent_units, group_workers))
+        tasks = [(name, _run_group, (concierge, group_workers, run, args)) for (name, run, args) in units]
+        exitcodes = executor.run_tasks(tasks, concurrent_units, logger=logger)
+        for (name, run, args) in units:
+            if exitcodes[name] != 0:
+                logger.error("Error calculating '%s' metrics, process exited with code %s" % (name, exitcodes[name]))
+
+
+    # Shut down any worker processes
+    concierge.close_executor()
 
     logger.info('ALL FINISHED!')
 
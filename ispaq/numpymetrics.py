@@ -0,0 +1,1886 @@
+# -*- coding: utf-8 -*-
+"""
+Python module containing NumPy implementations of IRISMustangMetrics metrics.
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+
+Functions in this module work directly on the decoded ObsPy data carried by a
+:class:`~ispaq.concierge.Waveform` and never start R. They reproduce the
+results of the corresponding IRISMustangMetrics functions, including the way
+multi-trace Streams are combined, and return dataframes with the same columns
+as :func:`~ispaq.irismustangmetrics.apply_simple_metric`.
+
+Business logic chooses between the R and NumPy versions of each metric
+function with the ``numpy_functions`` preference.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+
+import math
+import re
+import numpy as np
+import pandas as pd
+
+# Optional just-in-time compiler for rolling window kernels
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+#     Helper functions     ----------------------------------------------------
+
+def R_format(x, digits=7, nsmall=0):
+    """
+    Round a value the way IRISMustangMetrics does when it stores a metric.
+
+    GeneralValueMetric objects store values as ``format(x, digits=7)`` which
+    keeps 7 significant digits but never drops integer digits.
+    :param x: Value to round.
+    :param digits: Minimum number of significant digits.
+    :param nsmall: Minimum number of digits after the decimal point.
+    :return: Rounded float or `NaN` for missing values.
+
+    .. rubric:: Example
+
+    >>> R_format(1234.56789)
+    1234.568
+    >>> R_format(123456789.4)
+    123456789.0
+    >>> R_format(12345.6789, nsmall=3)
+    12345.679
+    """
+    if x is None or not np.isfinite(x):
+        return np.nan
+    if x == 0:
+        return 0.0
+    int_digits = int(math.floor(math.log10(abs(x)))) + 1
+    # R switches to scientific notation, and significant digits, for very large numbers
+    if int_digits > 15:
+        return float('%.*g' % (digits, x))
+    decimals = max(digits - int_digits, nsmall, 0)
+    return float('%.*f' % (decimals, x))
+
+
+def R_format_values(values, digits=7):
+    """
+    Round the values of a metric the way ``format(values, digits=7)`` does
+    when GeneralValueMetric stores several numeric elements together. Every
+    value keeps the number of decimals needed by the most precise one.
+    :param values: List of values.
+    :return: List of rounded floats, `NaN` for missing values.
+
+    .. rubric:: Example
+
+    >>> R_format_values([1.5, 0.123456789])
+    [1.5, 0.1234568]
+    """
+    decimals = 0
+    for x in values:
+        if x is None or not np.isfinite(x) or x == 0:
+            continue
+        int_digits = int(math.floor(math.log10(abs(x)))) + 1
+        if int_digits > 15:
+            continue
+        text = '%.*f' % (max(digits - int_digits, 0), x)
+        if '.' in text:
+            decimals = max(decimals, len(text.rstrip('0').split('.')[1]))
+    return [float('%.*f' % (decimals, x)) if x is not None and np.isfinite(x) else np.nan for x in values]
+
+
+def _datetime64(time):
+    """
+    Convert an ObsPy UTCDateTime to a `numpy.datetime64[ns]` value.
+    """
+    return np.datetime64(time.datetime, 'ns')
+
+
+def _snclq(py_stream, function_name):
+    """
+    Return the single N.S.L.C.Q identifier shared by all traces in a Stream.
+    """
+    unique_ids = sorted(set(['%s.%s' % (tr.id, tr.stats.mseed.dataquality) for tr in py_stream]))
+    if len(unique_ids) > 1:
+        raise Exception('%sMetric: Stream has %d unique identifiers' % (function_name, len(unique_ids)))
+    return unique_ids[0]
+
+
+def general_value_df(waveform, snclq, metrics, elementNames=('value',), starttime=None, endtime=None):
+    """
+    Create a dataframe matching the output of IRISMustangMetrics::metricList2DF
+    for a list of GeneralValueMetric objects.
+    :param waveform: :class:`~ispaq.concierge.Waveform` the metrics were calculated from.
+    :param snclq: N.S.L.C.Q identifier.
+    :param metrics: List of (metricName, value, ...) tuples with one value
+        for each of `elementNames`. Numeric values should already be rounded
+        by :func:`R_format`.
+    :param elementNames: Names of the value columns.
+    :param starttime: Metric starttime if not the waveform starttime.
+    :param endtime: Metric endtime if not the waveform endtime.
+    :return: pandas dataframe of metrics.
+    """
+    if starttime is None:
+        starttime = waveform.starttime
+    if endtime is None:
+        endtime = waveform.endtime
+    columns = {'metricName': [metric[0] for metric in metrics],
+               'snclq': snclq,
+               'starttime': _datetime64(starttime),
+               'endtime': _datetime64(endtime),
+               'qualityFlag': -9.0}
+    for (i, elementName) in enumerate(elementNames):
+        columns[elementName] = [metric[i + 1] for metric in metrics]
+    df = pd.DataFrame(columns, columns=['metricName', 'snclq', 'starttime', 'endtime', 'qualityFlag'] + list(elementNames))
+    return df
+
+
+def detrend(data):
+    """
+    Remove the least squares straight line from data as pracma::detrend does
+    with tt='linear'.
+    :param data: Array of data, or 2-D array with one series per row.
+    :return: Detrended float64 array.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[-1]
+    t = np.arange(n, dtype=np.float64) - (n - 1) / 2
+    residual = data - data.mean(axis=-1)[..., np.newaxis]
+    denominator = np.dot(t, t)
+    if denominator > 0:
+        residual -= t * (residual.dot(t) / denominator)[..., np.newaxis]
+    return residual
+
+
+def spec_taper(n, p=0.1):
+    """
+    Split cosine bell applied by stats::spec.taper to the first and last
+    proportion `p` of `n` samples.
+    :return: Array of n weights.
+    """
+    m = int(math.floor(n * p))
+    w = 0.5 * (1 - np.cos(np.pi * np.arange(1, 2 * m, 2) / (2 * m)))
+    return np.concatenate([w, np.ones(n - 2 * m), w[::-1]])
+
+
+#     Metric functions     ----------------------------------------------------
+
+def basicStatsMetric(waveform):
+    """
+    NumPy version of IRISMustangMetrics::basicStatsMetric.
+
+    Data from all traces are combined as R does by concatenating them. Minimum,
+    maximum, sum and sum of squares are accumulated in a single pass over each
+    trace and the median uses a selection algorithm rather than a full sort.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :return: pandas dataframe of sample_min, sample_median, sample_mean,
+        sample_max, sample_rms and sample_unique metrics.
+    """
+    snclq = _snclq(waveform.py_stream, 'basicStats')
+
+    arrays = []
+    for tr in waveform.py_stream:
+        data = tr.data
+        # Missing values are ignored as with na.rm=TRUE
+        if data.dtype.kind == 'f' and np.isnan(data).any():
+            data = data[~np.isnan(data)]
+        if data.size > 0:
+            arrays.append(data)
+
+    if len(arrays) == 0:
+        raise Exception('no data available')
+
+    # Accumulate relative to the first sample so that a large DC offset does
+    # not swamp the variance in the sum of squares
+    shift = float(arrays[0][0])
+    n = 0
+    total = 0.0
+    total_squares = 0.0
+    minimum = np.inf
+    maximum = -np.inf
+    for data in arrays:
+        shifted = data.astype(np.float64) - shift
+        n += shifted.size
+        total += shifted.sum()
+        total_squares += np.dot(shifted, shifted)
+        minimum = min(minimum, shifted.min())
+        maximum = max(maximum, shifted.max())
+
+    mean = shift + total / n
+    rms = math.sqrt(max(total_squares / n - (total / n)**2, 0.0))
+    minimum += shift
+    maximum += shift
+
+    # np.median partitions rather than sorts and may reuse this temporary copy
+    median = np.median(np.concatenate(arrays), overwrite_input=True)
+
+    unique = _count_unique(arrays, minimum, maximum, n)
+
+    metrics = [('sample_min', R_format(minimum)),
+               ('sample_median', R_format(median)),
+               ('sample_mean', R_format(mean)),
+               ('sample_max', R_format(maximum)),
+               ('sample_rms', R_format(rms)),
+               ('sample_unique', R_format(unique))]
+    return general_value_df(waveform, snclq, metrics)
+
+
+def _count_unique(arrays, minimum, maximum, n):
+    """
+    Count the unique values found in a list of arrays.
+
+    Integer data, which is what miniSEED usually decodes to, are counted with
+    a table of flags covering the data range. This is linear in the number of
+    samples and only falls back to sorting when the range is much larger than
+    the number of samples.
+    """
+    if all(data.dtype.kind in 'iu' for data in arrays):
+        value_range = int(maximum) - int(minimum) + 1
+        if value_range <= 4 * n + 65536:
+            seen = np.zeros(value_range, dtype=bool)
+            for data in arrays:
+                seen[data.astype(np.int64) - int(minimum)] = True
+            return int(np.count_nonzero(seen))
+    # Floating point data are compared as doubles, as in R
+    values = np.concatenate([data.astype(np.float64) for data in arrays])
+    return int(np.unique(values).size)
+
+
+def getGaps(headers, requested_starttime, requested_endtime, min_gap=None):
+    """
+    NumPy version of IRISSeismic::getGaps for a Stream.
+
+    The first gap is measured from the requested starttime, the last one to
+    the requested endtime and the others between consecutive traces. Gaps and
+    overlaps shorter than the tolerance used by IRISSeismic are set to zero.
+    :param headers: List of ObsPy trace Stats in Stream order.
+    :param requested_starttime: ObsPy UTCDateTime.
+    :param requested_endtime: ObsPy UTCDateTime.
+    :param min_gap: Minimum gap in seconds, at least one sample.
+    :return: Array of len(headers)+1 gaps in seconds, negative for overlaps.
+    """
+    sampling_rates = np.array([h.sampling_rate for h in headers], dtype=np.float64)
+    if np.any(sampling_rates < 0):
+        raise Exception('getGaps.Stream: encountered sampling rate < 0')
+    starts = np.array([h.starttime.timestamp for h in headers])
+    ends = np.array([h.endtime.timestamp for h in headers])
+
+    # Each gap uses the sampling rate of the trace that precedes it
+    rates = np.concatenate([sampling_rates[:1], sampling_rates])
+    if min_gap is None:
+        min_gaps = 1.0 / rates
+    else:
+        min_gaps = np.maximum(min_gap, 1.0 / rates)
+    thresholds = min_gaps - 0.5 / rates
+
+    # NOTE:  As in IRISSeismic, delta is the time between samples minus one
+    # NOTE:  sample, which is how many extra samples could fit in the gap
+    deltas = np.empty(len(headers) + 1)
+    deltas[0] = (starts[0] - requested_starttime.timestamp) - 1.0 / rates[0]
+    deltas[1:-1] = (starts[1:] - ends[:-1]) - 1.0 / rates[1:-1]
+    deltas[-1] = (requested_endtime.timestamp - ends[-1]) - 1.0 / rates[-1]
+
+    gaps = np.where(np.abs(deltas) > thresholds, deltas, 0.0)
+    # No overlap is possible before the first or after the last trace
+    gaps[0] = deltas[0] + 1.0 / rates[0] if deltas[0] > thresholds[0] else 0.0
+    gaps[-1] = deltas[-1] if deltas[-1] > thresholds[-1] else 0.0
+    return gaps
+
+
+def gapsMetric(waveform):
+    """
+    NumPy version of IRISMustangMetrics::gapsMetric.
+
+    Only trace start times, sample rates and sample counts are used so the
+    waveform may come from :meth:`~ispaq.concierge.Concierge.get_waveform`
+    with ``headonly=True``.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :return: pandas dataframe of num_gaps, max_gap, num_overlaps, max_overlap
+        and percent_availability metrics.
+    """
+    snclq = _snclq(waveform.py_stream, 'gaps')
+    headers = [tr.stats for tr in waveform.py_stream]
+    gaps = getGaps(headers, waveform.starttime, waveform.endtime)
+
+    num_gaps = 0
+    max_gap = 0
+    num_overlaps = 0
+    max_overlap = 0
+    gap_secs = 0.0
+    if gaps.sum() != 0:
+        positive = gaps[gaps > 0]
+        num_gaps = positive.size
+        if num_gaps > 0:
+            max_gap = positive.max()
+        gap_secs = positive.sum()
+        negative = gaps[gaps < 0]
+        num_overlaps = negative.size
+        if num_overlaps > 0:
+            max_overlap = abs(negative.min())
+
+    if num_gaps == 0:
+        percent_availability = 100
+    else:
+        total_secs = waveform.endtime - waveform.starttime
+        percent_availability = 100 - 100 * gap_secs / total_secs
+    percent_availability = min(max(percent_availability, 0), 100)
+
+    metrics = [('num_gaps', R_format(num_gaps)),
+               ('max_gap', R_format(max_gap, nsmall=3)),
+               ('num_overlaps', R_format(num_overlaps)),
+               ('max_overlap', R_format(max_overlap, digits=8)),
+               ('percent_availability', R_format(percent_availability))]
+    return general_value_df(waveform, snclq, metrics)
+
+
+def stateOfHealthMetric(waveform):
+    """
+    NumPy version of IRISMustangMetrics::stateOfHealthMetric.
+
+    Flag counts and timing quality are read from the miniSEED record headers
+    by :meth:`~ispaq.concierge.Concierge.get_waveform` and carried in the
+    waveform `trace_info` so the waveform may be read with ``headonly=True``.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :return: pandas dataframe of activity, I/O, data quality and timing
+        quality metrics.
+    """
+    snclq = _snclq(waveform.py_stream, 'stateOfHealth')
+    act_flags = waveform.trace_info.get('act_flags', [0] * 8)
+    io_flags = waveform.trace_info.get('io_flags', [0] * 8)
+    dq_flags = waveform.trace_info.get('dq_flags', [0] * 8)
+    timing_qual = waveform.trace_info.get('timing_qual')
+
+    metrics = [('calibration_signal', act_flags[0]),
+               ('timing_correction', act_flags[1]),
+               ('event_begin', act_flags[2]),
+               ('event_end', act_flags[3]),
+               ('event_in_progress', act_flags[6]),
+               ('clock_locked', io_flags[5]),
+               ('amplifier_saturation', dq_flags[0]),
+               ('digitizer_clipping', dq_flags[1]),
+               ('spikes', dq_flags[2]),
+               ('glitches', dq_flags[3]),
+               ('missing_padded_data', dq_flags[4]),
+               ('telemetry_sync_error', dq_flags[5]),
+               ('digital_filter_charging', dq_flags[6]),
+               ('suspect_time_tag', dq_flags[7]),
+               ('timing_quality', timing_qual)]
+    metrics = [(name, R_format(value)) for (name, value) in metrics]
+    return general_value_df(waveform, snclq, metrics)
+
+
+def _window_median(windows, n):
+    """
+    Median of each row of a 2-D array of `n` point windows, found by partial
+    sorting as the middle value or the mean of the two middle values.
+    """
+    if n % 2:
+        return np.partition(windows, n // 2, axis=1)[:, n // 2]
+    middle = np.partition(windows, [n // 2 - 1, n // 2], axis=1)
+    return (middle[:, n // 2 - 1] + middle[:, n // 2]) / 2
+
+
+def _roll_hampel_numpy(x, n, chunk_size=4096):
+    """
+    Rolling Hampel filter on strided windows of `chunk_size` windows at a time
+    so that extra memory does not grow with the length of `x`.
+    """
+    length = x.size
+    k = n // 2
+    out = np.empty(length)
+    out.fill(np.nan)
+
+    # NOTE:  Window i covers x[i:i+n] and is centered on x[i+k]
+    count = length - 2 * k
+    windows = np.lib.stride_tricks.as_strided(x, shape=(length - n + 1, n), strides=(x.strides[0], x.strides[0]))
+    for start in range(0, count, chunk_size):
+        stop = min(start + chunk_size, count)
+        x0 = _window_median(windows[start:stop], n)
+        mad = _window_median(np.abs(windows[start:stop] - x0[:, np.newaxis]), n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[start + k:stop + k] = np.abs(x[start + k:stop + k] - x0) / (1.4826 * mad)
+    return out
+
+
+if numba is not None:
+    @numba.njit(error_model='numpy')
+    def _roll_hampel_compiled(x, n):
+        """
+        Compiled version of :func:`_roll_hampel_numpy`, a direct port of the
+        seismicRoll C++ code.
+        """
+        length = x.size
+        k = n // 2
+        out = np.empty(length)
+        out[:] = np.nan
+        window = np.empty(n)
+        deviations = np.empty(n)
+        for ind in range(k, length - k):
+            for i in range(n):
+                window[i] = x[ind - k + i]
+            window.sort()
+            if n % 2:
+                x0 = window[n // 2]
+            else:
+                x0 = (window[n // 2 - 1] + window[n // 2]) / 2
+            for i in range(n):
+                deviations[i] = abs(x[ind - k + i] - x0)
+            deviations.sort()
+            if n % 2:
+                mad = deviations[n // 2]
+            else:
+                mad = (deviations[n // 2 - 1] + deviations[n // 2]) / 2
+            out[ind] = abs(x[ind] - x0) / (1.4826 * mad)
+        return out
+else:
+    _roll_hampel_compiled = None
+
+
+def roll_hampel(x, n):
+    """
+    NumPy version of seismicRoll::roll_hampel with increment=1.
+
+    Each value is the distance of a point from the median of the `n` point
+    window centered on it in units of the scaled median absolute deviation of
+    that window. The half window at either end is `NaN`. A compiled kernel is
+    used when numba is installed.
+    :param x: Array of data.
+    :param n: Window size.
+    :return: Array of Hampel values the same length as `x`.
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    if n > x.size:
+        raise Exception("n cannot be greater than length(x).")
+    if _roll_hampel_compiled is not None:
+        return _roll_hampel_compiled(x, n)
+    return _roll_hampel_numpy(x, n)
+
+
+def findOutliers(x, n=41, thresholdMin=10, selectivity=np.nan, fixedThreshold=True):
+    """
+    NumPy version of seismicRoll::findOutliers with increment=1.
+    :param x: Array of data.
+    :param n: Window size.
+    :param thresholdMin: Minimum Hampel value for an outlier.
+    :param selectivity: Fraction of the maximum Hampel value used as the
+        threshold when `fixedThreshold` is False.
+    :param fixedThreshold: Use `thresholdMin` as the threshold.
+    :return: Array of (zero based) outlier indices.
+    """
+    h = roll_hampel(x, n)
+
+    # If 50%+ of values in a window are the same, h blows up to Inf
+    h[np.isinf(h)] = np.nan
+    if np.all(np.isnan(h)):
+        raise Exception("roll_hampel returns a vector with all NA or NaN (50%+ of values in all windows are identical)")
+
+    maxH = np.nanmax(h)
+    if maxH < thresholdMin:
+        return np.array([], dtype=np.int64)
+
+    with np.errstate(invalid='ignore'):
+        if fixedThreshold:
+            return np.flatnonzero(h > thresholdMin)
+        else:
+            return np.flatnonzero(h > maxH * selectivity)
+
+
+def spikesMetric(waveform, windowSize=41, thresholdMin=10, selectivity=np.nan, fixedThreshold=True):
+    """
+    NumPy version of IRISMustangMetrics::spikesMetric.
+
+    Data from all traces are concatenated and adjacent outliers are counted
+    as a single spike.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :return: pandas dataframe with the num_spikes metric.
+    """
+    snclq = '%s.%s' % (waveform.py_stream[0].id, waveform.py_stream[0].stats.mseed.dataquality)
+    x = np.concatenate([tr.data.astype(np.float64) for tr in waveform.py_stream])
+
+    if x.size < windowSize:
+        raise Exception("spikesMetric: skipping %s trace length %d is less than windowSize %d" % (snclq, x.size, windowSize))
+
+    try:
+        outlierIndices = findOutliers(x, n=windowSize, thresholdMin=thresholdMin,
+                                      selectivity=selectivity, fixedThreshold=fixedThreshold)
+    except Exception as e:
+        raise Exception("spikesMetric: skipping %s %s" % (snclq, e))
+
+    # NOTE:  Ignore adjacent outliers when determining the count of spikes.
+    count = 0
+    if outlierIndices.size > 0:
+        count = np.count_nonzero(np.diff(outlierIndices) > 1) + 1
+
+    return general_value_df(waveform, snclq, [('num_spikes', R_format(count))])
+
+
+def roll_stalta(x, n_sta, n_lta, increment=1, block_size=65536):
+    """
+    NumPy version of seismicRoll::roll_stalta.
+
+    The STA window starts at each point and the LTA window ends at it. Window
+    sums are differences of cumulative sums, so every point costs the same no
+    matter how long the windows are. Cumulative sums are restarted for each
+    block of `block_size` points to keep rounding error relative to local
+    rather than whole-day signal energy.
+    :param x: Array of data, usually squared amplitudes.
+    :param n_sta: Number of points in the STA window.
+    :param n_lta: Number of points in the LTA window.
+    :param increment: Only calculate every `increment` points.
+    :return: Array of STA/LTA ratios the same length as `x`, `NaN` where not
+        calculated.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n_sta = int(n_sta)
+    n_lta = int(n_lta)
+    length = x.size
+    if n_sta > length:
+        raise Exception("n_sta cannot be greater than length(x).")
+    if n_lta > length:
+        raise Exception("n_lta cannot be greater than length(x).")
+    if increment < 1:
+        raise Exception("increment must be >= 1.")
+    increment = int(increment)
+
+    out = np.empty(length)
+    out.fill(np.nan)
+
+    # Block sizes are a multiple of increment so that every block starts on an evaluated point
+    block_size = max(increment, block_size - block_size % increment)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(n_lta, length - n_sta, block_size):
+            stop = min(start + block_size, length - n_sta)
+            # Cumulative sum over every point used by this block
+            first = start - n_lta + 1
+            cumsum = np.concatenate([[0.0], np.cumsum(x[first:stop + n_sta])])
+            ind = np.arange(start, stop, increment) - first
+            sta = (cumsum[ind + n_sta] - cumsum[ind]) / n_sta
+            lta = (cumsum[ind + 1] - cumsum[ind + 1 - n_lta]) / n_lta
+            out[ind + first] = sta / lta
+    return out
+
+
+def STALTAMetric(waveform, staSecs=3, ltaSecs=30, increment=1, algorithm='classic_LR'):
+    """
+    NumPy version of IRISMustangMetrics::STALTAMetric.
+
+    Each trace is demeaned and detrended before the classic_LR STA/LTA of its
+    squared amplitudes is calculated. With the default increment of 1 the
+    ratio is calculated at every sample.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :return: pandas dataframe with the max_stalta metric and its time.
+    """
+    if algorithm != 'classic_LR':
+        raise Exception('STALTAMetric: algorithm="%s" not supported by the NumPy engine' % algorithm)
+
+    snclq = _snclq(waveform.py_stream, 'STALTA')
+
+    maxSTALTA = 0.0
+    eventTime = waveform.starttime
+
+    for tr in waveform.py_stream:
+        sampling_rate = tr.stats.sampling_rate
+
+        # Make sure trace has enough data
+        n_lta = ltaSecs * sampling_rate
+        n_sta = staSecs * sampling_rate
+        if tr.stats.npts <= (n_lta + n_sta):
+            continue
+        if n_sta < 1:
+            raise Exception("STALTA.Trace: STA window of %s secs is too short for trace sampling rate of %s Hz." % (staSecs, sampling_rate))
+
+        data = detrend(tr.data)
+
+        # DC signals will have all zeroes after demeaning
+        if not np.any(data):
+            continue
+
+        stalta = roll_stalta(data**2, n_sta, n_lta, increment)
+        stalta[np.isinf(stalta)] = np.nan
+        if np.all(np.isnan(stalta)):
+            raise Exception("STALTAMetric: stalta returns a vector with all NA or NaN")
+
+        traceMaxSTALTA = np.nanmax(stalta)
+        if traceMaxSTALTA > maxSTALTA:
+            maxSTALTA = traceMaxSTALTA
+            # NOTE:  As in IRISMustangMetrics, the time uses the one based index of the maximum
+            eventIndex = np.flatnonzero(stalta == traceMaxSTALTA)[0] + 1
+            eventTime = tr.stats.starttime + eventIndex / sampling_rate
+
+    metrics = [('max_stalta', R_format(maxSTALTA), eventTime.strftime('%Y-%m-%dT%H:%M:%S'))]
+    return general_value_df(waveform, snclq, metrics, elementNames=('value', 'time'))
+
+
+def _slice_indices(stats, starttime, endtime):
+    """
+    Return the (start, stop) sample indices that IRISSeismic::slice keeps
+    when a Trace is sliced from `starttime` to `endtime`.
+    """
+    if starttime >= endtime:
+        raise Exception('slice.Trace: requested starttime "%s" >= requested endtime "%s"' % (starttime, endtime))
+    if starttime >= stats.endtime:
+        raise Exception('slice.Trace: requested starttime "%s" >= Trace endtime "%s"' % (starttime, stats.endtime))
+    if endtime <= stats.starttime:
+        raise Exception('slice.Trace: requested endtime "%s" <= Trace starttime "%s"' % (endtime, stats.starttime))
+    start = 0
+    stop = stats.npts
+    if starttime > stats.starttime:
+        start += int(math.floor(round(starttime - stats.starttime, 6) * stats.sampling_rate))
+    if endtime < stats.endtime:
+        stop -= int(math.floor(round(stats.endtime - endtime, 6) * stats.sampling_rate))
+    return (start, stop)
+
+
+def splitWindowSNR(data, noise, signal):
+    """
+    Ratio of the RMS variance of a signal window to that of a noise window
+    for every row of a 2-D array.
+    :param data: 2-D array with one row of data per station, padded with `NaN`.
+    :param noise: Tuple of (start, stop) index arrays of the noise windows.
+    :param signal: Tuple of (start, stop) index arrays of the signal windows.
+    :return: Array of SNR values, one per row.
+    """
+    columns = np.arange(data.shape[1])
+
+    def rms_variance(window):
+        (start, stop) = window
+        mask = (columns >= np.asarray(start)[:, np.newaxis]) & (columns < np.asarray(stop)[:, np.newaxis])
+        n = mask.sum(axis=1)
+        values = np.where(mask, data, 0.0)
+        mean = values.sum(axis=1) / n
+        deviations = np.where(mask, data - mean[:, np.newaxis], 0.0)
+        return np.sqrt((deviations**2).sum(axis=1) / n)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return rms_variance(signal) / rms_variance(noise)
+
+
+def SNRMetric_batch(waveforms, algorithm='splitWindow', windowSecs=60):
+    """
+    NumPy version of IRISMustangMetrics::SNRMetric for all of the station
+    windows around one event.
+
+    Windows are checked one at a time and then stacked into a single 2-D
+    array so that every SNR is calculated in one vectorized call.
+    :param waveforms: List of :class:`~ispaq.concierge.Waveform` with local data.
+    :param algorithm: Only "splitWindow" is supported.
+    :param windowSecs: Length of the noise plus signal windows in seconds.
+    :return: List with a dataframe with the sample_snr metric, or the
+        exception raised, for each waveform.
+    """
+    if algorithm != 'splitWindow':
+        raise Exception('SNRMetric: algorithm="%s" not supported by the NumPy engine' % algorithm)
+
+    results = [None] * len(waveforms)
+    rows = []
+    for (i, waveform) in enumerate(waveforms):
+        try:
+            tr = waveform.py_stream[0]
+            snclq = '%s.%s' % (tr.id, tr.stats.mseed.dataquality)
+            if len(waveform.py_stream) > 1:
+                raise Exception("SNRMetric: skipping %s because it has gaps" % snclq)
+            if tr.stats.endtime - tr.stats.starttime < windowSecs:
+                raise Exception("SNRMetric: Data do not fill the window.")
+            data = tr.data.astype(np.float64)
+            if np.all((data - data.mean()) == 0):
+                raise Exception("SNRMetric: Trace data is a DC signal.")
+            # NOTE:  The window is assumed to be centered about an event
+            to = tr.stats.starttime + (tr.stats.endtime - tr.stats.starttime) / 2
+            noise = _slice_indices(tr.stats, to - windowSecs / 2, to)
+            signal = _slice_indices(tr.stats, to, to + windowSecs / 2)
+            rows.append((i, snclq, tr.stats, data, noise, signal))
+        except Exception as e:
+            results[i] = e
+
+    if len(rows) > 0:
+        stacked = np.empty((len(rows), max(row[3].size for row in rows)))
+        stacked.fill(np.nan)
+        for (r, row) in enumerate(rows):
+            stacked[r, :row[3].size] = row[3]
+        noise = tuple(np.array([row[4][j] for row in rows]) for j in (0, 1))
+        signal = tuple(np.array([row[5][j] for row in rows]) for j in (0, 1))
+        snr = splitWindowSNR(stacked, noise, signal)
+
+        for (r, (i, snclq, stats, data, noise_window, signal_window)) in enumerate(rows):
+            results[i] = general_value_df(waveforms[i], snclq, [('sample_snr', R_format(snr[r]))],
+                                          starttime=stats.starttime, endtime=stats.endtime)
+
+    return results
+
+
+def SNRMetric(waveform, algorithm='splitWindow', windowSecs=60):
+    """
+    NumPy version of IRISMustangMetrics::SNRMetric for a single waveform.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :return: pandas dataframe with the sample_snr metric.
+    """
+    result = SNRMetric_batch([waveform], algorithm=algorithm, windowSecs=windowSecs)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+#     PSD metrics     ---------------------------------------------------------
+
+# Peterson (1993) New Low and High Noise Models as (minimum period, A, B)
+# where the model is A + B*log10(period) for periods above the minimum
+NLNM_TABLE = np.array([[0.10, -162.36, 5.64],
+                       [0.17, -166.70, 0.00],
+                       [0.40, -170.00, -8.30],
+                       [0.80, -166.40, 28.90],
+                       [1.24, -168.60, 52.48],
+                       [2.40, -159.98, 29.81],
+                       [4.30, -141.10, 0.00],
+                       [5.00, -71.36, -99.77],
+                       [6.00, -97.26, -66.49],
+                       [10.00, -132.18, -31.57],
+                       [12.00, -205.27, 36.16],
+                       [15.60, -37.65, -104.33],
+                       [21.90, -114.37, -47.10],
+                       [31.60, -160.58, -16.28],
+                       [45.00, -187.50, 0.00],
+                       [70.00, -216.47, 15.70],
+                       [101.00, -185.00, 0.00],
+                       [154.00, -168.34, -7.61],
+                       [328.00, -217.43, 11.90],
+                       [600.00, -258.28, 26.60],
+                       [10000.00, -346.88, 48.75],
+                       [100000.00, -346.88, 48.75]])
+
+NHNM_TABLE = np.array([[0.10, -108.73, -17.23],
+                       [0.22, -150.34, -80.50],
+                       [0.32, -122.31, -23.87],
+                       [0.80, -116.85, 32.51],
+                       [3.80, -108.48, 18.08],
+                       [4.60, -74.66, -32.95],
+                       [6.30, 0.66, -127.18],
+                       [7.90, -93.37, -22.42],
+                       [15.40, 73.54, -162.98],
+                       [20.00, -151.52, 10.01],
+                       [354.80, -206.66, 31.63],
+                       [100000, -206.66, 31.63]])
+
+
+class _TraceHeader(object):
+    """
+    Minimal trace header for merged traces whose endtime, as in IRISSeismic,
+    need not agree with starttime and npts.
+    """
+    def __init__(self, starttime, endtime, npts, sampling_rate):
+        self.starttime = starttime
+        self.endtime = endtime
+        self.npts = npts
+        self.sampling_rate = sampling_rate
+
+
+def _R_seq(start, stop, by):
+    """
+    Return the values of R seq(start, stop, by) including its tolerance for
+    rounding error at the end of the sequence.
+    """
+    n = int((stop - start) / by + 1e-10)
+    values = start + np.arange(n + 1) * by
+    if by > 0:
+        return np.minimum(values, stop)
+    else:
+        return np.maximum(values, stop)
+
+
+def _isDC(data):
+    """
+    True if data, ignoring missing values, are constant.
+    """
+    data = data[~np.isnan(data)]
+    return bool(np.all((data - data.mean()) == 0))
+
+
+def mergeTraces(waveform, fillMethod='fillZero'):
+    """
+    NumPy version of IRISSeismic::mergeTraces.
+
+    Gaps, and overlaps, are filled with as many zeros or `NaN` values as
+    samples would fit in them and the result is padded with `NaN` or truncated
+    to the length of the requested time window. When no gaps are found the
+    first trace is returned.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :param fillMethod: "fillZero" or "fillNA".
+    :return: Tuple of (header, data) for the merged trace.
+    """
+    if fillMethod not in ('fillZero', 'fillNA'):
+        raise Exception("mergeTraces.Stream: unknown fillMethod '%s'" % fillMethod)
+
+    py_stream = waveform.py_stream
+    headers = [tr.stats for tr in py_stream]
+    gaps = getGaps(headers, waveform.starttime, waveform.endtime)
+    sampling_rates = np.array([h.sampling_rate for h in headers], dtype=np.float64)
+    rates = np.concatenate([sampling_rates[:1], sampling_rates])
+    nsamples = np.round(np.abs(gaps) * rates).astype(np.int64)
+
+    first = headers[0]
+    if nsamples.sum() == 0:
+        header = _TraceHeader(first.starttime, first.endtime, first.npts, first.sampling_rate)
+        return (header, py_stream[0].data.astype(np.float64))
+
+    if np.any(np.abs(sampling_rates - sampling_rates[0]) >= 0.0002):
+        raise Exception('mergeTraces.Stream: %d unique sampling rates encountered in Stream.' %
+                        len(set(np.round(sampling_rates, 4))))
+
+    totalSecs = waveform.endtime - waveform.starttime
+    totalPoints = int(np.round(totalSecs) * first.sampling_rate)
+
+    fill = 0.0 if fillMethod == 'fillZero' else np.nan
+    pieces = []
+    for (i, tr) in enumerate(py_stream):
+        pieces.append(np.full(nsamples[i], fill))
+        pieces.append(tr.data.astype(np.float64))
+    pieces.append(np.full(nsamples[-1], fill))
+    data = np.concatenate(pieces)
+
+    missing_points = totalPoints - data.size
+    if missing_points > math.ceil(2 * first.sampling_rate):
+        raise Exception('mergeTraces.Stream: %d unaccounted for points after merge' % missing_points)
+    elif missing_points < math.ceil(-2 * first.sampling_rate):
+        raise Exception('mergeTraces.Stream: %d extra points after merge' % abs(missing_points))
+    if missing_points > 0:
+        data = np.concatenate([data, np.full(missing_points, np.nan)])
+    data = data[:totalPoints]
+
+    starttime = first.starttime if nsamples[0] == 0 else waveform.starttime
+    endtime = headers[-1].endtime if nsamples[-1] == 0 else waveform.endtime
+    return (_TraceHeader(starttime, endtime, totalPoints, first.sampling_rate), data)
+
+
+_bin_matrices = {}
+
+def McNamaraBins(freq, loFreq=0.005, hiFreq=10, alignFreq=0.1):
+    """
+    Return the 1/8 octave bin frequencies and averaging matrix used by
+    IRISSeismic::McNamaraBins.
+
+    Each bin averages the raw spectrum over the full octave from 1/2 octave
+    below to 1/2 octave above the bin frequency. Matrices are cached because
+    every PSD with the same number of samples uses the same one.
+    :param freq: Array of raw spectrum frequencies.
+    :param loFreq: Lowest bin frequency.
+    :param hiFreq: Highest bin frequency.
+    :param alignFreq: Frequency that is always a bin frequency.
+    :return: Tuple of (binFreq, matrix) where ``matrix.dot(spec)`` is the
+        binned spectrum, `NaN` for bins without raw frequencies.
+    """
+    key = (freq.size, freq[0], freq[-1], loFreq, hiFreq, alignFreq)
+    if key in _bin_matrices:
+        return _bin_matrices[key]
+
+    if alignFreq >= hiFreq:
+        octaves = _R_seq(math.log(alignFreq, 2), math.log(loFreq, 2), -0.125)
+        octaves = octaves[octaves <= math.log(hiFreq, 2)]
+    else:
+        loOctaves = _R_seq(math.log(alignFreq, 2), math.log(loFreq, 2), -0.125)
+        hiOctaves = _R_seq(math.log(alignFreq, 2), math.log(hiFreq, 2), 0.125)
+        octaves = np.unique(np.concatenate([loOctaves, hiOctaves]))
+    binFreq = np.sort(2**octaves)
+
+    # Raw frequencies in (binFreq[i-1], binFreq[i]] belong to bin i
+    halfOctaveAbove = 2**(math.log(hiFreq, 2) + 0.5)
+    breaks = np.concatenate([[0], binFreq, [halfOctaveAbove]])
+    codes = np.searchsorted(breaks, freq, side='left')
+    bins = np.where((codes >= 1) & (codes < breaks.size), codes - 1, -1)
+    maxBin = bins.max()
+
+    matrix = np.zeros((binFreq.size, freq.size))
+    for i in range(1, binFreq.size + 1):
+        loBin = max(1, i - 4)
+        hiBin = min(i + 3, maxBin)
+        # NOTE:  R seq(loBin, hiBin) counts down when hiBin < loBin
+        indices = (bins >= min(loBin, hiBin)) & (bins <= max(loBin, hiBin))
+        count = indices.sum()
+        if count > 0:
+            matrix[i - 1, indices] = 1.0 / count
+        else:
+            matrix[i - 1, :] = np.nan
+
+    _bin_matrices[key] = (binFreq, matrix)
+    return (binFreq, matrix)
+
+
+def _spectral_segments(windows, starts, truncatedLength):
+    """
+    Return the 13 overlapping McNamara subsegments of every PSD as rows of a
+    2-D array, gathered from a strided view of all windows of the data.
+    """
+    step = truncatedLength // 16
+    offsets = np.arange(13) * step
+    rows = (np.asarray(starts)[:, np.newaxis] + offsets).ravel()
+    return windows[rows]
+
+
+def McNamaraPSD_batch(data, starts, truncatedLength, sampling_rate, loFreq=0.005, hiFreq=10,
+                      alignFreq=0.1, block_size=8):
+    """
+    NumPy version of IRISSeismic::McNamaraPSD for many PSDs of the same length.
+
+    Every PSD averages the periodograms of 13 overlapping subsegments, each
+    1/4 of the data truncated to a power of two, computed as stats::spec.pgram
+    does with a 10% cosine taper after removing a linear trend. Subsegments
+    are views into the data so one copy is made per block of PSDs, which is
+    then detrended, tapered and transformed with a single batched FFT.
+    :param data: Array of merged trace data.
+    :param starts: Index of the first sample of each PSD.
+    :param truncatedLength: Power of two number of samples used by each PSD.
+    :param sampling_rate: Sampling rate in Hz.
+    :param block_size: Number of PSDs transformed together.
+    :return: Tuple of (freq, spec) with spec in dB, one row per PSD.
+    """
+    N = truncatedLength // 4
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    windows = np.lib.stride_tricks.as_strided(data, shape=(data.size - N + 1, N),
+                                              strides=(data.strides[0], data.strides[0]))
+
+    # stats::spec.pgram with detrend=TRUE, taper=0.1 and no padding for
+    # lengths that are a power of two
+    t = np.arange(1, N + 1) - (N + 1) / 2
+    sumt2 = N * (N**2 - 1) / 12
+    taper = spec_taper(N, 0.1)
+    u2 = 1 - (5 / 8) * 0.1 * 2
+    freq = sampling_rate / N + np.arange(N // 2) * (sampling_rate / N)
+    (binFreq, matrix) = McNamaraBins(freq, loFreq, hiFreq, alignFreq)
+
+    spec = np.empty((len(starts), binFreq.size))
+    for first in range(0, len(starts), block_size):
+        block = starts[first:first + block_size]
+        x = _spectral_segments(windows, block, truncatedLength)
+        x = x - x.mean(axis=1)[:, np.newaxis] - np.outer(x.dot(t) / sumt2, t)
+        x *= taper
+        xfft = np.fft.rfft(x, axis=1)[:, 1:N // 2 + 1]
+        pgram = (xfft.real**2 + xfft.imag**2) / (N * sampling_rate) / u2
+        # Average of 2 * spec over the 13 subsegments of each PSD
+        average = 2 * pgram.reshape(len(block), 13, -1).sum(axis=1) / 13
+        with np.errstate(divide='ignore', invalid='ignore'):
+            spec[first:first + len(block)] = 10 * np.log10(average.dot(matrix.T))
+
+    return (binFreq, spec)
+
+
+def psdList(waveform):
+    """
+    NumPy version of IRISSeismic::psdList.
+
+    The merged trace is cut into segments of one hour, or longer for long
+    period channels, that overlap by half. Segments are grouped by their power
+    of two length so that each group is processed by a single call to
+    :func:`McNamaraPSD_batch`.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :return: Tuple of (snclq, freq, starttimes, endtimes, spec) with one row of
+        spec in dB for each PSD.
+    """
+    (header, data) = mergeTraces(waveform)
+    # Very occasionally a trace will contain NaN values from the original miniSEED
+    data = np.where(np.isnan(data), 0.0, data)
+
+    stats = waveform.py_stream[0].stats
+    snclq = '%s.%s' % (waveform.py_stream[0].id, stats.mseed.dataquality)
+
+    hiFreq = 0.5 * header.sampling_rate
+    alignFreq = 0.1
+    if stats.channel.startswith('V'):
+        Z = 24 * 3600
+        loFreq = 0.0001
+        alignFreq = 0.025
+    elif stats.channel.startswith('L'):
+        Z = 3 * 3600
+        loFreq = 0.001
+    elif stats.channel.startswith('M'):
+        Z = 2 * 3600
+        loFreq = 0.0025
+    else:
+        Z = 3600
+        loFreq = 0.005
+
+    segments = []
+    start = header.starttime
+    end = start + Z
+    while header.endtime - start >= 0.99 * Z:
+        (first, last) = _slice_indices(header, start, end)
+        # Sliced times are offset from the trace times as in IRISSeismic::slice
+        starttime = header.starttime
+        if start > header.starttime:
+            starttime = header.starttime + round(start - header.starttime, 6)
+        endtime = header.endtime
+        if end < header.endtime:
+            endtime = header.endtime - round(header.endtime - end, 6)
+        if not _isDC(data[first:last]):
+            truncatedLength = 2**int(math.floor(math.log(last - first, 2)))
+            segments.append((first, truncatedLength, starttime, endtime))
+        start += Z / 2
+        end += Z / 2
+
+    rows = {}
+    freq = None
+    for truncatedLength in sorted(set(segment[1] for segment in segments)):
+        indices = [i for (i, segment) in enumerate(segments) if segment[1] == truncatedLength]
+        starts = np.array([segments[i][0] for i in indices])
+        (freq, spec) = McNamaraPSD_batch(data, starts, truncatedLength, header.sampling_rate,
+                                         loFreq, hiFreq, alignFreq)
+        for (i, row) in zip(indices, spec):
+            rows[i] = row
+
+    # PSDs with -Inf power are dropped
+    keep = [i for i in range(len(segments)) if not np.any(np.isneginf(rows[i]))]
+    starttimes = [segments[i][2] for i in keep]
+    endtimes = [segments[i][3] for i in keep]
+    spec = np.array([rows[i] for i in keep])
+    return (snclq, freq, starttimes, endtimes, spec)
+
+
+def noiseModels(freq):
+    """
+    NumPy version of IRISSeismic::noiseModels.
+    :param freq: Array of frequencies.
+    :return: Tuple of (nlnm, nhnm) arrays in dB, `NaN` outside the models.
+    """
+    period = 1 / np.asarray(freq, dtype=np.float64)
+
+    def model(table):
+        breaks = table[:, 0]
+        # .bincode(right=FALSE, include.lowest=TRUE) intervals [lo, hi), last one closed
+        rows = np.searchsorted(breaks, period, side='right') - 1
+        rows[period == breaks[-1]] = breaks.size - 2
+        valid = (rows >= 0) & (rows < breaks.size - 1)
+        rows = np.clip(rows, 0, breaks.size - 2)
+        values = table[rows, 1] + table[rows, 2] * np.log10(period)
+        return np.where(valid, values, np.nan)
+
+    return (model(NLNM_TABLE), model(NHNM_TABLE))
+
+
+def psdStatistics(spec, freq, evalresp):
+    """
+    NumPy version of IRISSeismic::psdStatistics for a list of PSDs.
+    :param spec: 2-D array of PSDs in dB, one row per PSD.
+    :param freq: Array of PSD frequencies.
+    :param evalresp: pandas dataframe of instrument response with freq and amp columns.
+    :return: Dictionary with the noiseMatrix, pdfMatrix, pdfBins, mean,
+        nlnm, nhnm, pct_above and pct_below arrays.
+    """
+    if not ('amp' in evalresp.columns and 'freq' in evalresp.columns):
+        raise Exception("error evalresp dataframe does not have columns named 'amp' and 'freq'")
+    if evalresp.shape[0] == 0:
+        raise Exception("getEvalresp returned no content")
+    if spec.shape[1] != evalresp.shape[0]:
+        raise Exception("psdList2NoiseMatrix: length(evalresp$freq) = %d and ncol(rawNoiseMatrix) = %d are not equal." %
+                        (evalresp.shape[0], spec.shape[1]))
+
+    # Dividing by the squared instrument response is subtracting in dB space
+    correction = 10 * np.log10(np.asarray(evalresp.amp, dtype=np.float64)) * 2
+    noiseMatrix = spec - correction
+
+    (nlnm, nhnm) = noiseModels(freq)
+    nrow = noiseMatrix.shape[0]
+    notNA = ~np.isnan(noiseMatrix[0]) & ~np.isnan(nlnm)
+    pct_above = np.where(notNA, 100 * (noiseMatrix > nhnm).sum(axis=0) / nrow, np.nan)
+    pct_below = np.where(notNA, 100 * (noiseMatrix < nlnm).sum(axis=0) / nrow, np.nan)
+
+    # 1 dB histograms of every column, closed on the right as with .bincode
+    valid = noiseMatrix[:, ~np.isnan(noiseMatrix[0])]
+    lo = math.floor(valid.min())
+    hi = math.ceil(valid.max())
+    pdfBins = np.arange(lo, hi + 1, dtype=np.float64)
+    breaks = np.arange(lo - 0.5, hi + 1.0, 1.0)
+    codes = np.searchsorted(breaks, noiseMatrix, side='left')
+    codes[noiseMatrix == breaks[0]] = 1
+    inside = ~np.isnan(noiseMatrix) & (codes >= 1) & (codes < breaks.size)
+    columns = np.broadcast_to(np.arange(noiseMatrix.shape[1]), noiseMatrix.shape)
+    pdfMatrix = np.zeros((pdfBins.size, noiseMatrix.shape[1]), dtype=np.int64)
+    np.add.at(pdfMatrix, (codes[inside] - 1, columns[inside]), 1)
+
+    return {'noiseMatrix': noiseMatrix,
+            'pdfMatrix': pdfMatrix,
+            'pdfBins': pdfBins,
+            'mean': noiseMatrix.mean(axis=0),
+            'nlnm': nlnm,
+            'nhnm': nhnm,
+            'pct_above': pct_above,
+            'pct_below': pct_below}
+
+
+def _period_band(period, hiPeriod, loPeriod):
+    """
+    Return the column indices used by PSDMetric between the last period at or
+    above `hiPeriod` and the first period at or below `loPeriod`.
+    """
+    above = np.nonzero(period >= hiPeriod)[0]
+    below = np.nonzero(period <= loPeriod)[0]
+    if above.size == 0 or below.size == 0:
+        raise Exception('PSDMetric: no PSD frequencies between periods of %g and %g seconds' % (loPeriod, hiPeriod))
+    first = above.max() + 1
+    last = below.min() - 1
+    # NOTE:  R first:last counts down when last < first
+    return np.arange(min(first, last), max(first, last) + 1)
+
+
+def _residual_sd(x, y):
+    """
+    Standard deviation of the residuals of a least squares line fit of y on x.
+    """
+    (slope, intercept) = np.polyfit(x, y, 1)
+    return np.std(y - (intercept + slope * x), ddof=1)
+
+
+def getEvalresp(snclq, time, minfreq, maxfreq, nfreq, units='acc'):
+    """
+    Return the instrument response from the IRIS evalresp web service.
+    :return: pandas dataframe with freq, amp and phase columns.
+    """
+    from obspy.clients.iris import Client
+    (network, station, location, channel) = snclq.split('.')[:4]
+    if location == '':
+        location = '--'
+    fap = Client().evalresp(network, station, location, channel, time=time, minfreq=minfreq,
+                            maxfreq=maxfreq, nfreq=nfreq, units=units, output='fap')
+    return pd.DataFrame(np.asarray(fap)[:, :3], columns=['freq', 'amp', 'phase'])
+
+
+def PSDMetric(waveform, expLoPeriod=None, expHiPeriod=100, linLoPeriod=None, linHiPeriod=100,
+              evalresp=None):
+    """
+    NumPy version of IRISMustangMetrics::PSDMetric.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :param evalresp: pandas dataframe of FAP from evalresp (freq,amp,phase).
+        The IRIS evalresp web service is used if it is not provided.
+    :return: tuple of GeneralValueMetrics, corrected PSD, and PDF dataframes
+        as returned by :func:`~ispaq.irismustangmetrics.apply_PSD_metric`.
+    """
+    py_stream = waveform.py_stream
+    sampling_rate = py_stream[0].stats.sampling_rate
+    if expLoPeriod is None:
+        expLoPeriod = 4 / sampling_rate
+    if linLoPeriod is None:
+        linLoPeriod = 4 / sampling_rate
+
+    if sum(tr.stats.npts for tr in py_stream) == 1:
+        raise Exception('PSDMetric: stopping PSD calculation because st length is one sample')
+    if _isDC(mergeTraces(waveform)[1]):
+        raise Exception('PSDMetric: stopping PSD calculation because st is flatlined')
+
+    (snclq, freq, starttimes, endtimes, spec) = psdList(waveform)
+    if len(starttimes) == 0:
+        raise Exception('PSDMetric: No PSDs returned for %s' % py_stream[0].id)
+
+    if evalresp is None:
+        evalresp = getEvalresp(snclq, starttimes[0] + 1, freq.min(), freq.max(), freq.size)
+
+    try:
+        psdStats = psdStatistics(spec, freq, evalresp)
+    except Exception as e:
+        raise Exception('PSDMetrics: %s %s' % (e, snclq))
+
+    with np.errstate(invalid='ignore'):
+        nyquist = sampling_rate / 2
+        below_nyquist = freq < nyquist / 1.5
+        avg_pct_above = np.nanmean(psdStats['pct_above'][below_nyquist])
+        avg_pct_below = np.nanmean(psdStats['pct_below'][below_nyquist])
+
+    period = 1 / freq
+    mean = psdStats['mean']
+
+    # Deviation from an exponential fit of the mean PSD
+    band = _period_band(period, expHiPeriod, expLoPeriod)
+    positiveMean = mean[band] - mean[band].min() + 0.1
+    dead_channel_exp = _residual_sd(np.log10(period[band]), np.log10(positiveMean))
+
+    # Deviation from a linear fit of the mean PSD
+    band = _period_band(period, linHiPeriod, linLoPeriod)
+    dead_channel_lin = _residual_sd(np.log10(period[band]), mean[band])
+
+    # Median of the PDF in the 4 to 8 second band compared with the NLNM
+    dead_channel_gsn = 0
+    if sampling_rate >= 1:
+        band = _period_band(period, 4, 8)
+        unH_floor = math.floor(psdStats['noiseMatrix'][:, band].min())
+        # NOTE:  As in IRISMustangMetrics, the histogram values start at unH_floor
+        pdfMedian = np.array([np.median(unH_floor + np.repeat(np.arange(column.size), column))
+                              for column in psdStats['pdfMatrix'][:, band].T])
+        averageDiff = np.mean(psdStats['nlnm'][band] - pdfMedian)
+        dead_channel_gsn = np.nan if np.isnan(averageDiff) else (1 if averageDiff > 5.0 else 0)
+
+    channel = py_stream[0].stats.channel
+    metrics = [('pct_above_nhnm', R_format(avg_pct_above)),
+               ('pct_below_nlnm', R_format(avg_pct_below))]
+    if re.search('BH|HH|CH|DH|BX|HX', channel):
+        metrics.append(('dead_channel_exp', R_format(dead_channel_exp)))
+        metrics.append(('dead_channel_lin', R_format(dead_channel_lin)))
+    if not np.isnan(dead_channel_gsn) and re.search('BH|HH|CH|DH|LH|MH|BX|HX', channel):
+        metrics.append(('dead_channel_gsn', R_format(dead_channel_gsn)))
+    df = general_value_df(waveform, snclq, metrics,
+                          starttime=py_stream[0].stats.starttime, endtime=py_stream[-1].stats.endtime)
+
+    # Corrected PSDs, one row per PSD and frequency
+    noiseMatrix = psdStats['noiseMatrix']
+    nfreq = freq.size
+    PSDCorrected = pd.DataFrame({'starttime': np.repeat([_datetime64(t) for t in starttimes], nfreq),
+                                 'endtime': np.repeat([_datetime64(t) for t in endtimes], nfreq),
+                                 'freq': np.tile(freq, noiseMatrix.shape[0]),
+                                 'power': noiseMatrix.ravel()},
+                                columns=['starttime', 'endtime', 'freq', 'power'])
+
+    # PDF hits, one row per frequency and power bin with hits
+    pdfMatrix = psdStats['pdfMatrix']
+    nbins = psdStats['pdfBins'].size
+    PDF = pd.DataFrame({'freq': np.repeat(freq, nbins),
+                        'power': np.tile(psdStats['pdfBins'], nfreq),
+                        'hits': pdfMatrix.T.ravel()},
+                       columns=['freq', 'power', 'hits'])
+    PDF = PDF[PDF.hits > 0].reset_index(drop=True)
+
+    return (df, PSDCorrected, PDF)
+
+
+#     Correlation metrics     -------------------------------------------------
+
+def correlationMatrix(data):
+    """
+    Pearson correlation of every pair of rows of a 2-D array.
+
+    As with cor(use="na.or.complete"), each pair only uses the columns where
+    both rows have values. All pairs are calculated together from matrix
+    products of the data and of its mask of valid values, after centering
+    each row so that the sums do not lose precision to a large DC offset.
+    :param data: 2-D array with one row per channel, padded with `NaN`.
+    :return: Square array of correlations, `NaN` where undefined.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    valid = ~np.isnan(data)
+    mask = valid.astype(np.float64)
+    counts = valid.sum(axis=1)
+    means = np.where(valid, data, 0.0).sum(axis=1) / np.maximum(counts, 1)
+    x = np.where(valid, data - means[:, np.newaxis], 0.0)
+
+    n = mask.dot(mask.T)
+    # sums[i, j] is the sum of row i over the columns where row j is also valid
+    sums = x.dot(mask.T)
+    squares = (x * x).dot(mask.T)
+    products = x.dot(x.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = products - sums * sums.T / n
+        variance = squares - sums**2 / n
+        correlation = covariance / np.sqrt(variance * variance.T)
+    correlation[n < 2] = np.nan
+    return np.clip(correlation, -1.0, 1.0)
+
+
+def correlationMetric_batch(waveforms, pairs, data=None):
+    """
+    NumPy version of IRISMustangMetrics::correlationMetric for many pairs of
+    channels at one station.
+
+    All channels are stacked into a single 2-D array, padded with `NaN` so
+    that each pair only uses the samples of the shorter channel, and every
+    pair is taken from one call to :func:`correlationMatrix`.
+    :param waveforms: List of :class:`~ispaq.concierge.Waveform` with local data.
+    :param pairs: List of (i, j) indices into `waveforms` to correlate.
+    :param data: Optional list of data arrays to use instead of the first
+        trace of each waveform, e.g. from :func:`mergeTraces`.
+    :return: List with a dataframe with the cross_talk metric, or the
+        exception raised, for each pair.
+    """
+    stats = [waveform.py_stream[0].stats for waveform in waveforms]
+    if data is None:
+        data = [waveform.py_stream[0].data for waveform in waveforms]
+    data = [np.asarray(d, dtype=np.float64) for d in data]
+
+    results = [None] * len(pairs)
+    rows = []
+    for (k, (i, j)) in enumerate(pairs):
+        (stats1, stats2) = (stats[i], stats[j])
+        try:
+            if waveforms[i].starttime != waveforms[j].starttime or waveforms[i].endtime != waveforms[j].endtime:
+                raise Exception("correlationMetric: Incompatible starttimes or endtimes")
+            if stats1.sampling_rate != stats2.sampling_rate:
+                raise Exception("correlationMetric: Incompatible sampling rates")
+            if abs(data[i].size - data[j].size) > 2:
+                raise Exception("correlationMetric: Incompatible lengths tr1 = %d , tr2 = %d" % (data[i].size, data[j].size))
+            if stats1.network != stats2.network or stats1.station != stats2.station:
+                raise Exception("correlationMetric: Incompatible trace ids '%s', '%s'" %
+                                (waveforms[i].py_stream[0].id, waveforms[j].py_stream[0].id))
+            for n in (i, j):
+                if _isDC(data[n]):
+                    raise Exception("correlationMetric: %s has one unique sample value (flatlined). Standard deviation is zero, correlation is undefined." %
+                                    waveforms[n].py_stream[0].id)
+            rows.append(k)
+        except Exception as e:
+            results[k] = e
+
+    if len(rows) > 0:
+        used = sorted(set(n for k in rows for n in pairs[k]))
+        stacked = np.empty((len(used), max(data[n].size for n in used)))
+        stacked.fill(np.nan)
+        for (r, n) in enumerate(used):
+            stacked[r, :data[n].size] = data[n]
+        correlation = correlationMatrix(stacked)
+
+        for k in rows:
+            (i, j) = pairs[k]
+            (stats1, stats2) = (stats[i], stats[j])
+            locations = stats1.location
+            if stats2.location != stats1.location:
+                locations = '%s:%s' % (locations, stats2.location)
+            channels = stats1.channel
+            if stats2.channel != stats1.channel:
+                channels = '%s:%s' % (channels, stats2.channel)
+            snclq = '.'.join([stats1.network, stats1.station, locations, channels, stats1.mseed.dataquality])
+            value = correlation[used.index(i), used.index(j)]
+            results[k] = general_value_df(waveforms[i], snclq, [('cross_talk', R_format(value, nsmall=3))])
+
+    return results
+
+
+#     Cross-correlation metrics     -------------------------------------------
+
+def _R_filtfilt(b, a, x):
+    """
+    Zero phase filter as signal::filtfilt, which pads the end of the data
+    with zeros instead of reflecting it.
+    """
+    from scipy import signal
+    padding = np.zeros(2 * max(len(a), len(b)))
+    y = signal.lfilter(b, a, np.concatenate([x, padding]))
+    return signal.lfilter(b, a, y[::-1])[::-1][:x.size]
+
+
+def R_decimate(x, q, n=8):
+    """
+    NumPy version of signal::decimate with an order `n` Chebyshev type I
+    anti-alias filter. As in R, the data are filtered even when q is 1.
+    :param x: Array of data.
+    :param q: Integer decimation factor.
+    :param n: Filter order.
+    :return: Every q-th sample of the filtered data.
+    """
+    from scipy import signal
+    (b, a) = signal.cheby1(n, 0.05, 0.8 / q)
+    return _R_filtfilt(b, a, np.asarray(x, dtype=np.float64))[::q]
+
+
+def _crossCorrelation_series(waveform, sampling_rate, polarity, cache):
+    """
+    Return the detrended, resampled and low pass filtered data that
+    crossCorrelationMetric correlates, using `cache` when possible.
+    """
+    tr = waveform.py_stream[0]
+    key = ('series', tr.id, tr.stats.starttime.timestamp, tr.stats.npts, sampling_rate, polarity)
+    if cache is not None and key in cache:
+        return cache[key]
+
+    from scipy import signal
+    data = detrend(polarity * tr.data.astype(np.float64))
+    if _isDC(data):
+        raise Exception("crossCorrelationMetric: %s.%s has one unique sample value (flatlined). Standard deviation is zero, cross-correlation is undefined." %
+                        (tr.id, tr.stats.mseed.dataquality))
+    rate = _crossCorrelation_rate(tr.stats.sampling_rate, sampling_rate)
+    if rate > sampling_rate:
+        data = R_decimate(data, int(np.round(rate / sampling_rate)))
+    if np.any(np.isnan(data)):
+        raise Exception("crossCorrelationMetric: %s.%s NA values were generated during resampling" %
+                        (tr.id, tr.stats.mseed.dataquality))
+    (b, a) = signal.butter(2, 0.1 / (sampling_rate / 2))
+    series = signal.lfilter(b, a, data)
+
+    if cache is not None:
+        cache[key] = series
+    return series
+
+
+def _crossCorrelation_rate(sampling_rate, other_rate):
+    """
+    Sampling rate rounded as in crossCorrelationMetric.
+    """
+    if sampling_rate < 1 or other_rate < 1:
+        return np.round(sampling_rate, 2)
+    return int(np.round(sampling_rate))
+
+
+def _crossCorrelation_spectrum(key, series, n, nfft, cache):
+    """
+    Return the spectrum and sum of squares of the first n demeaned values of
+    a series, using `cache` when possible.
+    """
+    key = ('spectrum',) + key + (n, nfft)
+    if cache is not None and key in cache:
+        return cache[key]
+    x = series[:n] - series[:n].mean()
+    result = (np.fft.rfft(x, nfft), np.dot(x, x))
+    if cache is not None:
+        cache[key] = result
+    return result
+
+
+def crossCorrelation(waveform1, waveform2, maxLagSecs=10, polarity1=1.0, polarity2=1.0, cache=None):
+    """
+    Peak of the normalized cross-correlation of two single trace waveforms
+    as calculated by IRISMustangMetrics::crossCorrelationMetric.
+
+    Both channels are resampled to the lower sampling rate with the same
+    anti-alias filter as signal::decimate and low pass filtered at 0.1 Hz.
+    The cross-correlation function of stats::ccf is then calculated for lags
+    up to `maxLagSecs` from the product of the two spectra.
+
+    Filtered series and spectra are stored in `cache`, when provided, so
+    that a channel compared with several neighbors is only processed and
+    transformed once.
+    :param waveform1: :class:`~ispaq.concierge.Waveform` with local data.
+    :param waveform2: :class:`~ispaq.concierge.Waveform` with local data.
+    :param maxLagSecs: Maximum lag in seconds.
+    :param polarity1: Factor applied to the data of waveform1, -1 to invert it.
+    :param polarity2: Factor applied to the data of waveform2.
+    :param cache: Optional dictionary shared between calls.
+    :return: tuple of (peak correlation, lag in seconds of waveform1 relative to waveform2).
+    """
+    (st1, st2) = (waveform1.py_stream, waveform2.py_stream)
+    for st in (st1, st2):
+        if len(st) > 1:
+            raise Exception("crossCorrelationMetric: %s.%s has more than one trace." % (st[0].id, st[0].stats.mseed.dataquality))
+    (tr1, tr2) = (st1[0], st2[0])
+    for tr in (tr1, tr2):
+        if tr.stats.sampling_rate < 0.05:
+            raise Exception("crossCorrelationMetric: %s.%s has a sampling_rate < 0.05." % (tr.id, tr.stats.mseed.dataquality))
+
+    sr1 = _crossCorrelation_rate(tr1.stats.sampling_rate, tr2.stats.sampling_rate)
+    sr2 = _crossCorrelation_rate(tr2.stats.sampling_rate, tr1.stats.sampling_rate)
+    sampling_rate = min(sr1, sr2)
+    for sr in (sr1, sr2):
+        if sr > sampling_rate and sr % sampling_rate > 0:
+            raise Exception("crossCorrelationMetric: sampling rates are not multiples of each other:%s=%s, %s=%s" %
+                            (tr1.id, sr1, tr2.id, sr2))
+
+    d1 = _crossCorrelation_series(waveform1, sampling_rate, polarity1, cache)
+    d2 = _crossCorrelation_series(waveform2, sampling_rate, polarity2, cache)
+
+    # stats::ccf uses the common length of both series and lags up to n-1
+    n = min(d1.size, d2.size)
+    lag_max = int(min(sampling_rate * maxLagSecs, n - 1))
+    nfft = 2**int(math.ceil(math.log(n + lag_max, 2)))
+    key1 = (tr1.id, tr1.stats.starttime.timestamp, tr1.stats.npts, sampling_rate, polarity1)
+    key2 = (tr2.id, tr2.stats.starttime.timestamp, tr2.stats.npts, sampling_rate, polarity2)
+    (X1, ss1) = _crossCorrelation_spectrum(key1, d1, n, nfft, cache)
+    (X2, ss2) = _crossCorrelation_spectrum(key2, d2, n, nfft, cache)
+
+    # Element k of the circular correlation is sum(x1[t+k] * x2[t])
+    circular = np.fft.irfft(X1 * np.conj(X2), nfft)
+    acf = np.concatenate([circular[nfft - lag_max:], circular[:lag_max + 1]]) / math.sqrt(ss1 * ss2)
+    lags = np.arange(-lag_max, lag_max + 1)
+
+    (corrMin, corrMax) = (acf.min(), acf.max())
+    peak_correlation = corrMin if abs(corrMin) > abs(corrMax) else corrMax
+    peak_lag = lags[acf == peak_correlation][0] / sampling_rate
+    return (peak_correlation, peak_lag)
+
+
+def crossCorrelationMetric(waveform1, waveform2, maxLagSecs=10, polarity1=1.0, polarity2=1.0, cache=None):
+    """
+    NumPy version of IRISMustangMetrics::crossCorrelationMetric.
+
+    Arguments are the same as for :func:`crossCorrelation`.
+    :return: pandas dataframe with the polarity_check metric.
+    """
+    (peak_correlation, peak_lag) = crossCorrelation(waveform1, waveform2, maxLagSecs, polarity1, polarity2, cache)
+    (tr1, tr2) = (waveform1.py_stream[0], waveform2.py_stream[0])
+    snclq2 = '%s.%s' % (tr2.id, tr2.stats.mseed.dataquality)
+    metrics = [('polarity_check', R_format(peak_correlation), snclq2)]
+    return general_value_df(waveform1, '%s.%s' % (tr1.id, tr1.stats.mseed.dataquality), metrics,
+                            elementNames=('value', 'snclq2'),
+                            starttime=tr1.stats.starttime, endtime=tr1.stats.endtime)
+
+
+#     Transfer function metrics     -------------------------------------------
+
+# Smoothing kernel of crossSpectrum with spans=c(3,5), the convolution of
+# modified Daniell kernels with m=1 and m=2, for lags -3 to 3
+_DANIELL_3_5 = np.convolve([0.25, 0.5, 0.25], [0.125, 0.25, 0.25, 0.25, 0.125])
+
+
+def _transferFunction_spectra(tr, data, sampling_rate, truncatedLength, cache):
+    """
+    Return the FFTs of the 13 overlapping, detrended and 10% tapered segments
+    of a channel used by transferFunctionMetric, using `cache` when possible.
+    """
+    key = ('transferFunction', tr.id, tr.stats.starttime.timestamp, tr.stats.npts, sampling_rate, truncatedLength)
+    if cache is not None and key in cache:
+        return cache[key]
+
+    sr = int(np.round(tr.stats.sampling_rate))
+    d = R_decimate(data, int(np.round(sr / sampling_rate)), 7)
+    if np.any(np.isnan(d)):
+        raise Exception("transferFunctionMetric: NA values generated during resampling, %s.%s" %
+                        (tr.id, tr.stats.mseed.dataquality))
+    if d.size < truncatedLength:
+        raise Exception("transferFunctionMetric: NA values generated during smoothing, %s.%s" %
+                        (tr.id, tr.stats.mseed.dataquality))
+
+    N = truncatedLength // 4
+    starts = np.arange(13) * (truncatedLength // 16)
+    segments = np.vstack([d[start:start + N] for start in starts])
+    spectra = np.fft.fft(detrend(segments) * spec_taper(N, 0.1), axis=1)
+
+    if cache is not None:
+        cache[key] = spectra
+    return spectra
+
+
+def _smooth_cross_spectrum(X, Y, N0, sampling_rate):
+    """
+    Cross spectrum of crossSpectrum before it is trimmed to positive
+    frequencies, smoothed by the circular modified Daniell kernel.
+    """
+    P = X * np.conj(Y) / (N0 * sampling_rate)
+    P[:, 0] = 0.5 * (P[:, 1] + P[:, -1])
+    smoothed = np.zeros_like(P)
+    for (lag, weight) in zip(range(-3, 4), _DANIELL_3_5):
+        smoothed += weight * np.roll(P, lag, axis=1)
+    return smoothed
+
+
+def _azimuth(waveform):
+    """
+    Metadata azimuth of a Waveform or `NaN` when unknown.
+    """
+    azimuth = (waveform.trace_info or {}).get('azimuth')
+    return np.nan if azimuth is None else float(azimuth)
+
+
+def transferFunctionMetric(waveform1, waveform2, evalresp1, evalresp2, cache=None,
+                           mate=None, angle=0, component='R'):
+    """
+    NumPy version of IRISMustangMetrics::transferFunctionMetric.
+
+    The spectrum of each channel is the FFT of 13 overlapping segments that
+    are stored in `cache`, when provided, so that a channel compared with
+    several others is only decimated and transformed once. Auto and cross
+    spectra, coherence and phase of a pair are formed from those FFTs.
+
+    When `mate` is given, the secondary channel is first rotated with its
+    orthogonal mate as IRISSeismic::rotate2D(waveform2, mate, angle) does.
+    Every processing step is linear so the spectra of the rotated channel
+    are combined from the cached spectra of the two channels.
+    :param waveform1: :class:`~ispaq.concierge.Waveform` of the primary channel.
+    :param waveform2: :class:`~ispaq.concierge.Waveform` of the secondary channel.
+    :param evalresp1: pandas dataframe of the evalresp FAP for waveform1.
+    :param evalresp2: pandas dataframe of the evalresp FAP for the secondary channel.
+    :param cache: Optional dictionary shared between calls.
+    :param mate: Optional :class:`~ispaq.concierge.Waveform` orthogonal to waveform2.
+    :param angle: Rotation angle in degrees.
+    :param component: 'R' for the radial or 'T' for the transverse component.
+    :return: pandas dataframe with the transfer_function metric.
+    """
+    streams = [waveform1.py_stream, waveform2.py_stream] + ([mate.py_stream] if mate is not None else [])
+    for st in streams:
+        if len(st) > 1:
+            raise Exception("transferFunctionMetric: %s.%s has more than one trace." % (st[0].id, st[0].stats.mseed.dataquality))
+    (tr1, tr2) = (waveform1.py_stream[0], waveform2.py_stream[0])
+    (id1, id2) = ['%s.%s' % (tr.id, tr.stats.mseed.dataquality) for tr in (tr1, tr2)]
+
+    (starttime, endtime) = (tr1.stats.starttime, tr1.stats.endtime)
+    if abs(tr2.stats.starttime - starttime) > 1:
+        raise Exception("transferFunctionMetric: starttimes don't match: %s , %s" % (tr2.stats.starttime, starttime))
+    if abs(tr2.stats.endtime - endtime) > 1:
+        raise Exception("transferFunctionMetric: endtimes don't match: %s , %s" % (tr2.stats.endtime, endtime))
+    for (tr, trace_id) in ((tr1, id1), (tr2, id2)):
+        if round(tr.stats.sampling_rate, 5) < 1:
+            raise Exception("transferFunctionMetric: %s has a sampling_rate < 1." % trace_id)
+
+    sr1 = int(np.round(tr1.stats.sampling_rate))
+    sr2 = int(np.round(tr2.stats.sampling_rate))
+    sampling_rate = min(sr1, sr2)
+    for sr in (sr1, sr2):
+        if sr > sampling_rate:
+            if sr % sampling_rate > 0:
+                raise Exception("transferFunctionMetric: sampling rates are not multiples of each other, %s , %s" % (id1, id2))
+            if round(sr / sampling_rate) > 10:
+                raise Exception("transferFunctionMetric: sampling rates differ by more than a factor of 10, %s , %s" % (id1, id2))
+
+    # Length of the primary channel after decimation
+    npts1 = int(math.ceil(tr1.stats.npts / round(sr1 / sampling_rate)))
+    truncatedLength = 2**int(math.floor(math.log(npts1, 2)))
+
+    X = _transferFunction_spectra(tr1, tr1.data, sampling_rate, truncatedLength, cache)
+    if mate is None:
+        Y = _transferFunction_spectra(tr2, tr2.data, sampling_rate, truncatedLength, cache)
+    else:
+        tr3 = mate.py_stream[0]
+        if tr3.stats.npts != tr2.stats.npts:
+            raise Exception("Incoming streams have different data lengths.")
+        (a, b) = (tr2, tr3)
+        if _rotate2D_swap(_azimuth(waveform2), _azimuth(mate)):
+            (a, b) = (b, a)
+        A = _transferFunction_spectra(a, a.data, sampling_rate, truncatedLength, cache)
+        B = _transferFunction_spectra(b, b.data, sampling_rate, truncatedLength, cache)
+        radians = angle * math.pi / 180
+        if component == 'R':
+            Y = math.cos(radians) * A + math.sin(radians) * B
+        else:
+            Y = -math.sin(radians) * A + math.cos(radians) * B
+
+    # IRISSeismic::crossSpectrum with spans=c(3,5), taper=0.1 and detrend=TRUE
+    N = truncatedLength // 4
+    Nspec = N // 2
+    positive = slice(1, Nspec + 1)
+    Pxx = _smooth_cross_spectrum(X, X, N, sampling_rate)[:, positive]
+    Pyy = _smooth_cross_spectrum(Y, Y, N, sampling_rate)[:, positive]
+    Pxy = _smooth_cross_spectrum(X, Y, N, sampling_rate)[:, positive]
+    coh = np.abs(Pxy)**2 / (Pxx.real * Pyy.real)
+    phase = np.angle(Pxy)
+
+    # Average of the 13 segments, where R also averages the frequencies
+    freq = sampling_rate / N + np.arange(Nspec) * (sampling_rate / N)
+    freqSum = np.zeros(Nspec)
+    for i in range(13):
+        freqSum += freq
+    freq = freqSum / 13
+
+    channel = tr1.stats.channel
+    if channel.startswith('L'):
+        loFreq = 0.001
+    elif channel.startswith('M'):
+        loFreq = 0.0025
+    else:
+        loFreq = 0.005
+    hiFreq = 0.5 * tr1.stats.sampling_rate
+    (binFreq, matrix) = McNamaraBins(freq, loFreq, hiFreq, 0.1)
+    (binPxx, binPxy, binPhase, binCoh) = [matrix.dot(x.sum(axis=0) / 13) for x in (Pxx, Pxy, phase, coh)]
+
+    dataAmp = np.abs(binPxy / binPxx)
+    dataPhase = binPhase * 180 / np.pi
+    indices = (1 / binFreq >= 5) & (1 / binFreq <= 7)
+    avgDataAmp = dataAmp[indices].mean()
+    avgDataPhase = dataPhase[indices].mean()
+    avgCoherence = binCoh[indices].mean()
+
+    respAmp = np.asarray(evalresp2.amp, dtype=np.float64) / np.asarray(evalresp1.amp, dtype=np.float64)
+    respPhase = np.asarray(evalresp1.phase, dtype=np.float64) - np.asarray(evalresp2.phase, dtype=np.float64)
+    respFreq = np.asarray(evalresp1.freq, dtype=np.float64)
+    indices = (1 / respFreq >= 5) & (1 / respFreq <= 7)
+    avgRespAmp = respAmp[indices].mean()
+    avgRespPhase = respPhase[indices].mean()
+
+    dataRespGainRatio = avgDataAmp / avgRespAmp
+    dataRespPhaseDiff = avgDataPhase - avgRespPhase
+    if abs(dataRespPhaseDiff) > 180:
+        dataRespPhaseDiff = 360 - dataRespPhaseDiff
+
+    locations = tr2.stats.location
+    if tr2.stats.location != tr1.stats.location:
+        locations = '%s:%s' % (locations, tr1.stats.location)
+    channels = '%s:%s' % (tr2.stats.channel[:-1], tr1.stats.channel)
+    snclq = '.'.join([tr1.stats.network, tr1.stats.station, locations, channels, tr1.stats.mseed.dataquality])
+
+    values = R_format_values([dataRespGainRatio, dataRespPhaseDiff, avgCoherence])
+    return general_value_df(waveform1, snclq, [['transfer_function'] + values],
+                            elementNames=('gain_ratio', 'phase_diff', 'ms_coherence'),
+                            starttime=starttime, endtime=endtime)
+
+
+#     Orientation metrics     -------------------------------------------------
+
+def DDT(data, demean=True, linear=True, taper=0.1):
+    """
+    NumPy version of IRISSeismic::DDT for one series or a 2-D array with one
+    series per row.
+    :param demean: Remove the mean.
+    :param linear: Remove the linear trend, which also removes the mean.
+    :param taper: Proportion of each end tapered by :func:`spec_taper`.
+    :return: float64 array.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if linear:
+        data = detrend(data)
+    elif demean:
+        data = data - np.nanmean(data, axis=-1)[..., np.newaxis]
+    if taper > 0:
+        data = data * spec_taper(data.shape[-1], taper)
+    return data
+
+
+def butterworth(data, sampling_rate, n, low=None, high=None, type='pass'):
+    """
+    NumPy version of IRISSeismic::butterworth for data that have already
+    been demeaned or detrended. As in IRISSeismic, the filter is applied
+    once in the forward direction by signal::filter.
+    :param data: One series or a 2-D array with one series per row.
+    :param sampling_rate: Sampling rate in Hz.
+    :param n: Filter order.
+    :param low: Low corner frequency in Hz.
+    :param high: High corner frequency in Hz.
+    :param type: 'low', 'high', 'pass' or 'stop'.
+    :return: Filtered float64 array.
+    """
+    from scipy import signal
+    norm = sampling_rate / 2
+    if type == 'low':
+        (b, a) = signal.butter(n, low / norm, btype='low')
+    elif type == 'high':
+        (b, a) = signal.butter(n, high / norm, btype='high')
+    else:
+        (b, a) = signal.butter(n, [low / norm, high / norm], btype={'pass': 'bandpass', 'stop': 'bandstop'}[type])
+    return signal.lfilter(b, a, np.asarray(data, dtype=np.float64), axis=-1)
+
+
+def hilbert(data):
+    """
+    NumPy version of IRISSeismic::hilbert, the imaginary part of the
+    analytic signal of data that are demeaned, detrended and 10% tapered.
+    :param data: One series or a 2-D array with one series per row.
+    :return: Hilbert transform of the data.
+    """
+    data = DDT(data, True, True, 0.1)
+    n = data.shape[-1]
+    # Weights of IRISSeismic::hilbertFFT, where the zero frequency weight is 2
+    h = np.zeros(n)
+    if n > 0:
+        h[:(n + 1) // 2] = 2
+        if n % 2 == 0:
+            h[n // 2] = 1
+    return np.fft.ifft(np.fft.fft(data, axis=-1) * h, axis=-1).imag
+
+
+def orientationPreprocess(dataN, dataE, dataZ, max_length, taper, filterArgs, sampling_rates):
+    """
+    Trim, detrend, taper and band pass filter the three channels used by
+    orientationCheck and take the Hilbert transform of the Z channel, as
+    IRISMustangUtils::generateMetrics_orientationCheck does with R.
+
+    Channels sharing a sampling rate are processed together as the rows of
+    a single array.
+    :param dataN: Data of the N or 1 channel.
+    :param dataE: Data of the E or 2 channel.
+    :param dataZ: Data of the Z channel.
+    :param max_length: Number of samples kept from the start of each channel.
+    :param taper: Proportion of each end tapered.
+    :param filterArgs: Butterworth [order, low, high] band pass arguments.
+    :param sampling_rates: Sampling rate of each channel.
+    :return: tuple of (N, E, Z, HZ) arrays.
+    """
+    data = np.vstack([np.asarray(x[:max_length], dtype=np.float64) for x in (dataN, dataE, dataZ)])
+    data = DDT(data, True, True, taper)
+    rates = np.asarray(sampling_rates, dtype=np.float64)
+    for rate in np.unique(rates):
+        rows = rates == rate
+        data[rows] = butterworth(data[rows], rate, filterArgs[0], filterArgs[1], filterArgs[2])
+    (N, E, Z) = data
+    return (N, E, Z, hilbert(Z))
+
+
+def _rotate2D_swap(azimuth1, azimuth2):
+    """
+    Return True when IRISSeismic::rotate2D exchanges its two horizontal
+    channels because the second one lags the first by up to 180 degrees.
+    """
+    if np.isnan(azimuth1) or np.isnan(azimuth2):
+        return False
+    azdiff = azimuth1 - azimuth2
+    if not ((87 < abs(azdiff) < 93) or (267 < abs(azdiff) < 273)):
+        raise Exception("Incoming streams are not orthogonal (+/- 3 degrees): azimuth1=%s; azimuth2=%s" %
+                        (azimuth1, azimuth2))
+    return 0 < azdiff <= 180
+
+
+def orientationScan(data1, data2, hilbertZ, azimuth1=np.nan, azimuth2=np.nan, degreeIncrement=1):
+    """
+    Correlate the Hilbert transform of the vertical channel with the radial
+    component of two horizontal channels rotated to every trial angle as in
+    IRISMustangUtils::generateMetrics_orientationCheck.
+
+    The radial component at angle a is cos(a)*N + sin(a)*E, as calculated
+    by IRISSeismic::rotate2D, so the zero lag correlations of every angle
+    follow from the dot products of N, E and H{Z}:
+
+    * Szr = cos(a)*(H.N) + sin(a)*(H.E)
+    * Srr = cos(a)^2*(N.N) + 2*cos(a)*sin(a)*(N.E) + sin(a)^2*(E.E)
+
+    :param data1: Filtered data of the N or 1 channel.
+    :param data2: Filtered data of the E or 2 channel.
+    :param hilbertZ: Hilbert transform of the filtered Z channel.
+    :param azimuth1: Metadata azimuth of the first channel.
+    :param azimuth2: Metadata azimuth of the second channel.
+    :param degreeIncrement: Spacing of trial angles in degrees, which run
+        from `degreeIncrement` to less than 360.
+    :return: tuple of (angles, Czr, C_zr) arrays with the correlation
+        coefficients Szr/sqrt(Szz*Srr) and Szr/Szz at each angle.
+    """
+    N = np.asarray(data1, dtype=np.float64)
+    E = np.asarray(data2, dtype=np.float64)
+    H = np.asarray(hilbertZ, dtype=np.float64)
+    if N.size != E.size:
+        raise Exception("Incoming streams have different data lengths.")
+    if _rotate2D_swap(azimuth1, azimuth2):
+        (N, E) = (E, N)
+
+    count = int(round(360.0 / degreeIncrement))
+    angles = np.round(np.arange(1, count) * degreeIncrement, 10)
+    radians = angles * np.pi / 180
+    (c, s) = (np.cos(radians), np.sin(radians))
+
+    Szz = np.dot(H, H)
+    Szr = c * np.dot(H, N) + s * np.dot(H, E)
+    Srr = c**2 * np.dot(N, N) + 2 * c * s * np.dot(N, E) + s**2 * np.dot(E, E)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Czr = Szr / np.sqrt(Szz * Srr)
+        C_zr = Szr / Szz
+    return (angles, Czr, C_zr)
+
+
+#     Business logic interface     --------------------------------------------
+
+# Metric functions with a NumPy implementation, by IRISMustangMetrics function name
+SIMPLE_METRICS = {'basicStats': basicStatsMetric,
+                  'gaps': gapsMetric,
+                  'stateOfHealth': stateOfHealthMetric,
+                  'numSpikes': spikesMetric,
+                  'STALTA': STALTAMetric,
+                  'SNR': SNRMetric}
+
+# Metric functions that only need trace headers and not sample values
+HEADER_METRICS = ['gaps', 'stateOfHealth']
+
+# All metric functions that may be named in the numpy_functions preference
+FUNCTIONS = sorted(SIMPLE_METRICS.keys()) + ['PSD', 'crossTalk', 'pressureCorrelation', 'crossCorrelation', 'transferFunction']
+
+
+def apply_simple_metric(waveform, metric_function_name, *args, **kwargs):
+    """
+    Invoke a named "simple" NumPy metric.
+
+    Arguments are the same as for :func:`~ispaq.irismustangmetrics.apply_simple_metric`
+    except that a :class:`~ispaq.concierge.Waveform` is passed instead of an R Stream.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :param metric_function_name: the name of the set of metrics
+    :return: pandas dataframe of metrics.
+    """
+    if waveform.py_stream is None:
+        raise Exception('%s: NumPy metrics require local waveform data' % metric_function_name)
+    function = SIMPLE_METRICS[metric_function_name]
+    return function(waveform, *args, **kwargs)
+
+
+def apply_PSD_metric(waveform, evalresp=None):
+    """
+    Invoke the NumPy PSDMetric.
+
+    Arguments are the same as for :func:`~ispaq.irismustangmetrics.apply_PSD_metric`
+    except that a :class:`~ispaq.concierge.Waveform` is passed instead of an R Stream.
+    :param waveform: :class:`~ispaq.concierge.Waveform` with local data.
+    :param evalresp: pandas dataframe of FAP from evalresp (freq,amp,phase)
+    :return: tuple of GeneralValueMetrics, corrected PSD, and PDF
+    """
+    if waveform.py_stream is None:
+        raise Exception('PSD: NumPy metrics require local waveform data')
+    return PSDMetric(waveform, evalresp=evalresp)
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(exclude_empty=True)
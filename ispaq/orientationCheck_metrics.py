@@ -10,6 +10,8 @@ ISPAQ Business Logic for Orientation Check Metrics.
 
 from __future__ import (absolute_import, division, print_function)
 
+import collections
+
 import numpy as np
 import pandas as pd
 
@@ -18,6 +20,7 @@ from .concierge import NoAvailableDataError
 from . import utils
 from . import irisseismic
 from . import irismustangmetrics
+from . import numpymetrics
 
 from obspy import UTCDateTime
 
@@ -35,6 +38,22 @@ def orientationCheck_metrics(concierge):
 
     TODO:  doctest examples
     """
+    return utils.finish_pass(orientationCheck_metrics_events(concierge))
+
+
+def orientationCheck_metrics_events(concierge):
+    """
+    Generate *orientationCheck* metrics one event at a time.
+
+    This generator yields the ``(halfHourStart, halfHourEnd)`` window around
+    each event before the metrics of that event are submitted and finally
+    yields the dataframe of orientationCheck metrics or None. It is run to
+    the end by :func:`orientationCheck_metrics` or advanced in step with
+    other event based business logic by :func:`~ispaq.ispaq.run_pass`.
+
+    :type concierge: :class:`~ispaq.concierge.Concierge`
+    :param concierge: Data access expediter.
+    """
     # Get the logger from the concierge
     logger = concierge.logger
         
@@ -49,12 +68,12 @@ def orientationCheck_metrics(concierge):
     windowSecsAfter = 600
     taper = 0.05
     filterArgs = [2,0.02,0.04]    
-    degreeIncrement = 1
+    degreeIncrement = 0.1
         
     # Sanity check for metadata
     if concierge.station_url is None:
         logger.warning('No station metadata found for orientationCheck metrics')
-        return None
+        return
 
     # Get the seismic events in this time period
     events = concierge.get_event(minmag=minmag)
@@ -62,7 +81,7 @@ def orientationCheck_metrics(concierge):
     # Sanity check
     if events is None or events.shape[0] == 0:
         logger.info('No events found for orientationCheck metrics.')
-        return None
+        return
         
     # Container for all of the metrics dataframes generated
     dataframes = []
@@ -73,8 +92,42 @@ def orientationCheck_metrics(concierge):
 
     logger.info('Calculating orientationCheck metrics for %d events' % events.shape[0])
 
+    # orientationCheck requires 3 channels, look for all 3 even if input SNCL pattern is for one (i.e., TA.109..BHZ will look for TA.109C..BH?)
+    sncl_patterns = concierge.get_component_sncl_patterns()
+
+    # Events whose jobs have not been gathered yet
+    pending_events = collections.deque()
+
+    def gather_event(jobs):
+        """
+        Gather the results of one event in the order the jobs were submitted.
+        """
+        for (sn_lId, job) in jobs:
+
+            # Periodically release R objects from previous stations
+            concierge.memory.tick()
+
+            try:
+                result = job.get()
+            except Exception as e:
+                result = e
+
+            if isinstance(result, Exception):
+                logger.warning('skipping %s: orientationCheck metric calculation failed:  %s' % (sn_lId, result))
+            elif isinstance(result, pd.DataFrame):
+                dataframes.append(result)
+            else:
+                logger.info(result)
+
     for (index, event) in events.iterrows():
 
+        # Window around the event used for metadata and data requests
+        halfHourStart = event.time - 60 * 2
+        halfHourEnd = event.time + 60 * 28
+
+        # Let a fused event pass bring other business logic to this event first
+        yield (halfHourStart, halfHourEnd)
+
         logger.info('%03d Magnitude %3.1f event: %s %sT%s:%s:%sZ' % (index, event.magnitude, event.eventLocationName, event.time.date, str(event.time.hour).zfill(2), str(event.time.minute).zfill(2), str(event.time.second).zfill(2)))
         
         # Sanity check
@@ -90,44 +143,22 @@ def orientationCheck_metrics(concierge):
         # Get the data availability around this event
         # NOTE:  Get availability from 2 minutes before event until 28 minutes after
         # Get the data availability using spatial search parameters
-        halfHourStart = event.time - 60 * 2
-        halfHourEnd = event.time + 60 * 28
-
         logger.debug("Looking for metadata from %s to %s" % (halfHourStart.strftime("%Y-%m-%dT%H:%M:%S"),halfHourEnd.strftime("%Y-%m-%dT%H:%M:%S")))
 
-        # crossCorrelation requires 3 channels, look for all 3 even if input SNCL pattern is for one (i.e., TA.109..BHZ will look for TA.109C..BH?)
-        original_sncl_patterns = concierge.sncl_patterns
-        new_sncl_patterns = []
-        UR=["temp0","temp1","temp2","temp3"]
-        for sncl_pattern in concierge.sncl_patterns:
-            UR[concierge.netOrder] = sncl_pattern.split('.')[concierge.netOrder]
-            UR[concierge.staOrder] = sncl_pattern.split('.')[concierge.staOrder]
-            UR[concierge.locOrder] = sncl_pattern.split('.')[concierge.locOrder]
-            UR[concierge.chanOrder] = sncl_pattern.split('.')[concierge.chanOrder]
-            if len(UR[concierge.chanOrder]) == 3:
-                UR[concierge.chanOrder]=UR[concierge.chanOrder][:-1] + '?'
-            new_sncl_pattern = ".".join(UR)
-            new_sncl_patterns.append(new_sncl_pattern)
-        concierge.sncl_patterns = new_sncl_patterns    
- 
         try:        
             availability = concierge.get_availability(starttime=halfHourStart, endtime=halfHourEnd,
                                                       longitude=event.longitude, latitude=event.latitude,
-                                                      minradius=eventMinradius, maxradius=eventMaxradius)
+                                                      minradius=eventMinradius, maxradius=eventMaxradius,
+                                                      sncl_patterns=sncl_patterns)
         except NoAvailableDataError as e:
             logger.info('Skipping event with no available data')
-            concierge.sncl_patterns = original_sncl_patterns
             continue
         except Exception as e:
             logger.warning('Skipping event because concierge.get_availability failed: %s' % (e))
-            concierge.sncl_patterns = original_sncl_patterns
             continue
         if availability is None:
             logger.info("Skipping event with no available data")
-            concierge.sncl_patterns = original_sncl_patterns
             continue
-
-        concierge.sncl_patterns = original_sncl_patterns
                     
         # Apply the channelFilter
         availability = availability[availability.channel.str.contains(channelFilter)]      
@@ -152,6 +183,9 @@ def orientationCheck_metrics(concierge):
         # Add sn_lId to the availability dataframe for easy detection
         availability.insert(availability.shape[1],'sn_lId',sn_lIds)
 
+        # Metric calculations are submitted to the executor and gathered in SN.L order
+        jobs = []
+
         # ----- All available SNCLs -------------------------------------------------
 
         for sn_lId in sorted(list(set(sn_lIds))):
@@ -178,7 +212,7 @@ def orientationCheck_metrics(concierge):
             ZChannel = sn_lAvailability[Z_mask].iloc[0]
     
             # Calculate various distances and surface travel time
-            distaz = irisseismic.getDistaz(event.latitude,event.longitude,ZChannel.latitude,ZChannel.longitude)
+            distaz = concierge.get_distaz(event.latitude,event.longitude,ZChannel.latitude,ZChannel.longitude)
     
             surfaceDistance = irisseismic.surfaceDistance(event.latitude,event.longitude,ZChannel.latitude,ZChannel.longitude)[0]
             surfaceTravelTime = surfaceDistance / 4.0 # km  / (km/sec)
@@ -201,8 +235,8 @@ def orientationCheck_metrics(concierge):
             logger.debug("Looking for data for %s, %s, %s from %s to %s" % (Channel_1.snclId, Channel_2.snclId, ZChannel.snclId, windowStart.strftime("%Y-%m-%dT%H:%M:%S"), windowEnd.strftime("%Y-%m-%dT%H:%M:%S")))
 
             try:
-                stN = concierge.get_dataselect(Channel_1.network, Channel_1.station, Channel_1.location, Channel_1.channel,
-                                               windowStart, windowEnd, inclusiveEnd=False)
+                stN = concierge.get_waveform(Channel_1.network, Channel_1.station, Channel_1.location, Channel_1.channel,
+                                            windowStart, windowEnd, inclusiveEnd=False)
             except Exception as e:
                 if str(e).lower().find('no data') > -1:
                     logger.info('No data available for %s' % (Channel_1.snclId[:-1]))
@@ -213,8 +247,8 @@ def orientationCheck_metrics(concierge):
                 continue
         
             try:
-                stE = concierge.get_dataselect(Channel_2.network, Channel_2.station, Channel_2.location, Channel_2.channel,
-                                               windowStart, windowEnd, inclusiveEnd=False)
+                stE = concierge.get_waveform(Channel_2.network, Channel_2.station, Channel_2.location, Channel_2.channel,
+                                            windowStart, windowEnd, inclusiveEnd=False)
             except Exception as e:
                 if str(e).lower().find('no data') > -1:
                     logger.info('No data available for %s' % (Channel_2.snclId[:-1]))
@@ -225,8 +259,8 @@ def orientationCheck_metrics(concierge):
                 continue
         
             try:
-                stZ = concierge.get_dataselect(ZChannel.network, ZChannel.station, ZChannel.location, ZChannel.channel,
-                                               windowStart, windowEnd, inclusiveEnd=False)
+                stZ = concierge.get_waveform(ZChannel.network, ZChannel.station, ZChannel.location, ZChannel.channel,
+                                            windowStart, windowEnd, inclusiveEnd=False)
             except Exception as e:
                 if str(e).lower().find('no data') > -1:
                     logger.info('No data available for %s' % (ZChannel.snclId[:-1]))
@@ -235,134 +269,162 @@ def orientationCheck_metrics(concierge):
                 else:
                     logger.info('No data available for %s from %s: %s' % (ZChannel.snclId, concierge.dataselect_url, e))
                 continue
-        
-        
-            # If metadata indicates reversed polarity (dip>0), invert the amplitudes 
-            if (ZChannel.dip > 0):
-                stZ = irisseismic.multiplyBy(stZ,-1)
-        
-            if len(utils.get_slot(stN,'traces')) > 1 or len(utils.get_slot(stE,'traces')) > 1 or len(utils.get_slot(stZ,'traces')) > 1:
-                logger.info('Skipping %s because it has gaps' % (sn_lId)) 
-                continue
-        
-            # complain if sample lengths differ by more than 1 sample
-            l1 = utils.get_slot(stN,'npts')
-            l2 = utils.get_slot(stE,'npts')
-            l3 = utils.get_slot(stZ,'npts')
-      
-            if( abs(l1 - l2) > 1  or abs(l1 - l3) > 1 ):
-                logger.info('Skipping %s because the number of data samples differs between channels. Incompatible lengths stN=%d, stE=%d, stZ=%d' % (sn_lId,l1,l2,l3))
-                continue
-            else:
-                max_length = min(l1, l2, l3)
-                
-                
-            # NOTE:  This next function captures a chunk of functionality that involves direct
-            # NOTE:  manipulation of individual slots in Stream objects.
-            # NOTE:  This requires some R knowledge and rpy2 trickery that doesn't belong in 
-            # NOTE:  the business logic python code.
- 
-            (stN, stE, stZ, HZ) = irisseismic.trim_taper_filter(stN, stE, stZ, max_length, taper, filterArgs)
-            
-            
-            #         For trial empirical BHN/BH1 channel azimuths X = 0 to 360 in degrees (X is bearing from N):
-            #             Rotate the two horizontal channels to find the radial component R
-            #                 (R is the vector sum of the 2 horizontal channels in the back azimuth direction)
-            #                 Assume BHE/BH2 is 90 degrees clockwise from BHN/BH1.
-            #             Calculate the cross-correlation of R and H{Z} at zero lag:
-            #                 Szr = sum(i): [R[t(i)] * H{Z[t(i)]}] where i = 1,...,N samples
-            #             Calculate the auto-correlations of R and H{Z} at zero lag:
-            #                 Szz = sum(i): [H{Z[t(i)]}^2] where i = 1,...,N samples
-            #                 Srr = sum(i): [R[t(i)]^2] where i = 1,...,N samples
-            #             Calculate and save 2 separate normalized correlation coefficients:
-            #                 a) Czr = Szr / sqrt(Szz*Srr)
-            #                 b) C*zr = Szr / Srr
-
-            # Prefill Szz as it doesn't depend on the angle
-            HZ_data = pd.Series(utils.get_slot(HZ,'data'))
-            SzzValue = sum(HZ_data * HZ_data)
-            Szz = pd.Series([SzzValue] * 360)
-            Szr = pd.Series([np.NaN] * 360)
-            Srr = pd.Series([np.NaN] * 360)
-
-            # Calculate correlations as a function of angle
-            rotateOK = True
-            for angle in range(1,360,degreeIncrement):
-                
-                #if angle % 10 == 0:
-                #    logger.debug('rotate2D angle = %d' % angle)
-                    
-                try:
-                    stR = irisseismic.rotate2D(stN, stE, angle)[0]
-                except Exception as e:
-                    logger.warning('skipping %s: irisseismic.rotate2D failed:  %s' % (sn_lId, e.message))
-                    rotateOK = False
-                    break
-                R_data = pd.Series(utils.get_slot(stR,'data'))
-                Srr[angle] = sum(R_data * R_data)
-                Szr[angle] = sum(HZ_data * R_data)
-                
-            # an error in the loop means we skip this SNL, go to next in loop
-            if not rotateOK:
-                continue
-                
-            # Normalized correlation coefficients
-            Czr = Szr / (Szz*Srr).pow(.5)
-            C_zr = Szr / Szz
-            
-            maxCzr = Czr.max(skipna=True)
-            maxC_zr = C_zr.max(skipna=True)
-        
-            angleAtMaxCzr = int( list(Czr[Czr == maxCzr].index)[0] )
-            angleAtMaxC_zr = int( list(C_zr[C_zr == maxC_zr].index)[0] )
-        
-            azimuth_R = angleAtMaxC_zr % 360
-            azimuth_T = (azimuth_R + 90) % 360
-
-            #         Find the orientation X with the maximum C*zr and:
-            #             report empirical X, X+90, 
-            #             report metadata azimuths for horizontal channels
-            #             report Czr & C*zr 
-            #             report start and end of data window
-            #
-            #
-            # REC Feb 2014 -- change the attribute names based on Mary Templeton's recommendations
-            #              -- also add an event magnitude attribute
-            # azimuth_R
-            # backAzimuth
-            # azimuth_Y_obs        (= backAzimuth - azimuth_R)
-            # azimuth_X_obs        (= azimuth_Y_obs + 90)
-            # azimuth_Y_meta       (azimuth_N renamed)
-            # azimuth_X_meta       (azimuth_E renamed)
-            # max_Czr
-            # max_C_zr
-            # magnitude
-        
-            azimuth_Y_obs = (float(distaz.backAzimuth) - azimuth_R) % 360
-            azimuth_X_obs = (azimuth_Y_obs + 90.0) % 360
-        
-            elementNames = ["azimuth_R","backAzimuth","azimuth_Y_obs","azimuth_X_obs","azimuth_Y_meta","azimuth_X_meta","max_Czr","max_C_zr","magnitude"]
-            elementValues = [azimuth_R, float(distaz.backAzimuth), azimuth_Y_obs, azimuth_X_obs,
-                               float(Channel_1.azimuth), float(Channel_2.azimuth), maxCzr, maxC_zr, float(event.magnitude)]
-
-            # Create metric
-            df = irisseismic.generalValueMetric(utils.get_slot(stZ, 'id'), windowStart, windowEnd,
-                                               'orientation_check', elementNames, elementValues)
-            dataframes.append(df)
+
+            job = concierge.executor.submit(_orientationCheck_metrics_job, sn_lId, (stN, stE, stZ), float(ZChannel.dip),
+                                            (float(Channel_1.azimuth), float(Channel_2.azimuth)), float(distaz.backAzimuth),
+                                            float(event.magnitude), windowStart, windowEnd, taper, filterArgs, degreeIncrement)
+            jobs.append((sn_lId, job))
                         
         # END of sn_lId loop
 
+        pending_events.append(jobs)
+
+        # NOTE:  Jobs of the next events are submitted before earlier events are gathered so that
+        # NOTE:  workers stay busy across events
+        while len(pending_events) > concierge.workers:
+            gather_event(pending_events.popleft())
+
     # END of event loop
 
+    while pending_events:
+        gather_event(pending_events.popleft())
+
     # Concatenate dataframes before returning ----------------------------------
     
     if len(dataframes) == 0:
         logger.warning('"orientation_check" metric calculation generated zero metrics')
-        return None
+        return
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         result.reset_index(drop=True, inplace=True)
-        return(result)
+        yield result
+
+
+def _orientationCheck_metrics_job(sn_lId, waveforms, dipZ, azimuths, backAzimuth, magnitude, windowStart, windowEnd,
+                                  taper, filterArgs, degreeIncrement):
+    """
+    Calculate the orientationCheck metric for the three channels of one SN.L.
+
+    This is submitted to the concierge executor and may run in a worker process.
+
+    :param sn_lId: Network.Station.Location.ChannelType identifier.
+    :param waveforms: N or 1, E or 2 and Z :class:`~ispaq.concierge.Waveform`.
+    :param dipZ: Metadata dip of the Z channel.
+    :param azimuths: Metadata azimuths of the N or 1 and E or 2 channels.
+    :param backAzimuth: Back azimuth from the station to the event.
+    :param magnitude: Event magnitude.
+    :param windowStart: ObsPy UTCDateTime of the start of the data window.
+    :param windowEnd: ObsPy UTCDateTime of the end of the data window.
+    :param taper: Cosine taper fraction.
+    :param filterArgs: Butterworth filter order, low and high frequencies.
+    :param degreeIncrement: Trial angle increment in degrees.
+
+    :return: Dataframe with the orientation_check metric or the reason the
+        SN.L was skipped.
+    """
+    try:
+        (stN, stE, stZ) = [_trace_data(waveform) for waveform in waveforms]
+    except Exception as e:
+        return 'No data available for %s: %s' % (sn_lId, e)
+
+    # If metadata indicates reversed polarity (dip>0), invert the amplitudes 
+    if (dipZ > 0):
+        stZ = stZ._replace(data=-1 * stZ.data)
+
+    if stN.traces > 1 or stE.traces > 1 or stZ.traces > 1:
+        return 'Skipping %s because it has gaps' % (sn_lId)
+
+    # complain if sample lengths differ by more than 1 sample
+    l1 = len(stN.data)
+    l2 = len(stE.data)
+    l3 = len(stZ.data)
+
+    if( abs(l1 - l2) > 1  or abs(l1 - l3) > 1 ):
+        return 'Skipping %s because the number of data samples differs between channels. Incompatible lengths stN=%d, stE=%d, stZ=%d' % (sn_lId,l1,l2,l3)
+    else:
+        max_length = min(l1, l2, l3)
+
+
+    # Trim, detrend, taper and filter all three channels and take the Hilbert transform of Z
+    (N, E, Z, HZ) = numpymetrics.orientationPreprocess(stN.data, stE.data, stZ.data, max_length, taper, filterArgs,
+                                                       (stN.sampling_rate, stE.sampling_rate, stZ.sampling_rate))
+
+
+    #         For trial empirical BHN/BH1 channel azimuths X = 0 to 360 in degrees (X is bearing from N):
+    #             Rotate the two horizontal channels to find the radial component R
+    #                 (R is the vector sum of the 2 horizontal channels in the back azimuth direction)
+    #                 Assume BHE/BH2 is 90 degrees clockwise from BHN/BH1.
+    #             Calculate the cross-correlation of R and H{Z} at zero lag:
+    #                 Szr = sum(i): [R[t(i)] * H{Z[t(i)]}] where i = 1,...,N samples
+    #             Calculate the auto-correlations of R and H{Z} at zero lag:
+    #                 Szz = sum(i): [H{Z[t(i)]}^2] where i = 1,...,N samples
+    #                 Srr = sum(i): [R[t(i)]^2] where i = 1,...,N samples
+    #             Calculate and save 2 separate normalized correlation coefficients:
+    #                 a) Czr = Szr / sqrt(Szz*Srr)
+    #                 b) C*zr = Szr / Srr
+
+    # All angles are evaluated at once from dot products of the three channels
+    (angles, Czr, C_zr) = numpymetrics.orientationScan(N, E, HZ, azimuths[0], azimuths[1], degreeIncrement)
+
+    if np.all(np.isnan(C_zr)):
+        return 'Skipping %s because correlations are undefined' % (sn_lId)
+
+    maxCzr = np.nanmax(Czr)
+    maxC_zr = np.nanmax(C_zr)
+
+    angleAtMaxC_zr = float(angles[np.nanargmax(C_zr)])
+
+    azimuth_R = angleAtMaxC_zr % 360
+    azimuth_T = (azimuth_R + 90) % 360
+
+    #         Find the orientation X with the maximum C*zr and:
+    #             report empirical X, X+90, 
+    #             report metadata azimuths for horizontal channels
+    #             report Czr & C*zr 
+    #             report start and end of data window
+    #
+    #
+    # REC Feb 2014 -- change the attribute names based on Mary Templeton's recommendations
+    #              -- also add an event magnitude attribute
+    # azimuth_R
+    # backAzimuth
+    # azimuth_Y_obs        (= backAzimuth - azimuth_R)
+    # azimuth_X_obs        (= azimuth_Y_obs + 90)
+    # azimuth_Y_meta       (azimuth_N renamed)
+    # azimuth_X_meta       (azimuth_E renamed)
+    # max_Czr
+    # max_C_zr
+    # magnitude
+
+    azimuth_Y_obs = (backAzimuth - azimuth_R) % 360
+    azimuth_X_obs = (azimuth_Y_obs + 90.0) % 360
+
+    elementNames = ["azimuth_R","backAzimuth","azimuth_Y_obs","azimuth_X_obs","azimuth_Y_meta","azimuth_X_meta","max_Czr","max_C_zr","magnitude"]
+    elementValues = [azimuth_R, backAzimuth, azimuth_Y_obs, azimuth_X_obs,
+                       azimuths[0], azimuths[1], maxCzr, maxC_zr, magnitude]
+
+    # Create metric
+    df = irisseismic.generalValueMetric(stZ.id, windowStart, windowEnd,
+                                       'orientation_check', elementNames, elementValues)
+    return df
+
+
+# Data of a single channel needed for orientationCheck
+TraceData = collections.namedtuple('TraceData', ['traces', 'id', 'sampling_rate', 'data'])
+
+
+def _trace_data(waveform):
+    """
+    Return the :class:`TraceData` of the first trace of a Waveform, reading
+    data from FDSN web services through an R Stream.
+    """
+    if waveform.py_stream is not None:
+        tr = waveform.py_stream[0]
+        return TraceData(len(waveform.py_stream), '%s.%s' % (tr.id, tr.stats.mseed.dataquality),
+                         tr.stats.sampling_rate, tr.data)
+    r_stream = waveform.R_Stream()
+    return TraceData(len(utils.get_slot(r_stream, 'traces')), utils.get_slot(r_stream, 'id'),
+                     utils.get_slot(r_stream, 'sampling_rate'), np.array(utils.get_slot(r_stream, 'data')))
 
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,204 @@
+"""
+ISPAQ PDF Histograms.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+
+A probability density function (PDF) of PSD power is a two dimensional
+histogram counting how many corrected PSDs fall in each 1 dB power bin at each
+PSD frequency. IRISSeismic::psdStatistics builds this histogram from scratch
+for every SNCL-day so a PDF covering a month or a year would require every PSD
+of the period to be calculated again.
+
+:class:`PDFHistogram` keeps the counts on a fixed grid of power bins instead.
+Histograms are updated incrementally from corrected PSDs, can be added together
+when they share the same frequencies and are saved in a compressed binary
+``.npz`` file. A long period PDF is then the sum of the stored daily histograms.
+
+Power bins are centered on whole decibels and closed on the right, exactly as
+in IRISSeismic::noiseMatrix2PdfMatrix, so a daily histogram reproduces the
+hits of the ``pdf_text`` output of IRISMustangMetrics::PSDMetric.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+
+import numpy as np
+import pandas as pd
+from obspy import UTCDateTime
+
+
+#     PDF histogram     --------------------------------------------------------
+
+class PDFHistogram(object):
+    """
+    Frequency by power bin histogram of corrected PSDs for one SNCL.
+
+    :type snclId: str
+    :param snclId: N.S.L.C identifier.
+    :type freq: numpy.ndarray
+    :param freq: PSD frequencies in Hz.
+    :type power_lo: int
+    :param power_lo: Center of the lowest power bin in dB.
+    :type power_hi: int
+    :param power_hi: Center of the highest power bin in dB. Power outside of
+        the range is not counted.
+    """
+    def __init__(self, snclId, freq, power_lo=-310, power_hi=55):
+        self.snclId = snclId
+        self.freq = np.asarray(freq, dtype=np.float64)
+        self.power_lo = int(power_lo)
+        self.power_hi = int(power_hi)
+        self.counts = np.zeros((self.freq.size, self.power_hi - self.power_lo + 1), dtype=np.int64)
+        self.starttime = None
+        self.endtime = None
+        self.psd_count = 0
+
+    @property
+    def power(self):
+        """
+        Centers of the power bins in dB.
+        """
+        return np.arange(self.power_lo, self.power_hi + 1, dtype=np.float64)
+
+    def _extend(self, starttime, endtime):
+        if starttime is not None and (self.starttime is None or starttime < self.starttime):
+            self.starttime = starttime
+        if endtime is not None and (self.endtime is None or endtime > self.endtime):
+            self.endtime = endtime
+
+    def update(self, noiseMatrix, starttime=None, endtime=None):
+        """
+        Add corrected PSDs to the histogram.
+        :param noiseMatrix: 2-D array of corrected PSD power in dB with one row
+            per PSD and one column per frequency. `NaN` values are ignored.
+        :param starttime: ObsPy UTCDateTime of the first PSD.
+        :param endtime: ObsPy UTCDateTime of the last PSD.
+        """
+        noiseMatrix = np.atleast_2d(np.asarray(noiseMatrix, dtype=np.float64))
+        if noiseMatrix.shape[1] != self.freq.size:
+            raise Exception('PDFHistogram: %d PSD frequencies do not match %d histogram frequencies' %
+                            (noiseMatrix.shape[1], self.freq.size))
+        valid = ~np.isnan(noiseMatrix)
+        # (center - 0.5, center + 0.5] belongs to the bin at center
+        centers = np.ceil(noiseMatrix[valid] - 0.5)
+        columns = np.nonzero(valid)[1]
+        # power outside of the bins is dropped, as in noiseMatrix2PdfMatrix
+        inside = (centers >= self.power_lo) & (centers <= self.power_hi)
+        bins = (centers[inside] - self.power_lo).astype(np.int64)
+        columns = columns[inside]
+        flat = np.bincount(columns * self.counts.shape[1] + bins, minlength=self.counts.size)
+        self.counts += flat.reshape(self.counts.shape)
+        self.psd_count += noiseMatrix.shape[0]
+        self._extend(starttime, endtime)
+
+    def update_from_df(self, PSDCorrected):
+        """
+        Add corrected PSDs from a dataframe as returned by ``apply_PSD_metric``.
+        :param PSDCorrected: pandas dataframe with starttime, endtime, freq and power columns.
+        """
+        power = np.asarray(PSDCorrected.power, dtype=np.float64)
+        if power.size % self.freq.size != 0:
+            raise Exception('PDFHistogram: %d PSD values do not fill rows of %d frequencies' %
+                            (power.size, self.freq.size))
+        noiseMatrix = power.reshape(-1, self.freq.size)
+        if not np.allclose(np.asarray(PSDCorrected.freq[:self.freq.size], dtype=np.float64), self.freq):
+            raise Exception('PDFHistogram: PSD frequencies do not match histogram frequencies for %s' % self.snclId)
+        starttime = UTCDateTime(pd.Timestamp(PSDCorrected.starttime.min()).to_pydatetime())
+        endtime = UTCDateTime(pd.Timestamp(PSDCorrected.endtime.max()).to_pydatetime())
+        self.update(noiseMatrix, starttime, endtime)
+
+    @classmethod
+    def from_df(cls, snclId, PSDCorrected, **kwargs):
+        """
+        Return a new histogram of the corrected PSDs in a dataframe.
+        """
+        nfreq = np.sum(PSDCorrected.starttime == PSDCorrected.starttime.iloc[0])
+        histogram = cls(snclId, np.asarray(PSDCorrected.freq[:nfreq], dtype=np.float64), **kwargs)
+        histogram.update_from_df(PSDCorrected)
+        return histogram
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram of the same SNCL and frequencies.
+        :return: This histogram.
+        """
+        if other.snclId != self.snclId:
+            raise Exception('PDFHistogram: cannot merge %s into %s' % (other.snclId, self.snclId))
+        if other.freq.size != self.freq.size or not np.allclose(other.freq, self.freq):
+            raise Exception('PDFHistogram: cannot merge histograms of %s with different frequencies' % self.snclId)
+        if (other.power_lo, other.power_hi) != (self.power_lo, self.power_hi):
+            raise Exception('PDFHistogram: cannot merge histograms of %s with different power bins' % self.snclId)
+        self.counts += other.counts
+        self.psd_count += other.psd_count
+        self._extend(other.starttime, other.endtime)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def to_df(self):
+        """
+        Return the non-empty bins in the layout of the ``PDF`` dataframe
+        returned by ``apply_PSD_metric``.
+        :return: pandas dataframe with freq, power and hits columns.
+        """
+        (rows, columns) = np.nonzero(self.counts)
+        return pd.DataFrame({'freq': self.freq[rows],
+                             'power': self.power[columns],
+                             'hits': self.counts[rows, columns]},
+                            columns=['freq', 'power', 'hits'])
+
+    def save(self, filepath):
+        """
+        Write the histogram to a compressed ``.npz`` file.
+        """
+        times = [t.isoformat() if t is not None else '' for t in (self.starttime, self.endtime)]
+        # Counts rarely exceed a few thousand per bin so the smallest integer type is used
+        dtype = np.uint16 if self.counts.max() < 2**16 else np.uint32
+        with open(filepath, 'wb') as f:
+            np.savez_compressed(f, snclId=np.array(self.snclId), freq=self.freq,
+                                power_range=np.array([self.power_lo, self.power_hi]),
+                                counts=self.counts.astype(dtype), times=np.array(times),
+                                psd_count=np.array(self.psd_count))
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Read a histogram written by :meth:`save`.
+        """
+        with np.load(filepath) as npz:
+            (power_lo, power_hi) = npz['power_range']
+            histogram = cls(str(npz['snclId']), npz['freq'], power_lo, power_hi)
+            histogram.counts += npz['counts'].astype(np.int64)
+            histogram.psd_count = int(npz['psd_count'])
+            (starttime, endtime) = [UTCDateTime(str(t)) if str(t) else None for t in npz['times']]
+        histogram._extend(starttime, endtime)
+        return histogram
+
+
+def merge_files(filepaths):
+    """
+    Return the sum of the histograms saved in several files.
+    :param filepaths: List of ``.npz`` files written by :meth:`PDFHistogram.save`.
+    :return: :class:`PDFHistogram`
+    """
+    histogram = None
+    for filepath in filepaths:
+        if histogram is None:
+            histogram = PDFHistogram.load(filepath)
+        else:
+            histogram.merge(PDFHistogram.load(filepath))
+    if histogram is None:
+        raise Exception('merge_files: no PDF histogram files')
+    return histogram
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(exclude_empty=True)
@@ -10,6 +10,7 @@ ISPAQ Business Logic for Simple Metrics.
 
 from __future__ import (absolute_import, division, print_function)
 
+import collections
 import pandas as pd
 
 from obspy import UTCDateTime
@@ -17,6 +18,7 @@ from obspy import UTCDateTime
 from . import utils
 from . import irisseismic
 from . import irismustangmetrics
+from . import numpymetrics
 
 
 def pressureCorrelation_metrics(concierge):
@@ -33,6 +35,22 @@ def pressureCorrelation_metrics(concierge):
 
     TODO:  doctest examples
     """
+    return utils.finish_pass(pressureCorrelation_metrics_days(concierge))
+
+
+def pressureCorrelation_metrics_days(concierge):
+    """
+    Generate *pressureCorrelation* metrics one day at a time.
+
+    This generator yields the ``(starttime, endtime)`` window of each day
+    before the metrics of that day are submitted and finally yields the
+    dataframe of pressureCorrelation metrics or None. It is run to the end
+    by :func:`pressureCorrelation_metrics` or advanced in step with other
+    day based business logic by :func:`~ispaq.ispaq.run_pass`.
+
+    :type concierge: :class:`~ispaq.concierge.Concierge`
+    :param concierge: Data access expediter.
+    """
     # Get the logger from the concierge
     logger = concierge.logger
     
@@ -61,21 +79,50 @@ def pressureCorrelation_metrics(concierge):
             raise
         except Exception as e:
             logger.error("concierge.get_availability() failed: '%s'" % e)
-            return None
+            return
 
-    for day in range(nday):
-        starttime = (start + day * 86400)
-        starttime = UTCDateTime(starttime.strftime("%Y-%m-%d") +"T00:00:00Z")
-        endtime = starttime + 86400
+    # Day-sized work units and the days whose jobs have not been gathered yet
+    days = concierge.day_windows()
+    pending_days = collections.deque()
 
-        if starttime == end:
-            continue
+    def gather_day(day, starttime, jobs):
+        """
+        Gather the results of one day in the order the jobs were submitted.
+        """
+        for (pAv, snclIds, job) in jobs:
+
+            # Periodically release R objects from previous SNCLs
+            concierge.memory.tick()
+
+            # Merge traces -- gracefully go to next in loop if an error reported
+            try:
+                results = job.get()
+            except Exception as e:
+                logger.debug("%s" % (e))
+                continue
+
+            for (snclId, result) in zip(snclIds, results):
+                if result is None:
+                    logger.debug('Unable to merge traces for %s' % (snclId))
+                elif isinstance(result, Exception):
+                    logger.warning('"pressure_effects" metric calculation failed for %s:%s: %s' % (pAv.snclId, snclId, result))
+                else:
+                    dataframes.append(result)
+
+        # Release this day's R objects and report memory use
+        concierge.memory.log_usage('pressureCorrelation metrics on %s' % starttime.date)
+        logger.info('Finished pressureCorrelation metrics on %s, day %d of %d' % (starttime.date, day + 1, len(days)))
+
+    for (day, (starttime, endtime)) in enumerate(days):
+
+        # Let a fused day pass bring other business logic to this day first
+        yield (starttime, endtime)
 
         try:
             pressureAvailability = concierge.get_availability(location=pressureLocation, channel=pressureChannel,starttime=starttime,endtime=endtime)
         except Exception as e:
             logger.error('Metric calculation failed because concierge.get_availability failed: %s' % (e))
-            return None
+            return
     
         if pressureAvailability is None or pressureAvailability.shape[0] == 0:
             logger.info('No pressure channels available')
@@ -83,16 +130,19 @@ def pressureCorrelation_metrics(concierge):
         else:
             logger.info('Calculating pressureCorrelation metrics for %d SNCLs on %s' % (pressureAvailability.shape[0], str(starttime).split('T')[0]))
    
+        # Metric calculations are submitted to the executor and gathered in SNCL order
+        jobs = []
  
         # Loop over rows of the availability dataframe
         for (pIndex, pAv) in pressureAvailability.iterrows():
         
             logger.info('%03d Calculating pressureCorrelation metric for %s' % (pIndex, pAv.snclId))
-        
+
             # Get the data ----------------------------------------------
 
             try:
-                r_pStream = concierge.get_dataselect(pAv.network, pAv.station, pAv.location, pAv.channel, starttime, endtime, inclusiveEnd=False)
+                pWaveform = concierge.get_waveform(pAv.network, pAv.station, pAv.location, pAv.channel, starttime, endtime, inclusiveEnd=False)
+                use_numpy = 'pressureCorrelation' in concierge.numpy_functions and pWaveform.py_stream is not None
             except Exception as e:
                 if str(e).lower().find('no data') > -1:
                     logger.info('No data available for %s' % (pAv.snclId))
@@ -102,12 +152,9 @@ def pressureCorrelation_metrics(concierge):
                     logger.warning('No data available for %s from %s: %s' % (pAv.snclId, concierge.dataselect_url, e))
                 continue
 
-            # Merge traces -- gracefully go to next in loop if an error reported
-            try:
-                r_pStream = irisseismic.mergeTraces(r_pStream)
-            except Exception as e:
-                logger.debug("%s" % (e))
-                continue
+            # Every seismic channel is correlated with the pressure channel in one job
+            waveforms = []
+            snclIds = []
 
             # Get all desired seismic channels for this network-station
             seismicAvailability = concierge.get_availability(pAv.network, pAv.station)
@@ -145,7 +192,7 @@ def pressureCorrelation_metrics(concierge):
                 # Loop over rows of the availability dataframe
                 for (index, lAv) in locationAvailability.iterrows():
                     try:
-                        r_stream = concierge.get_dataselect(lAv.network, lAv.station, lAv.location, lAv.channel, starttime, endtime,inclusiveEnd=False)
+                        waveform = concierge.get_waveform(lAv.network, lAv.station, lAv.location, lAv.channel, starttime, endtime,inclusiveEnd=False)
                     except Exception as e:
                         if str(e).lower().find('no data') > -1:
                             logger.debug('No data available for %s' % (lAv.snclId))
@@ -154,39 +201,97 @@ def pressureCorrelation_metrics(concierge):
                         else:
                             logger.warning('No data available for %s from %s: %s' % (lAv.snclId, concierge.dataselect_url, e))
                         continue
+
+                    waveforms.append(waveform)
+                    snclIds.append(lAv.snclId)
                 
-                    # Merge traces -- gracefully go to next in loop if an error reported
-                    try:
-                        r_stream = irisseismic.mergeTraces(r_stream)
-                    except Exception as e:
-                        logger.debug("%s" % (e))
-                        continue
-                
-                    logger.debug('Calculating pressureCorrelation metrics for %s:%s on %s' % (pAv.snclId, lAv.snclId,starttime.date))
-                    try:
-                        df = irismustangmetrics.apply_correlation_metric(r_pStream, r_stream, 'correlation')
-                        dataframes.append(df)
-                    except Exception as e:
-                        logger.warning('"pressure_effects" metric calculation failed for %s:%s: %s' % (pAv.snclId, lAv.snclId, e))              
                 # End of locationAvailability loop
     
             # End of locations loop
+
+            if len(waveforms) > 0:
+                logger.debug('Calculating pressureCorrelation metrics for %s and %d seismic channels on %s' % (pAv.snclId, len(waveforms), starttime.date))
+                job = concierge.executor.submit(_pressureCorrelation_metrics_job, pWaveform, waveforms, use_numpy)
+                jobs.append((pAv, snclIds, job))
     
         # End of pressureAvailability loop	
 
+        pending_days.append((day, starttime, jobs))
+
+        # NOTE:  Jobs of the next days are submitted before earlier days are gathered so that
+        # NOTE:  workers stay busy across day boundaries
+        while len(pending_days) > concierge.workers:
+            gather_day(*pending_days.popleft())
+
     # End of day loop
 
+    # Gather results of the remaining days -------------------------------
+
+    while pending_days:
+        gather_day(*pending_days.popleft())
+
     # Concatenate and filter dataframes before returning -----------------------
 
     if len(dataframes) == 0:
         logger.warning('"pressure_correlation" metric calculation generated zero metrics')
-        return None
+        return
     else:
         result = pd.concat(dataframes, ignore_index=True) 
         # Change metricName to "pressure_effects"
         result['metricName'] = 'pressure_effects'
         result.reset_index(drop=True, inplace=True)        
-        return(result)
+        yield result
+
+
+def _pressureCorrelation_metrics_job(pWaveform, waveforms, use_numpy):
+    """
+    Correlate a pressure channel with seismic channels at the same station.
+
+    This is submitted to the concierge executor and may run in a worker process.
+
+    :type pWaveform: :class:`~ispaq.concierge.Waveform`
+    :param pWaveform: Pressure channel.
+    :param waveforms: List of :class:`~ispaq.concierge.Waveform` seismic channels.
+    :param use_numpy: Calculate with :mod:`~ispaq.numpymetrics` instead of R.
+
+    :rtype: list
+    :return: A dataframe with the correlation metric, the exception raised by
+        the metric function or `None` if the traces could not be merged, for
+        each seismic channel. Raises an exception if the traces of the
+        pressure channel cannot be merged.
+    """
+    results = [None] * len(waveforms)
+
+    if use_numpy:
+        # With NumPy, every seismic channel is correlated with the pressure channel at once
+        merged_waveforms = [pWaveform]
+        merged = [numpymetrics.mergeTraces(pWaveform, fillMethod='fillNA')[1]]
+        positions = []
+        for (k, waveform) in enumerate(waveforms):
+            try:
+                merged.append(numpymetrics.mergeTraces(waveform, fillMethod='fillNA')[1])
+            except Exception as e:
+                continue
+            merged_waveforms.append(waveform)
+            positions.append(k)
+        pairs = [(0, k) for k in range(1, len(merged_waveforms))]
+        batch = numpymetrics.correlationMetric_batch(merged_waveforms, pairs, data=merged)
+        for (k, result) in zip(positions, batch):
+            results[k] = result
+
+    else:
+        r_pStream = irisseismic.mergeTraces(pWaveform.R_Stream())
+        for (k, waveform) in enumerate(waveforms):
+            try:
+                r_stream = irisseismic.mergeTraces(waveform.R_Stream())
+            except Exception as e:
+                continue
+            try:
+                results[k] = irismustangmetrics.apply_correlation_metric(r_pStream, r_stream, 'correlation')
+            except Exception as e:
+                results[k] = e
+
+    return results
 
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Python module providing lazy access to the embedded R session.
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+
+Importing ``rpy2.robjects`` starts an embedded R interpreter and evaluating
+``robjects.r('IRISSeismic::slice')`` loads the IRISSeismic namespace. Doing
+this when ISPAQ modules are imported means that ``--help``, ``--list-metrics``
+and metrics that never call R all pay for a full R start.
+
+Modules that wrap R packages get their rpy2 modules from here instead:
+
+    from .rsession import robjects, rinterface, pandas2ri, RFunction
+
+    _R_slice = RFunction('IRISSeismic::slice')
+
+``robjects``, ``rinterface`` and ``pandas2ri`` are proxies that start R the
+first time one of their attributes is used. :class:`RFunction` handles are
+only looked up in R the first time they are called. Global R options are
+registered with :func:`on_initialize` and evaluated as soon as R starts.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+
+import importlib
+
+
+# IRIS R packages used by ISPAQ
+IRIS_PACKAGES = ['seismicRoll', 'IRISSeismic', 'IRISMustangMetrics']
+
+# R commands evaluated when R starts
+_startup_commands = []
+
+_robjects = None
+
+
+def on_initialize(cmd):
+    """
+    Evaluate an R command when R is started, or right away if R is running.
+    :param cmd: R command (string).
+    """
+    if _robjects is None:
+        _startup_commands.append(cmd)
+    else:
+        _robjects.r(cmd)
+
+
+def initialize():
+    """
+    Start the embedded R session if it is not already running.
+    :return: The ``rpy2.robjects`` module.
+    """
+    global _robjects
+    if _robjects is None:
+        from rpy2 import robjects
+        for cmd in _startup_commands:
+            robjects.r(cmd)
+        _robjects = robjects
+    return _robjects
+
+
+def is_initialized():
+    """
+    Return ``True`` if the embedded R session has been started.
+    """
+    return _robjects is not None
+
+
+def load_packages():
+    """
+    Start R and load the namespaces of all IRIS R packages.
+
+    Used by worker processes that should pay for package loading once, up
+    front, rather than inside their first job.
+    """
+    robjects = initialize()
+    for package in IRIS_PACKAGES:
+        robjects.r('invisible(loadNamespace("%s"))' % package)
+
+
+class LazyModule(object):
+    """
+    Proxy for an rpy2 module that starts R on first attribute access.
+    :param name: Full name of the module, e.g. ``'rpy2.robjects'``.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            initialize()
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<LazyModule %s>' % self._name
+
+
+class RFunction(object):
+    """
+    Handle to an R function that is only looked up in R when first called.
+    :param expression: R expression returning the function, e.g.
+        ``'IRISSeismic::slice'``.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self._function = None
+
+    def __call__(self, *args, **kwargs):
+        if self._function is None:
+            self._function = initialize().r(self.expression)
+        return self._function(*args, **kwargs)
+
+    def __repr__(self):
+        return '<RFunction %s>' % self.expression
+
+
+robjects = LazyModule('rpy2.robjects')
+rinterface = LazyModule('rpy2.rinterface')
+pandas2ri = LazyModule('rpy2.robjects.pandas2ri')
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(exclude_empty=True)
@@ -0,0 +1,129 @@
+"""
+#
+# test_import_time -- check that importing ISPAQ modules is fast and does not start R
+#
+# Each module is imported in a fresh python process. The test fails if any
+# import takes longer than the budget or leaves an embedded R session running.
+# A header only simple metrics job on a synthetic day, followed by the
+# garbage collection done after each SNCL and day, must not start R either.
+#
+# run this as a package from the root ispaq directory:
+# python -m ispaq.scripts.test_import_time <options>
+# options:    --budget <seconds>
+#
+# example call, showing the defaults:
+# python -m ispaq.scripts.test_import_time --budget=3.0
+#
+"""
+from __future__ import print_function
+
+import sys
+import argparse
+import subprocess
+
+# Modules that wrap R packages plus the modules that import them on every run
+MODULES = ['ispaq.rsession',
+           'ispaq.irisseismic',
+           'ispaq.irismustangmetrics',
+           'ispaq.updater',
+           'ispaq.utils',
+           'ispaq.concierge',
+           'ispaq.ispaq']
+
+# Code run in each child process, prints "<seconds> <R started>"
+CODE = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print('%%f %%s' %% (elapsed, 'rpy2.robjects' in sys.modules))
+"""
+
+# Code run in a child process, prints "<failed metrics> <R started>"
+HEADONLY_CODE = """
+import logging
+import obspy
+from ispaq import rsession, utils
+from ispaq.concierge import Waveform
+from ispaq.simple_metrics import _simple_metrics_job
+logging.basicConfig(level=logging.WARNING)
+starttime = obspy.UTCDateTime('2013-01-05')
+tr = obspy.Trace(header={'network': 'XX', 'station': 'SYN', 'location': '00', 'channel': 'BHZ',
+                         'sampling_rate': 40.0, 'starttime': starttime, 'mseed': {'dataquality': 'M'}})
+tr.stats.npts = 40 * 86400
+trace_info = {'act_flags': [0] * 8, 'io_flags': [0] * 8, 'dq_flags': [0] * 8, 'timing_qual': None}
+waveform = Waveform('XX.SYN.00.BHZ', starttime, starttime + 86400, py_stream=obspy.Stream([tr]),
+                    trace_info=trace_info, headonly=True)
+calls = [('gaps', (), {}), ('stateOfHealth', (), {})]
+results = _simple_metrics_job(waveform, calls, numpy_functions=['gaps', 'stateOfHealth'])
+memory = utils.MemoryManager(gc_interval=1, logger=logging.getLogger('test_import_time'))
+memory.tick()
+memory.log_usage('synthetic day')
+print('%d %s' % (len([r for r in results if isinstance(r, Exception)]), rsession.is_initialized()))
+"""
+
+
+def headonly_run():
+    """
+    Run a header only simple metrics job in a child process and return a
+    list of problems.
+    """
+    try:
+        output = subprocess.check_output([sys.executable, '-c', HEADONLY_CODE])
+    except subprocess.CalledProcessError as e:
+        return ['job failed with status %d' % e.returncode]
+    (failed, r_started) = output.split()[-2:]
+    errors = []
+    if int(failed) > 0:
+        errors.append('%s metric functions failed' % int(failed))
+    if r_started == b'True' or r_started == 'True':
+        errors.append('R was started')
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', action='store', type=float, default=3.0,
+                        help='maximum seconds allowed to import each module')
+    args = parser.parse_args(sys.argv[1:])
+
+    print("Import time budget %.2f seconds" % args.budget)
+
+    failures = 0
+    for module in MODULES:
+        try:
+            output = subprocess.check_output([sys.executable, '-c', CODE % module])
+        except subprocess.CalledProcessError as e:
+            print("FAIL  %-28s import failed with status %d" % (module, e.returncode))
+            failures += 1
+            continue
+
+        (elapsed, r_started) = output.split()[-2:]
+        elapsed = float(elapsed)
+        r_started = (r_started == b'True' or r_started == 'True')
+
+        if r_started:
+            status = 'FAIL'
+            reason = 'R was started'
+        elif elapsed > args.budget:
+            status = 'FAIL'
+            reason = 'over budget'
+        else:
+            status = 'ok'
+            reason = ''
+        if status == 'FAIL':
+            failures += 1
+        print("%-4s  %-28s %6.3f s  %s" % (status, module, elapsed, reason))
+
+    errors = headonly_run()
+    print("%-4s  %-28s %s" % ('FAIL' if errors else 'ok', 'header only simple metrics', ', '.join(errors)))
+
+    if failures or errors:
+        print("%d of %d imports and %d header only runs failed" % (failures, len(MODULES), len(errors) > 0))
+        sys.exit(1)
+    else:
+        print("All imports within budget and header only metrics without starting R")
+
+
+if __name__ == "__main__":
+    main()
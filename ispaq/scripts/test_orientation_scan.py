@@ -0,0 +1,173 @@
+"""
+#
+# test_orientation_scan -- check the closed form orientation scan against the R rotate2D loop
+#
+# Three synthetic channels are created from a Rayleigh wave arriving from a
+# known back azimuth with the horizontal channels misoriented by a known angle.
+# Correlations from numpymetrics.orientationScan at every whole degree are
+# compared with those calculated from IRISSeismic::rotate2D at each angle as
+# orientationCheck_metrics used to do. The test also checks that the scan on
+# the --increment grid recovers the radial direction to within one increment
+# and that numpymetrics.orientationPreprocess reproduces the R trim, taper,
+# filter and Hilbert transform steps of irisseismic.trim_taper_filter.
+#
+# run this as a package from the root ispaq directory:
+# python -m ispaq.scripts.test_orientation_scan <options>
+# options:    --increment <degrees>
+#             --rtol <relative tolerance>
+#             --no-R
+#
+# example call, showing the defaults:
+# python -m ispaq.scripts.test_orientation_scan --increment=0.1 --rtol=1e-9
+#
+"""
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import obspy
+
+from ispaq import numpymetrics
+
+# Direction of the radial component measured clockwise from the N channel
+RADIAL_ANGLE = 123.4
+
+
+def synthetic_channels(npts=6000, sampling_rate=1.0, seed=2013):
+    """
+    Return N, E and Hilbert transformed Z data of a noisy 30 s Rayleigh wave.
+    """
+    random = np.random.RandomState(seed)
+    t = np.arange(npts) / sampling_rate
+    envelope = np.exp(-((t - npts / sampling_rate / 2) / 600.0)**2)
+    radial = envelope * np.sin(2 * np.pi * t / 30.0)
+    # H{Z} of a retrograde Rayleigh wave is in phase with the radial motion
+    hilbertZ = radial + random.normal(0, 0.05, npts)
+    radians = RADIAL_ANGLE * np.pi / 180
+    N = np.cos(radians) * radial + random.normal(0, 0.05, npts)
+    E = np.sin(radians) * radial + random.normal(0, 0.05, npts)
+    return (N, E, hilbertZ)
+
+
+def R_streams(channels):
+    """
+    Return IRISSeismic Streams for a list of (channel, data, azimuth) tuples.
+    """
+    from ispaq import irisseismic
+    streams = []
+    for (channel, data, azimuth) in channels:
+        header = {'network': 'XX', 'station': 'SYN', 'location': '00', 'channel': channel,
+                  'sampling_rate': 1.0, 'starttime': obspy.UTCDateTime('2013-01-05'),
+                  'mseed': {'dataquality': 'M'}}
+        py_stream = obspy.Stream([obspy.Trace(data=data, header=header)])
+        streams.append(irisseismic.R_Stream(py_stream, azimuth=azimuth))
+    return streams
+
+
+def R_scan(N, E, hilbertZ):
+    """
+    Return correlations at angles 1 to 359 calculated with IRISSeismic::rotate2D.
+    """
+    from ispaq import irisseismic
+    from ispaq import utils
+    streams = R_streams([('BHN', N, 0.0), ('BHE', E, 90.0)])
+    Szz = np.sum(hilbertZ * hilbertZ)
+    (Czr, C_zr) = ([], [])
+    for angle in range(1, 360):
+        R_data = np.array(utils.get_slot(irisseismic.rotate2D(streams[0], streams[1], angle)[0], 'data'))
+        Srr = np.sum(R_data * R_data)
+        Szr = np.sum(hilbertZ * R_data)
+        Czr.append(Szr / np.sqrt(Szz * Srr))
+        C_zr.append(Szr / Szz)
+    return (np.arange(1, 360), np.array(Czr), np.array(C_zr))
+
+
+def compare_preprocess(N, E, Z, rtol):
+    """
+    Compare NumPy and R preprocessing of raw channels and return a list of differences.
+    """
+    from ispaq import irisseismic
+    from ispaq import utils
+    (max_length, taper, filterArgs) = (N.size - 1, 0.05, [2, 0.02, 0.04])
+    (stN, stE, stZ) = R_streams([('BHN', N, 0.0), ('BHE', E, 90.0), ('BHZ', Z, 0.0)])
+    R_data = irisseismic.trim_taper_filter(stN, stE, stZ, max_length, taper, filterArgs)
+    np_data = numpymetrics.orientationPreprocess(N, E, Z, max_length, taper, filterArgs, (1.0, 1.0, 1.0))
+    errors = []
+    for (name, r_object, data) in zip(['N', 'E', 'Z', 'HZ'], R_data, np_data):
+        r_values = np.array(utils.get_slot(r_object, 'data'))
+        if not np.allclose(r_values, data, rtol=rtol, atol=rtol * np.abs(r_values).max()):
+            errors.append('%s differs by up to %g' % (name, np.max(np.abs(r_values - data))))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--increment', action='store', type=float, default=0.1,
+                        help='trial angle increment in degrees for the fine scan')
+    parser.add_argument('--rtol', action='store', type=float, default=1e-9,
+                        help='relative tolerance')
+    parser.add_argument('--no-R', dest='use_R', action='store_false', default=True,
+                        help='compare with a NumPy rotation loop instead of R')
+    args = parser.parse_args(sys.argv[1:])
+
+    (N, E, hilbertZ) = synthetic_channels()
+    failures = 0
+
+    start = time.time()
+    if args.use_R:
+        (loop_angles, loop_Czr, loop_C_zr) = R_scan(N, E, hilbertZ)
+    else:
+        loop_angles = np.arange(1, 360)
+        radians = loop_angles * np.pi / 180
+        R_data = [np.cos(a) * N + np.sin(a) * E for a in radians]
+        Szz = np.sum(hilbertZ * hilbertZ)
+        loop_Czr = np.array([np.sum(hilbertZ * R) / np.sqrt(Szz * np.sum(R * R)) for R in R_data])
+        loop_C_zr = np.array([np.sum(hilbertZ * R) / Szz for R in R_data])
+    loop_elapsed = time.time() - start
+
+    start = time.time()
+    (angles, Czr, C_zr) = numpymetrics.orientationScan(N, E, hilbertZ, 0.0, 90.0, 1)
+    scan_elapsed = time.time() - start
+
+    errors = []
+    if not np.array_equal(angles, loop_angles):
+        errors.append('angles differ')
+    elif not (np.allclose(Czr, loop_Czr, rtol=args.rtol, atol=0) and np.allclose(C_zr, loop_C_zr, rtol=args.rtol, atol=0)):
+        errors.append('correlations differ by up to %g' % np.max(np.abs(np.concatenate([Czr - loop_Czr, C_zr - loop_C_zr]))))
+    elif np.argmax(C_zr) != np.argmax(loop_C_zr):
+        errors.append('angle at max C_zr %s != %s' % (angles[np.argmax(C_zr)], loop_angles[np.argmax(loop_C_zr)]))
+    print("%-4s  1 degree scan  loop %7.3f s  closed form %7.4f s" %
+          ('FAIL' if errors else 'ok', loop_elapsed, scan_elapsed))
+    for error in errors:
+        print("        %s" % error)
+    failures += len(errors) > 0
+
+    start = time.time()
+    (angles, Czr, C_zr) = numpymetrics.orientationScan(N, E, hilbertZ, 0.0, 90.0, args.increment)
+    scan_elapsed = time.time() - start
+    azimuth_R = angles[np.argmax(C_zr)]
+    ok = abs(azimuth_R - RADIAL_ANGLE) <= args.increment
+    print("%-4s  %g degree scan  azimuth_R %.3f (expected %.3f)  closed form %7.4f s" %
+          ('ok' if ok else 'FAIL', args.increment, azimuth_R, RADIAL_ANGLE, scan_elapsed))
+    failures += not ok
+
+    if args.use_R:
+        (N, E, hilbertZ) = synthetic_channels()
+        errors = compare_preprocess(N, E, np.cumsum(hilbertZ), args.rtol)
+        print("%-4s  trim, taper, filter and Hilbert transform" % ('FAIL' if errors else 'ok'))
+        for error in errors:
+            print("        %s" % error)
+        failures += len(errors) > 0
+
+    if failures:
+        print("%d orientation scans failed" % failures)
+        sys.exit(1)
+    else:
+        print("Orientation scans match")
+
+
+if __name__ == "__main__":
+    main()
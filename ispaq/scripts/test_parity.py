@@ -0,0 +1,335 @@
+"""
+#
+# test_parity -- check that NumPy metric functions reproduce the R metric functions
+#
+# Each metric function in ispaq.numpymetrics is run on a local miniSEED file
+# with both the R and NumPy implementations. The test fails if any metric
+# differs by more than the tolerance and reports the speedup of each NumPy
+# metric function over R. By default every metric function with both an R
+# and a NumPy engine in ispaq.engines is compared. With --synthetic, a day of
+# random noise with injected spikes is used instead of the file. State-of-health
+# flags are counted from the record headers of the file. PSD metrics are compared
+# using a flat instrument response so that no web service is needed and the
+# correlation and cross-correlation metrics are compared using a noisy copy of
+# the data as a second channel. The transfer function metric also uses a flat
+# instrument response for both channels. A metric function is skipped when
+# its R reference fails and fails when its NumPy version raises an exception.
+#
+# run this as a package from the root ispaq directory:
+# python -m ispaq.scripts.test_parity <options>
+# options:    --file <miniSEED file>
+#             --functions <comma separated metric functions>
+#             --rtol <relative tolerance>
+#             --synthetic <number of spikes>
+#
+# example call, showing the defaults:
+# python -m ispaq.scripts.test_parity --file=./test_data/II.KAPI.00.BHZ.2013.005.M --rtol=1e-6
+# python -m ispaq.scripts.test_parity --synthetic=25 --functions=numSpikes
+#
+"""
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import obspy
+
+from ispaq.concierge import Waveform, _read_flags
+from ispaq import irismustangmetrics
+from ispaq import numpymetrics
+from ispaq import engines
+
+# Arguments used by simple_metrics for each metric function, with the same
+# STALTA increment for both R and NumPy
+CASES = {'basicStats': ((), {}),
+         'gaps': ((), {}),
+         'stateOfHealth': ((), {}),
+         'numSpikes': ((41, 10), {'fixedThreshold': True}),
+         'STALTA': ((), {'staSecs': 3, 'ltaSecs': 30, 'algorithm': 'classic_LR', 'increment': 20}),
+         'SNR': ((), {'algorithm': 'splitWindow', 'windowSecs': 60})}
+
+
+class RFailure(Exception):
+    """
+    Raised when the R reference fails so that the metric function is skipped
+    rather than counted as a NumPy failure.
+    """
+    pass
+
+
+def synthetic_stream(spikes, sampling_rate=40.0, seed=2013):
+    """
+    Return a day of Gaussian noise with `spikes` single and double sample spikes.
+    """
+    random = np.random.RandomState(seed)
+    npts = int(86400 * sampling_rate)
+    data = np.round(random.normal(0, 500, npts)).astype(np.int32)
+    positions = random.randint(100, npts - 100, spikes)
+    data[positions] += random.choice([-1, 1], spikes) * random.randint(20000, 100000, spikes)
+    data[positions[::2] + 1] += 20000
+    header = {'network': 'XX', 'station': 'SYN', 'location': '00', 'channel': 'BHZ',
+              'sampling_rate': sampling_rate, 'starttime': obspy.UTCDateTime('2013-01-05'),
+              'mseed': {'dataquality': 'M'}}
+    return obspy.Stream([obspy.Trace(data=data, header=header)])
+
+
+def compare(function_name, r_df, np_df, rtol):
+    """
+    Compare R and NumPy metric dataframes and return a list of differences.
+    """
+    errors = []
+    r_values = dict(zip(r_df.metricName, r_df.value))
+    np_values = dict(zip(np_df.metricName, np_df.value))
+    if sorted(r_values.keys()) != sorted(np_values.keys()):
+        errors.append('metric names %s != %s' % (sorted(r_values.keys()), sorted(np_values.keys())))
+    for name in sorted(set(r_values) & set(np_values)):
+        r_value = float(r_values[name])
+        np_value = float(np_values[name])
+        if not np.isclose(r_value, np_value, rtol=rtol, atol=0, equal_nan=True):
+            errors.append('%s R=%r NumPy=%r' % (name, r_value, np_value))
+    for column in ['snclq', 'starttime', 'endtime', 'time']:
+        if column not in r_df.columns:
+            continue
+        if list(r_df[column]) != list(np_df[column]):
+            errors.append('%s R=%s NumPy=%s' % (column, list(r_df[column])[0], list(np_df[column])[0]))
+    return errors
+
+
+def compare_PSD(waveform, r_stream, rtol):
+    """
+    Compare R and NumPy PSD metrics, corrected PSDs and PDFs and return a list
+    of differences and the R and NumPy elapsed times.
+    """
+    freq = numpymetrics.psdList(waveform)[1]
+    evalresp = pd.DataFrame({'freq': freq, 'amp': np.ones(freq.size), 'phase': np.zeros(freq.size)},
+                            columns=['freq', 'amp', 'phase'])
+
+    start = time.time()
+    try:
+        (r_df, r_psd, r_pdf) = irismustangmetrics.apply_PSD_metric(r_stream, evalresp=evalresp)
+    except Exception as e:
+        raise RFailure(e)
+    r_elapsed = time.time() - start
+
+    start = time.time()
+    (np_df, np_psd, np_pdf) = numpymetrics.apply_PSD_metric(waveform, evalresp=evalresp)
+    np_elapsed = time.time() - start
+
+    errors = compare('PSD', r_df, np_df, rtol)
+    if r_psd.shape != np_psd.shape:
+        errors.append('corrected PSD shape R=%s NumPy=%s' % (r_psd.shape, np_psd.shape))
+    else:
+        if not np.allclose(r_psd.power, np_psd.power, rtol=rtol, atol=0, equal_nan=True):
+            errors.append('corrected PSD power differs by up to %g dB' % np.nanmax(np.abs(r_psd.power - np_psd.power)))
+        if list(r_psd.starttime) != list(np_psd.starttime):
+            errors.append('corrected PSD starttimes differ')
+    # Values on a 1 dB bin edge may fall in either bin
+    mismatched = pd.merge(r_pdf, np_pdf, how='outer', on=['freq', 'power']).fillna(0)
+    mismatched = mismatched[mismatched.hits_x != mismatched.hits_y]
+    if mismatched.shape[0] > 0:
+        errors.append('PDF hits differ in %d bins' % mismatched.shape[0])
+    return (errors, r_elapsed, np_elapsed)
+
+
+def noisy_copy(waveform):
+    """
+    Return a copy of the waveform on the N channel with added Gaussian noise.
+    """
+    py_stream = waveform.py_stream.copy()
+    random = np.random.RandomState(2013)
+    for tr in py_stream:
+        tr.stats.channel = tr.stats.channel[:2] + 'N'
+        tr.data = tr.data + np.round(random.normal(0, tr.data.std(), tr.stats.npts)).astype(tr.data.dtype)
+    return Waveform(py_stream[0].id, waveform.starttime, waveform.endtime, py_stream=py_stream, trace_info={})
+
+
+def compare_correlation(waveform, r_stream, rtol):
+    """
+    Compare R and NumPy correlation metrics of the data and a noisy copy and
+    return a list of differences and the R and NumPy elapsed times.
+    """
+    waveform2 = noisy_copy(waveform)
+
+    try:
+        r_stream2 = waveform2.R_Stream()
+        start = time.time()
+        r_df = irismustangmetrics.apply_correlation_metric(r_stream, r_stream2, 'correlation')
+        r_elapsed = time.time() - start
+    except Exception as e:
+        raise RFailure(e)
+
+    start = time.time()
+    np_df = numpymetrics.correlationMetric_batch([waveform, waveform2], [(0, 1)])[0]
+    np_elapsed = time.time() - start
+    if isinstance(np_df, Exception):
+        raise np_df
+
+    return (compare('correlation', r_df, np_df, rtol), r_elapsed, np_elapsed)
+
+
+def compare_crossCorrelation(waveform, r_stream, rtol):
+    """
+    Compare R and NumPy cross-correlation metrics of the first 10 minutes of
+    the data and a noisy copy and return a list of differences and the R and
+    NumPy elapsed times.
+    """
+    endtime = waveform.starttime + 600
+    py_stream = waveform.py_stream.slice(waveform.starttime, endtime)[:1]
+    waveform1 = Waveform(py_stream[0].id, waveform.starttime, endtime, py_stream=py_stream, trace_info={})
+    waveform2 = noisy_copy(waveform1)
+
+    try:
+        (r_stream1, r_stream2) = (waveform1.R_Stream(), waveform2.R_Stream())
+        start = time.time()
+        r_df = irismustangmetrics.apply_correlation_metric(r_stream1, r_stream2, 'crossCorrelation', 10)
+        r_elapsed = time.time() - start
+    except Exception as e:
+        raise RFailure(e)
+
+    start = time.time()
+    np_df = numpymetrics.crossCorrelationMetric(waveform1, waveform2, 10)
+    np_elapsed = time.time() - start
+
+    errors = compare('crossCorrelation', r_df, np_df, rtol)
+    if list(r_df.snclq2) != list(np_df.snclq2):
+        errors.append('snclq2 R=%s NumPy=%s' % (list(r_df.snclq2)[0], list(np_df.snclq2)[0]))
+    return (errors, r_elapsed, np_elapsed)
+
+
+def compare_transferFunction(waveform, r_stream, rtol):
+    """
+    Compare R and NumPy transfer function metrics of the first hour of the data
+    and a noisy copy and return a list of differences and the R and NumPy
+    elapsed times.
+    """
+    endtime = waveform.starttime + 3600
+    py_stream = waveform.py_stream.slice(waveform.starttime, endtime)[:1]
+    waveform1 = Waveform(py_stream[0].id, waveform.starttime, endtime, py_stream=py_stream, trace_info={})
+    waveform2 = noisy_copy(waveform1)
+    freq = 2**np.arange(np.log2(0.005), np.log2(0.5 * py_stream[0].stats.sampling_rate), 0.125)
+    evalresp = pd.DataFrame({'freq': freq, 'amp': np.ones(freq.size), 'phase': np.zeros(freq.size)},
+                            columns=['freq', 'amp', 'phase'])
+
+    try:
+        (r_stream1, r_stream2) = (waveform1.R_Stream(), waveform2.R_Stream())
+        start = time.time()
+        r_df = irismustangmetrics.apply_transferFunction_metric(r_stream1, r_stream2, evalresp, evalresp)
+        r_elapsed = time.time() - start
+    except Exception as e:
+        raise RFailure(e)
+
+    start = time.time()
+    np_df = numpymetrics.transferFunctionMetric(waveform1, waveform2, evalresp, evalresp)
+    np_elapsed = time.time() - start
+
+    errors = []
+    for column in ['snclq', 'starttime', 'endtime']:
+        if list(r_df[column]) != list(np_df[column]):
+            errors.append('%s R=%s NumPy=%s' % (column, list(r_df[column])[0], list(np_df[column])[0]))
+    for column in ['gain_ratio', 'phase_diff', 'ms_coherence']:
+        (r_value, np_value) = (float(r_df[column].iloc[0]), float(np_df[column].iloc[0]))
+        if not np.isclose(r_value, np_value, rtol=rtol, atol=0, equal_nan=True):
+            errors.append('%s R=%r NumPy=%r' % (column, r_value, np_value))
+    return (errors, r_elapsed, np_elapsed)
+
+
+# Metric functions compared by their own functions
+COMPARISONS = {'PSD': compare_PSD,
+               'correlation': compare_correlation,
+               'crossCorrelation': compare_crossCorrelation,
+               'transferFunction': compare_transferFunction}
+
+
+def default_functions():
+    """
+    Return the metric functions with both engines that can be compared. The
+    crossTalk and pressureCorrelation metric functions share 'correlation'.
+    """
+    registry = engines.registry()
+    function_names = [name for name in sorted(CASES.keys()) + sorted(COMPARISONS.keys())
+                      if name == 'correlation' or registry.get(name) == ['r', 'numpy']]
+    return function_names
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', action='store', default='./test_data/II.KAPI.00.BHZ.2013.005.M',
+                        help='local miniSEED file')
+    parser.add_argument('--functions', action='store', default=','.join(default_functions()),
+                        help='comma separated metric functions to compare')
+    parser.add_argument('--rtol', action='store', type=float, default=1e-6,
+                        help='relative tolerance')
+    parser.add_argument('--synthetic', action='store', type=int, default=None,
+                        help='number of spikes injected into synthetic data used instead of --file')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.synthetic is None:
+        py_stream = obspy.read(args.file)
+    else:
+        py_stream = synthetic_stream(args.synthetic)
+    starttime = obspy.UTCDateTime(py_stream[0].stats.starttime.date)
+    endtime = starttime + 86400 - 0.000001
+    py_stream = py_stream.slice(starttime, endtime, nearest_sample=False)
+    # State-of-health flags are only available from the miniSEED file
+    trace_info = _read_flags(args.file, starttime, endtime) if args.synthetic is None else {}
+    waveform = Waveform(py_stream[0].id, starttime, endtime, py_stream=py_stream, trace_info=trace_info)
+    r_stream = waveform.R_Stream()
+
+    failures = 0
+    (r_total, np_total) = (0.0, 0.0)
+    for function_name in args.functions.split(','):
+        if function_name in COMPARISONS:
+            compare_function = COMPARISONS[function_name]
+            try:
+                (errors, r_elapsed, np_elapsed) = compare_function(waveform, r_stream, args.rtol)
+            except RFailure as e:
+                print("skip  %-16s R failed: %s" % (function_name, e))
+                continue
+            except Exception as e:
+                print("FAIL  %-16s NumPy failed: %s" % (function_name, e))
+                failures += 1
+                continue
+        else:
+            (fargs, fkwargs) = CASES[function_name]
+
+            start = time.time()
+            try:
+                r_df = irismustangmetrics.apply_simple_metric(r_stream, function_name, *fargs, **fkwargs)
+            except Exception as e:
+                print("skip  %-16s R failed: %s" % (function_name, e))
+                continue
+            r_elapsed = time.time() - start
+
+            start = time.time()
+            try:
+                np_df = numpymetrics.apply_simple_metric(waveform, function_name, *fargs, **fkwargs)
+            except Exception as e:
+                print("FAIL  %-16s NumPy failed: %s" % (function_name, e))
+                failures += 1
+                continue
+            np_elapsed = time.time() - start
+
+            errors = compare(function_name, r_df, np_df, args.rtol)
+        status = 'FAIL' if errors else 'ok'
+        print("%-4s  %-16s R %7.3f s  NumPy %7.3f s  speedup %6.1fx" %
+              (status, function_name, r_elapsed, np_elapsed, r_elapsed / max(np_elapsed, 1e-6)))
+        r_total += r_elapsed
+        np_total += np_elapsed
+        for error in errors:
+            print("        %s" % error)
+        if errors:
+            failures += 1
+
+    print("Total R %.3f s  NumPy %.3f s  speedup %.1fx" % (r_total, np_total, r_total / max(np_total, 1e-6)))
+    if failures:
+        print("%d metric functions differ from R or failed" % failures)
+        sys.exit(1)
+    else:
+        print("All NumPy metric functions match R")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+#
+# test_pdf_histogram -- check that PDF histograms reproduce and combine daily PDFs
+#
+# Corrected PSDs are calculated for each day of a synthetic stream with the
+# NumPy PSD engine. The test fails if a daily histogram differs from the PDF
+# returned by PSDMetric, if histograms change when saved and loaded, or if
+# the sum of daily histograms differs from the histogram of all PSDs.
+#
+# run this as a package from the root ispaq directory:
+# python -m ispaq.scripts.test_pdf_histogram <options>
+# options:    --days <number of days>
+#
+# example call, showing the defaults:
+# python -m ispaq.scripts.test_pdf_histogram --days=3
+#
+"""
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+import obspy
+
+from ispaq.concierge import Waveform
+from ispaq import numpymetrics
+from ispaq import pdf_histogram
+from ispaq.pdf_histogram import PDFHistogram
+
+
+def synthetic_waveform(day, sampling_rate=20.0, seed=2013):
+    """
+    Return a Waveform with a day of random walk noise.
+    """
+    random = np.random.RandomState(seed + day)
+    npts = int(86400 * sampling_rate)
+    data = np.cumsum(random.normal(0, 100, npts)).astype(np.int32)
+    starttime = obspy.UTCDateTime('2013-01-05') + day * 86400
+    header = {'network': 'XX', 'station': 'SYN', 'location': '00', 'channel': 'BHZ',
+              'sampling_rate': sampling_rate, 'starttime': starttime,
+              'mseed': {'dataquality': 'M'}}
+    py_stream = obspy.Stream([obspy.Trace(data=data, header=header)])
+    return Waveform('XX.SYN.00.BHZ', starttime, starttime + 86400, py_stream=py_stream, trace_info={})
+
+
+def same_pdf(a, b):
+    columns = ['freq', 'power', 'hits']
+    a = a[columns].sort_values(columns).reset_index(drop=True)
+    b = b[columns].sort_values(columns).reset_index(drop=True)
+    return a.shape == b.shape and np.allclose(a.values.astype(float), b.values.astype(float))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', action='store', type=int, default=3,
+                        help='number of synthetic days')
+    args = parser.parse_args(sys.argv[1:])
+
+    failures = []
+    directory = tempfile.mkdtemp()
+    try:
+        filepaths = []
+        corrected = []
+        for day in range(args.days):
+            waveform = synthetic_waveform(day)
+            freq = numpymetrics.psdList(waveform)[1]
+            evalresp = pd.DataFrame({'freq': freq, 'amp': np.ones(freq.size), 'phase': np.zeros(freq.size)})
+            (df, PSDCorrected, PDF) = numpymetrics.apply_PSD_metric(waveform, evalresp=evalresp)
+            corrected.append(PSDCorrected)
+
+            histogram = PDFHistogram.from_df(waveform.snclId, PSDCorrected)
+            if not same_pdf(histogram.to_df(), PDF):
+                failures.append('day %d histogram differs from PSDMetric PDF' % day)
+
+            filepath = os.path.join(directory, 'day%d.npz' % day)
+            histogram.save(filepath)
+            filepaths.append(filepath)
+            loaded = PDFHistogram.load(filepath)
+            if not np.array_equal(loaded.counts, histogram.counts) or loaded.starttime != histogram.starttime:
+                failures.append('day %d histogram changed when saved and loaded' % day)
+
+        merged = pdf_histogram.merge_files(filepaths)
+        combined = PDFHistogram.from_df('XX.SYN.00.BHZ', pd.concat(corrected, ignore_index=True))
+        if not np.array_equal(merged.counts, combined.counts):
+            failures.append('sum of daily histograms differs from histogram of all PSDs')
+        if merged.psd_count != combined.psd_count:
+            failures.append('merged PSD count %d != %d' % (merged.psd_count, combined.psd_count))
+        print("%d days, %d PSDs, %d bytes per daily histogram" %
+              (args.days, merged.psd_count, os.path.getsize(filepaths[0])))
+    finally:
+        shutil.rmtree(directory)
+
+    for failure in failures:
+        print("FAIL  %s" % failure)
+    if failures:
+        sys.exit(1)
+    else:
+        print("All PDF histogram checks passed")
+
+
+if __name__ == "__main__":
+    main()
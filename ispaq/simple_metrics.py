@@ -10,6 +10,7 @@ ISPAQ Business Logic for Simple Metrics.
 
 from __future__ import (absolute_import, division, print_function)
 
+import collections
 import math
 import numpy as np
 import pandas as pd
@@ -21,6 +22,7 @@ from .concierge import NoAvailableDataError
 from . import utils
 from . import irisseismic
 from . import irismustangmetrics
+from . import numpymetrics
 
 def simple_metrics(concierge):
     """
@@ -36,6 +38,22 @@ def simple_metrics(concierge):
 
     TODO:  doctest examples
     """
+    return utils.finish_pass(simple_metrics_days(concierge))
+
+
+def simple_metrics_days(concierge):
+    """
+    Generate *simple* metrics one day at a time.
+
+    This generator yields the ``(starttime, endtime)`` window of each day
+    before the metrics of that day are submitted and finally yields the
+    dataframe of simple metrics or None. It is run to the end by
+    :func:`simple_metrics` or advanced in step with other day based business
+    logic by :func:`~ispaq.ispaq.run_pass`.
+
+    :type concierge: :class:`~ispaq.concierge.Concierge`
+    :param concierge: Data access expediter.
+    """
     # Get the logger from the concierge
     logger = concierge.logger
 
@@ -64,7 +82,7 @@ def simple_metrics(concierge):
             raise
         except Exception as e:
             logger.error("concierge.get_availability() failed: '%s'" % e)
-            return None
+            return
 
     # function metadata dictionary
     function_metadata = concierge.function_by_logic['simple']
@@ -75,14 +93,47 @@ def simple_metrics(concierge):
 
     logger.debug("channelFilter %s" % channelFilter)
 
+    # When every metric function only needs trace headers, sample values are never decoded
+    headonly = all(function_name in concierge.numpy_functions and function_name in numpymetrics.HEADER_METRICS
+                   for function_name in function_metadata)
+    if headonly:
+        logger.debug("reading miniSEED record headers only")
+
+    # Day-sized work units and the days whose jobs have not been gathered yet
+    days = concierge.day_windows()
+    pending_days = collections.deque()
+
+    def gather_day(day, starttime, jobs):
+        """
+        Gather the results of one day in the order the jobs were submitted.
+        """
+        for (av, calls, job) in jobs:
+            try:
+                results = job.get()
+            except Exception as e:
+                if str(e).lower().find('no data') > -1:
+                    logger.info('No data available for %s' % (av.snclId))
+                else:
+                    logger.warning('No data available for %s from %s: %s' % (av.snclId, concierge.dataselect_url, e))
+                continue
+
+            for ((function_name, args, kwargs), df) in zip(calls, results):
+                if isinstance(df, Exception):
+                    logger.warning('"%s" metric calculation failed for %s: %s' % (function_name, av.snclId, df))
+                    continue
+                dataframes.append(df)
+
+            concierge.memory.tick()
+
+        # Release this day's R objects and report memory use
+        concierge.memory.log_usage('simple metrics on %s' % starttime.date)
+        logger.info('Finished simple metrics on %s, day %d of %d' % (starttime.date, day + 1, len(days)))
+
     # Loop over days
-    for day in range(nday):
-        starttime = (start + day * 86400)
-        starttime = UTCDateTime(starttime.strftime("%Y-%m-%d") + "T00:00:00Z")
-        endtime = starttime + 86400
+    for (day, (starttime, endtime)) in enumerate(days):
 
-        if starttime == end:
-            continue
+        # Let a fused day pass bring other business logic to this day first
+        yield (starttime, endtime)
 
         try:
             availability = concierge.get_availability(starttime=starttime, endtime=endtime)
@@ -91,7 +142,7 @@ def simple_metrics(concierge):
         except Exception as e:
             logger.debug(e)
             logger.error('concierge.get_availability() failed')
-            return None 
+            return
 
         # NEW: If the station has no data, then skip it (used to raise NoAvailableDataError)
         if availability is None:
@@ -104,6 +155,9 @@ def simple_metrics(concierge):
         # Loop over rows of the availability dataframe
         logger.info('Calculating simple metrics for %d SNCLs on %s' % (availability.shape[0], str(starttime).split('T')[0]))
 
+        # Metric calculations are submitted to the executor and gathered in SNCL order
+        jobs = []
+
         for (index, av) in availability.iterrows():
 
             logger.info('%03d Calculating simple metrics for %s' % (index, av.snclId))
@@ -112,7 +166,8 @@ def simple_metrics(concierge):
 
             # NOTE:  Use the requested starttime, not just what is available
             try:
-                r_stream = concierge.get_dataselect(av.network, av.station, av.location, av.channel, starttime, endtime, ignoreEpoch=True)
+                waveform = concierge.get_waveform(av.network, av.station, av.location, av.channel, starttime, endtime,
+                                                  ignoreEpoch=True, headonly=headonly)
             except Exception as e:
                 if str(e).lower().find('no data') > -1:
                     logger.info('No data available for %s' % (av.snclId))
@@ -120,36 +175,24 @@ def simple_metrics(concierge):
                     logger.warning('No data available for %s from %s: %s' % (av.snclId, concierge.dataselect_url, e))
                 continue
 
+            # List of (metric_function_name, args, kwargs) to run on this waveform
+            calls = []
+            stalta_waveform = None
+
             # Run the Gaps metric ----------------------------------------
 
             if 'gaps' in function_metadata:
-                try:
-                    df = irismustangmetrics.apply_simple_metric(r_stream, 'gaps')
-                    dataframes.append(df)
-                except Exception as e:
-                    logger.warning('"gaps" metric calculation failed for %s: %s' % (av.snclId, e))
+                calls.append(('gaps', (), {}))
             
             # Run the State-of-Health metric -----------------------------
+
             if 'stateOfHealth' in function_metadata:
-                try:
-                    df = irismustangmetrics.apply_simple_metric(r_stream, 'stateOfHealth')
-                    # for local miniSEED data, remove invalid state of health metrics
-                    if concierge.dataselect_client is None:
-                        df = df[~df.metricName.isin(["calibration_signal","clock_locked","event_begin","event_end","event_in_progess","timing_correction","timing_quality"])]
-                    dataframes.append(df)
-                except Exception as e:
-                    logger.warning('"stateOfHealth" metric calculation failed for %s: %s' % (av.snclId, e))
-                    
+                calls.append(('stateOfHealth', (), {}))
             
             # Run the Basic Stats metric ---------------------------------
 
             if 'basicStats' in function_metadata:  
-                try:
-                    df = irismustangmetrics.apply_simple_metric(r_stream, 'basicStats')
-                    dataframes.append(df)
-                except Exception as e:
-                    logger.warning('"basicStats" metric calculation failed for %s: %s' % (av.snclId, e))
-                    
+                calls.append(('basicStats', (), {}))
 
             # Run the STALTA metric --------------------------------------
 
@@ -158,12 +201,14 @@ def simple_metrics(concierge):
             # NOTE:  ahead a few points as determined by the "increment" parameter.
             # NOTE:  An increment that translates to 0.2-0.5 secs seems to be a good compromise
             # NOTE:  between performance and accuracy.
+            # NOTE:  When STALTA is in numpy_functions, every point is used.
 
             if 'STALTA' in function_metadata:
             
                 if av.channel.startswith(('BH','HH','CH','DH','EH','SH','DP','EL','BX','HX')):
                     try:
-                        r_stream_stalta = concierge.get_dataselect(av.network, av.station, av.location, av.channel, starttime, endtime)
+                        stalta_waveform = concierge.get_waveform(av.network, av.station, av.location, av.channel, starttime, endtime)
+                        calls.append(('STALTA', (), {'staSecs': 3, 'ltaSecs': 30, 'algorithm': 'classic_LR'}))
                     except Exception as e:
                         if str(e).lower().find('no data') > -1:
                             logger.info('No data available for %s' % (av.snclId))
@@ -171,20 +216,9 @@ def simple_metrics(concierge):
                             logger.info('Skipping %s because multiple metadata epochs found' % (av.snclId))
                         else:
                             logger.warning('No data available for %s from %s: %s' % (av.snclId, concierge.dataselect_url, e))
-                        continue
-
-                    sampling_rate = utils.get_slot(r_stream_stalta, 'sampling_rate')
-                    increment = math.ceil(sampling_rate / 2.0)
-                
-                    try:
-                        df = irismustangmetrics.apply_simple_metric(r_stream_stalta, 'STALTA', staSecs=3, ltaSecs=30, increment=increment, algorithm='classic_LR')
-                        dataframes.append(df)
-                    except Exception as e:
-                        logger.warning('"STALTA" metric calculation failed for for %s: %s' % (av.snclId, e))
                 else:
                     logger.info('Skipping %s because channel not valid for "STALTA" metric' % av.snclId)
                     
-                    
             # Run the numSpikes metric --------------------------------------
 
             # NOTE:  Appropriate values for spikesMetric arguments are determined empirically
@@ -194,14 +228,26 @@ def simple_metrics(concierge):
                 if av.channel.startswith(('BH','HH','BX','HX')):
                     windowSize = 41
                     thresholdMin = 10
-                           
-                    try:
-                        df = irismustangmetrics.apply_simple_metric(r_stream, 'numSpikes', windowSize, thresholdMin, fixedThreshold=True)
-                        dataframes.append(df)
-                    except Exception as e:
-                        logger.warning('"numSpikes" metric calculation failed for %s: %s' % (av.snclId, e))            
+                    calls.append(('numSpikes', (windowSize, thresholdMin), {'fixedThreshold': True}))
                 else:
                     logger.info('Skipping %s because channel not valid for "numSpikes" metric' % av.snclId)
+
+            job = concierge.executor.submit(_simple_metrics_job, waveform, calls, stalta_waveform,
+                                            numpy_functions=concierge.numpy_functions)
+            jobs.append((av, calls, job))
+
+        pending_days.append((day, starttime, jobs))
+
+        # NOTE:  Jobs of the next days are submitted before earlier days are gathered so that
+        # NOTE:  workers stay busy across day boundaries. Results are gathered day by day so
+        # NOTE:  that metrics are in the same order for any number of workers.
+        while len(pending_days) > concierge.workers:
+            gather_day(*pending_days.popleft())
+
+    # Gather results of the remaining days -------------------------------
+
+    while pending_days:
+        gather_day(*pending_days.popleft())
                         
     # Concatenate and filter dataframes before returning -----------------------
        
@@ -211,13 +257,64 @@ def simple_metrics(concierge):
                 
     if len(dataframes) == 0:
         logger.warning('"simple" metric calculation generated zero metrics')
-        return None
+        return
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         mask = result.metricName.apply(valid_metric)
         result = result[(mask)] 
         result.reset_index(drop=True, inplace=True)        
-        return(result)
+        yield result
+
+
+def _simple_metrics_job(waveform, calls, stalta_waveform=None, numpy_functions=()):
+    """
+    Run a list of simple metric functions on a single waveform.
+
+    This is submitted to the concierge executor and may run in a worker process.
+
+    :type waveform: :class:`~ispaq.concierge.Waveform`
+    :param waveform: Waveform used by all metric functions except STALTA.
+    :param calls: List of (metric_function_name, args, kwargs) tuples.
+    :type stalta_waveform: :class:`~ispaq.concierge.Waveform`
+    :param stalta_waveform: Waveform used by the STALTA metric function.
+    :param numpy_functions: Metric functions to calculate with
+        :mod:`~ispaq.numpymetrics` instead of R when local data are available.
+
+    :rtype: list
+    :return: A dataframe of metrics, or the exception that was raised, for
+        each entry in `calls`.
+    """
+    # NumPy metric functions work on local data only
+    if waveform.py_stream is None:
+        numpy_functions = ()
+
+    # NOTE:  The R Stream is only created if an R metric function needs it
+    r_stream = None
+    for (function_name, args, kwargs) in calls:
+        if function_name != 'STALTA' and function_name not in numpy_functions:
+            r_stream = waveform.R_Stream()
+            break
+
+    results = []
+    for (function_name, args, kwargs) in calls:
+        try:
+            if function_name == 'STALTA' and function_name in numpy_functions:
+                # NOTE:  The NumPy engine is fast enough to calculate STA/LTA at every point
+                df = numpymetrics.apply_simple_metric(stalta_waveform, 'STALTA', *args, increment=1, **kwargs)
+            elif function_name in numpy_functions:
+                df = numpymetrics.apply_simple_metric(waveform, function_name, *args, **kwargs)
+            elif function_name == 'STALTA':
+                r_stream_stalta = stalta_waveform.R_Stream()
+                sampling_rate = utils.get_slot(r_stream_stalta, 'sampling_rate')
+                increment = math.ceil(sampling_rate / 2.0)
+                df = irismustangmetrics.apply_simple_metric(r_stream_stalta, 'STALTA', *args, increment=increment, **kwargs)
+            else:
+                df = irismustangmetrics.apply_simple_metric(r_stream, function_name, *args, **kwargs)
+            results.append(df)
+        except Exception as e:
+            results.append(e)
+
+    return results
         
 
 # ------------------------------------------------------------------------------
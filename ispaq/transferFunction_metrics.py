@@ -19,11 +19,12 @@ import pandas as pd
 from obspy.clients.fdsn import Client
 from obspy import UTCDateTime
 
-from .concierge import NoAvailableDataError
+from .concierge import NoAvailableDataError, Waveform
 
 from . import utils
 from . import irisseismic
 from . import irismustangmetrics
+from . import numpymetrics
 
 
 def transferFunction_metrics(concierge):
@@ -47,6 +48,9 @@ def transferFunction_metrics(concierge):
     # Default parameters from IRISMustangUtils::generateMetrics_transferFunction or transferFunctionMetrics_exec.R
     channelFilter = '[BCFHLM][HX].' 
     logger.debug("channelFilter %s" % channelFilter)
+
+    # Transfer functions between channels with local data are calculated by numpymetrics
+    use_numpy = 'transferFunction' in concierge.numpy_functions
     
     # Sanity check for metadata
     if concierge.station_url is None:
@@ -67,20 +71,12 @@ def transferFunction_metrics(concierge):
 
     # loop over days
 
-    start = concierge.requested_starttime
-    end = concierge.requested_endtime 
+    days = concierge.day_windows()
 
-    delta = (end-start)/(24*60*60)
-    nday=int(delta)+1
- 
-    for day in range(nday):
-        beginday = (start + day * 86400)
+    for (day, (beginday, endday)) in enumerate(days):
         # start and endtimes should be 1 hour, not 1 day
         windowStart = UTCDateTime(beginday.strftime("%Y-%m-%d") + "T12:00:00Z")
         windowEnd = UTCDateTime(beginday.strftime("%Y-%m-%d") + "T13:00:00Z")
-
-        if beginday == end:
-            continue
     
 	# ----- All available SNCLs -------------------------------------------------
 	
@@ -116,6 +112,14 @@ def transferFunction_metrics(concierge):
 	    (network,station) = networkStation.split('.')
 	    stationAvailability = availability[(availability.network == network) & (availability.station == station)].reset_index(drop=True)
 
+	    # Periodically release R objects from previous stations
+	    concierge.memory.tick()
+
+	    # Traces, responses and spectra of this station are shared by all location pairs
+	    streams = {}
+	    evalresps = {}
+	    spectra = {}
+
 	    # Do not include any sncls that lack metadata
 	    metaMask = stationAvailability.dip.isnull().values 
 	    metaMask = metaMask == False
@@ -186,7 +190,7 @@ def transferFunction_metrics(concierge):
                         logger.info('Calculating transferFunction metrics for %s:%s' % (Zav1.snclId, Zav2.snclId))
 			# Get primary (1) and secondary (2) traces
 			try:
-			    Zst1 = concierge.get_dataselect(Zav1.network, Zav1.station, Zav1.location, Zav1.channel, windowStart, windowEnd, inclusiveEnd=False)
+			    Zst1 = _get_stream(concierge, Zav1, windowStart, windowEnd, use_numpy, streams)
 			except Exception as e:
 			    if str(e).lower().find('no data') > -1:
 				logger.info('No data available for %s' % (Zav1.snclId))
@@ -197,7 +201,7 @@ def transferFunction_metrics(concierge):
 			    continue
 
 			try:
-			    Zst2 = concierge.get_dataselect(Zav2.network, Zav2.station, Zav2.location, Zav2.channel, windowStart, windowEnd, inclusiveEnd=False)
+			    Zst2 = _get_stream(concierge, Zav2, windowStart, windowEnd, use_numpy, streams)
 			except Exception as e:
 			    if str(e).lower().find('no data') > -1:
 				logger.info('No data available for %s' % (Zav2.snclId))
@@ -207,12 +211,12 @@ def transferFunction_metrics(concierge):
 				logger.warning('No data available for %s from %s: %s' % (Zav2.snclId, concierge.dataselect_url, e))
 			    continue
 			
-			sampling_rate = min(utils.get_slot(Zst1,'sampling_rate'), utils.get_slot(Zst2,'sampling_rate'))
+			sampling_rate = min(utils.get_stream_slot(Zst1,'sampling_rate'), utils.get_stream_slot(Zst2,'sampling_rate'))
 		    
 			# Get primary (1), secondary (2) and orthogonal secondary spectra 
 			try:
-			    Zevalresp1 = utils.getSpectra(Zst1,sampling_rate,concierge)
-			    Zevalresp2 = utils.getSpectra(Zst2,sampling_rate,concierge) 
+			    Zevalresp1 = _get_spectra(Zst1, Zav1, sampling_rate, concierge, evalresps)
+			    Zevalresp2 = _get_spectra(Zst2, Zav2, sampling_rate, concierge, evalresps) 
 			except Exception as e:
 			    logger.warning('"transferFunction_metrics" getSpectra failed for %s:%s: %s' % (Zav1.snclId, Zav2.snclId, e))
 			    continue
@@ -221,7 +225,7 @@ def transferFunction_metrics(concierge):
 			# Run the transferFunction metric ----------------------------------------
 		
 			try:
-			    df = irismustangmetrics.apply_correlation_metric(Zst1, Zst2, 'transferFunction', Zevalresp1, Zevalresp2)
+			    df = _transferFunction(Zst1, Zst2, Zevalresp1, Zevalresp2, spectra)
 			    dataframes.append(df)
 			except Exception as e:
 			    logger.warning('"transfer_function" metric calculation failed for %s:%s: %s' % (Zav1.snclId, Zav2.snclId, e))
@@ -381,7 +385,7 @@ def transferFunction_metrics(concierge):
 
 				# Get primary (1) and secondary (2) traces
 				try:
-				    st1 = concierge.get_dataselect(av1.network, av1.station, av1.location, av1.channel, windowStart, windowEnd, inclusiveEnd=False)
+				    st1 = _get_stream(concierge, av1, windowStart, windowEnd, use_numpy, streams)
 				except Exception as e:
 				    if str(e).lower().find('no data') > -1:
 					logger.info('No data available for %s' % (av1.snclId))
@@ -392,7 +396,7 @@ def transferFunction_metrics(concierge):
 				    continue
 	    
 				try:
-				    st2 = concierge.get_dataselect(av2.network, av2.station, av2.location, av2.channel, windowStart, windowEnd, inclusiveEnd=False)
+				    st2 = _get_stream(concierge, av2, windowStart, windowEnd, use_numpy, streams)
 				except Exception as e:
 				    if str(e).lower().find('no data') > -1:
 					logger.info('No data available for %s' % (av2.snclId))
@@ -402,12 +406,12 @@ def transferFunction_metrics(concierge):
 					logger.warning('No data available for %s from %s: %s' % (av2.snclId, concierge.dataselect_url, e))
 				    continue
 	    
-				sampling_rate = min( utils.get_slot(st1, 'sampling_rate'), utils.get_slot(st2, 'sampling_rate') )
+				sampling_rate = min( utils.get_stream_slot(st1, 'sampling_rate'), utils.get_stream_slot(st2, 'sampling_rate') )
 	    
 				# Get primary (1), secondary (2) and orthogonal secondary spectra
 				try:
-				    evalresp1 = utils.getSpectra(st1, sampling_rate, concierge)
-				    evalresp2 = utils.getSpectra(st2, sampling_rate, concierge)
+				    evalresp1 = _get_spectra(st1, av1, sampling_rate, concierge, evalresps)
+				    evalresp2 = _get_spectra(st2, av2, sampling_rate, concierge, evalresps)
 				except Exception as e:
 				    logger.warning('"transferFunction_metrics" getSpectra failed for %s:%s: %s' % (av1.snclId, av2.snclId, e))
 				    continue
@@ -416,7 +420,7 @@ def transferFunction_metrics(concierge):
 				# Calculate the metrics and append them to the current list
 				logger.info('Calculating transferFunction metrics for %s:%s' % (av1.snclId, av2.snclId))
 				try:
-				    df = irismustangmetrics.apply_transferFunction_metric(st1, st2, evalresp1, evalresp2)
+				    df = _transferFunction(st1, st2, evalresp1, evalresp2, spectra)
 				except Exception as e:
 				    logger.warning('"transfer_function" metric calculation failed for %s:%s: %s' % (av1.snclId, av2.snclId, e))
 				    continue
@@ -469,7 +473,7 @@ def transferFunction_metrics(concierge):
 
 				# Get primary (1), secondary (2), and secondary orthogonal traces
 				try:
-				    st1 = concierge.get_dataselect(av1.network, av1.station, av1.location, av1.channel, windowStart, windowEnd, inclusiveEnd=False)
+				    st1 = _get_stream(concierge, av1, windowStart, windowEnd, use_numpy, streams)
 				except Exception as e:
 				    if str(e).lower().find('no data') > -1:
 					logger.info('No data available for %s' % (av1.snclId))
@@ -480,7 +484,7 @@ def transferFunction_metrics(concierge):
 				    continue
 	    
 				try:
-				    st2 = concierge.get_dataselect(av2.network, av2.station, av2.location, av2.channel, windowStart, windowEnd, inclusiveEnd=False)
+				    st2 = _get_stream(concierge, av2, windowStart, windowEnd, use_numpy, streams)
 				except Exception as e:
 				    if str(e).lower().find('no data') > -1:
 					logger.info('No data available for %s' % (av2.snclId))
@@ -491,7 +495,7 @@ def transferFunction_metrics(concierge):
 				    continue
 				 
 				try:
-				    st3 = concierge.get_dataselect(av3.network, av3.station, av3.location, av3.channel, windowStart, windowEnd, inclusiveEnd=False)
+				    st3 = _get_stream(concierge, av3, windowStart, windowEnd, use_numpy, streams)
 				except Exception as e:
 				    if str(e).lower().find('no data') > -1:
 					logger.info('No data available for %s' % (av3.snclId))
@@ -501,13 +505,13 @@ def transferFunction_metrics(concierge):
 					logger.warning('No data available for %s from %s: %s' % (av3.snclId, concierge.dataselect_url, e))
 				    continue
 				 
-				sampling_rate = min( utils.get_slot(st1, 'sampling_rate'), utils.get_slot(st2, 'sampling_rate') )
+				sampling_rate = min( utils.get_stream_slot(st1, 'sampling_rate'), utils.get_stream_slot(st2, 'sampling_rate') )
 	    
 				# Get primary (1), secondary (2) and orthogonal secondary spectra 
 				try:
-				    evalresp1 = utils.getSpectra(st1, sampling_rate, concierge)
-				    evalresp2 = utils.getSpectra(st2, sampling_rate, concierge)          
-				    evalresp3 = utils.getSpectra(st3, sampling_rate, concierge)
+				    evalresp1 = _get_spectra(st1, av1, sampling_rate, concierge, evalresps)
+				    evalresp2 = _get_spectra(st2, av2, sampling_rate, concierge, evalresps)          
+				    evalresp3 = _get_spectra(st3, av3, sampling_rate, concierge, evalresps)
 				except Exception as e:
 				    logger.debug('"transferFunction_metrics" getSpectra failed for %s:%s: %s' % (av1.snclId, av2.snclId, e))
 				    continue
@@ -528,14 +532,17 @@ def transferFunction_metrics(concierge):
 				    continue
 	    
 				# Rotate the secondary traces
-				try:
-				    traceRotList = irisseismic.rotate2D(Yst2, Xst2, rotAngle)
-				except Exception as e:
-				    logger.warning('"transferFunction_metrics Trace rotation failed for %s:%s: %s' % (av1.snclId, av2.snclId, e))
-				    continue
+				# NOTE:  numpymetrics combines the spectra of the secondary traces instead
+				use_spectra = isinstance(st1, Waveform) and isinstance(Yst2, Waveform) and isinstance(Xst2, Waveform)
+				if not use_spectra:
+				    try:
+					traceRotList = irisseismic.rotate2D(utils.as_R_Stream(Yst2), utils.as_R_Stream(Xst2), rotAngle)
+				    except Exception as e:
+					logger.warning('"transferFunction_metrics Trace rotation failed for %s:%s: %s' % (av1.snclId, av2.snclId, e))
+					continue
 				
-				RYst2 = traceRotList[0]
-				RXst2 = traceRotList[1]
+				    RYst2 = traceRotList[0]
+				    RXst2 = traceRotList[1]
 	    
 				# Rotate the secondary spectra
 				radians = rotAngle * math.pi/180.0
@@ -550,7 +557,11 @@ def transferFunction_metrics(concierge):
 				# Determine whether primary trace was X or Y
 				if av1.cartAxis == "Y":
 				    try:
-					df = irismustangmetrics.apply_transferFunction_metric(st1, RYst2, evalresp1, RYevalresp2)
+					if use_spectra:
+					    df = numpymetrics.transferFunctionMetric(st1, Yst2, evalresp1, RYevalresp2, spectra,
+					                                             mate=Xst2, angle=rotAngle, component='R')
+					else:
+					    df = irismustangmetrics.apply_transferFunction_metric(utils.as_R_Stream(st1), RYst2, evalresp1, RYevalresp2)
 				    except Exception as e:
 					logger.warning('"transfer_function" metric calculation failed for %s:%s: %s' % (av1.snclId, av2.snclId, e))
 					continue
@@ -559,7 +570,11 @@ def transferFunction_metrics(concierge):
 				    
 				elif av1.cartAxis == "X":
 				    try:
-					df = irismustangmetrics.apply_transferFunction_metric(st1, RXst2, evalresp1, RXevalresp2)
+					if use_spectra:
+					    df = numpymetrics.transferFunctionMetric(st1, Yst2, evalresp1, RXevalresp2, spectra,
+					                                             mate=Xst2, angle=rotAngle, component='T')
+					else:
+					    df = irismustangmetrics.apply_transferFunction_metric(utils.as_R_Stream(st1), RXst2, evalresp1, RXevalresp2)
 				    except Exception as e:
 					logger.warning('"transfer_function" metric calculation failed for %s:%s: %s' % (av1.snclId, av2.snclId, e))
 					continue
@@ -583,6 +598,10 @@ def transferFunction_metrics(concierge):
 	    # END for dips
 	      
 	# END for stations    
+
+	# Release this day's R objects and report memory use
+	concierge.memory.log_usage('transferFunction metrics on %s' % windowStart.date)
+	logger.info('Finished transferFunction metrics on %s, day %d of %d' % (windowStart.date, day + 1, len(days)))
         
     if len(dataframes) == 0:
         logger.warning('"transfer_function" metric calculation generated zero metrics')
@@ -593,6 +612,43 @@ def transferFunction_metrics(concierge):
         return(result)
 
 
+def _get_stream(concierge, av, starttime, endtime, use_numpy, streams):
+    """
+    Return a Waveform with local data when NumPy is used and an R Stream
+    otherwise. Streams are kept in `streams` so that a channel paired with
+    several locations is only read once.
+    """
+    if av.snclId not in streams:
+        waveform = concierge.get_waveform(av.network, av.station, av.location, av.channel, starttime, endtime, inclusiveEnd=False)
+        if use_numpy and waveform.py_stream is not None:
+            streams[av.snclId] = waveform
+        else:
+            streams[av.snclId] = waveform.R_Stream()
+    return streams[av.snclId]
+
+
+def _get_spectra(stream, av, sampling_rate, concierge, evalresps):
+    """
+    Return a copy of the evalresp response of a channel, kept in `evalresps`
+    so that the response is only requested once for each sampling rate.
+    """
+    key = (av.snclId, sampling_rate)
+    if key not in evalresps:
+        evalresps[key] = utils.getSpectra(stream, sampling_rate, concierge)
+    # Responses of rotated channels are modified by the business logic
+    return evalresps[key].copy()
+
+
+def _transferFunction(stream1, stream2, evalresp1, evalresp2, spectra):
+    """
+    Calculate the transfer_function metric with numpymetrics when both
+    channels have local data and with IRISMustangMetrics otherwise.
+    """
+    if isinstance(stream1, Waveform) and isinstance(stream2, Waveform):
+        return numpymetrics.transferFunctionMetric(stream1, stream2, evalresp1, evalresp2, spectra)
+    return irismustangmetrics.apply_transferFunction_metric(utils.as_R_Stream(stream1), utils.as_R_Stream(stream2), evalresp1, evalresp2)
+
+
 # ------------------------------------------------------------------------------
 
 
@@ -12,26 +12,25 @@ from __future__ import (absolute_import, division, print_function)
 
 import pandas as pd
 
-from rpy2 import robjects
-from rpy2 import rinterface
-from rpy2.robjects import pandas2ri
+from .rsession import robjects, rinterface, pandas2ri, RFunction
+from . import rsession
 
 
 #     R Initialization     -----------------------------------------------------
 
-# Global R options are set here
+# Global R options are set here and evaluated when R is first started
 
-robjects.r('options(download.file.method="curl")')
+rsession.on_initialize('options(download.file.method="curl")')
 
 # Do now show error messages generated inside of the R packages
-robjects.r('options(show.error.messages=FALSE)')
+rsession.on_initialize('options(show.error.messages=FALSE)')
 
 #     R functions called internally     ----------------------------------------
 
 # NOTE:  These functions behave exactly the same as the R versions and require
 # NOTE:  R-compatible objects as arguments.
 
-_R_install_packages = robjects.r('utils::install.packages')
+_R_install_packages = RFunction('utils::install.packages')
 
 
 def get_IRIS_package_versions(logger):
@@ -18,6 +18,7 @@ from obspy import UTCDateTime
 
 # ISPAQ modules
 from . import irismustangmetrics
+from . import engines
 
 from .ispaq import currentispaq
 
@@ -98,6 +99,10 @@ class UserRequest(object):
                                 'csv_dir': '.',
                                 'sigfigs': 6,
                                 'sncl_format': 'N.S.L.C'}
+            self.workers = 1
+            self.gc_interval = 10
+            self.engine = 'r'
+            self.numpy_functions = []
 
         #     Initialize from JSON     ----------------------------------------
         
@@ -133,6 +138,20 @@ class UserRequest(object):
             if 'sncl_format' in json_dict:
                 self.sncl_format = json_dict['sncl_format']
 
+            self.workers = 1
+            if 'workers' in json_dict:
+                self.workers = json_dict['workers']
+
+            self.gc_interval = 10
+            if 'gc_interval' in json_dict:
+                self.gc_interval = json_dict['gc_interval']
+
+            self.engine = 'auto'
+            if 'engine' in json_dict:
+                self.engine = json_dict['engine']
+
+            self.numpy_functions = engines.numpy_functions(self.engine, json_dict.get('numpy_functions', []))
+
         #     Initialize from arguments       ---------------------------------
 
         else:
@@ -158,6 +177,7 @@ class UserRequest(object):
             metric_sets, sncl_sets, data_access, preferences = {}, {}, {}, {}
             currentSection = None
             multiValue = False
+            multiValuePreferences = ['numpy_functions']  # Preferences entries holding comma separated lists
 
             if self.preferences_file is None:
                 self.preferences_file=os.path.expanduser('./preference_files/default.txt')
@@ -204,7 +224,7 @@ class UserRequest(object):
                                 continue
                             if values is None or len(values) == 0:
                                 currentSection[name] = None  # for optional values
-                            elif multiValue:
+                            elif multiValue or (currentSection is preferences and name in multiValuePreferences):
                                 currentSection[name] = values
                             else:
                                 currentSection[name] = values[0]
@@ -299,6 +319,47 @@ class UserRequest(object):
                 else:
                     self.sncl_format = "N.S.L.C"
 
+            # Worker processes, the command line overrides the preference file
+            if args.workers is not None:
+                self.workers = args.workers
+            elif 'workers' in preferences and preferences['workers'] is not None:
+                try:
+                    self.workers = int(preferences['workers'])
+                except ValueError:
+                    logger.critical('workers %s is not a valid number of worker processes' % preferences['workers'])
+                    raise SystemExit
+            else:
+                self.workers = 1
+            if self.workers < 1:
+                logger.critical('workers %s is not a valid number of worker processes' % self.workers)
+                raise SystemExit
+
+            if 'gc_interval' in preferences and preferences['gc_interval'] is not None:
+                try:
+                    self.gc_interval = int(preferences['gc_interval'])
+                except ValueError:
+                    logger.critical('gc_interval %s is not a valid number of SNCLs' % preferences['gc_interval'])
+                    raise SystemExit
+            else:
+                self.gc_interval = 10
+
+            # Metric engine, the command line overrides the preference file
+            self.engine = args.engine
+            if self.engine is None:
+                if 'engine' in preferences and preferences['engine'] is not None:
+                    self.engine = preferences['engine'].lower()
+                else:
+                    self.engine = 'auto'
+            if self.engine not in engines.ENGINES:
+                logger.critical('engine %s is not one of %s' % (self.engine, ', '.join(engines.ENGINES)))
+                raise SystemExit
+
+            # Metric functions to calculate with NumPy instead of R
+            requested_functions = []
+            if 'numpy_functions' in preferences and preferences['numpy_functions'] is not None:
+                requested_functions = preferences['numpy_functions']
+            self.numpy_functions = engines.numpy_functions(self.engine, requested_functions, logger=logger)
+
             sncl_expr = re.compile('[SNCL][\.][SNCL][\.][SNCL][\.][SNCL]')
             if (not re.match(sncl_expr, self.sncl_format)):
                 logger.critical('sncl_format %s is not valid' % self.sncl_format)
@@ -10,14 +10,19 @@ Utility functions for ISPAQ.
 
 from __future__ import (absolute_import, division, print_function)
 
+import gc
+import logging
 import math
 import os
+import resource
+import sys
 import numpy as np
 import pandas as pd
 
 from obspy import UTCDateTime
 
 from . import irisseismic
+from . import rsession
 from . import evalresp as evresp
 
 class EvalrespException(Exception):
@@ -36,10 +41,8 @@ def write_simple_df(df, filepath, sigfigs=6):
     """
     if df is None:
         raise("Dataframe of simple metrics does not exist.")
-    # Sometimes 'starttime' and 'endtime' get converted from UTCDateTime to float and need to be
-    # converted back. Nothing happens if this column is already of type UTCDateTime.
-    df.starttime = df.starttime.apply(UTCDateTime, precision=0) # no milliseconds
-    df.endtime = df.endtime.apply(UTCDateTime, precision=0) # no milliseconds
+    # NOTE:  'starttime' and 'endtime' arrive as datetime64 columns and are only
+    # NOTE:  converted to strings once, inside format_simple_df().
     df = df.replace('NULL',np.nan)
     # Get pretty values
     pretty_df = format_simple_df(df, sigfigs=sigfigs)
@@ -66,7 +69,7 @@ def format_simple_df(df, sigfigs=6):
     The following conversions take place:
     
     * Round the 'value' column to the specified number of significant figures.
-    * Convert 'starttime' and 'endtime' to python 'date' objects.
+    * Convert 'starttime' and 'endtime' to ISO 8601 strings without fractional seconds.
     """
     if 'value' in df.columns:
         # convert values to float
@@ -74,11 +77,9 @@ def format_simple_df(df, sigfigs=6):
         format_string = "." + str(sigfigs) + "g"
         df.value = df.value.apply(lambda x: format(x, format_string))
     if 'starttime' in df.columns:
-        df.starttime = df.starttime.apply(UTCDateTime, precision=0) # no milliseconds
-        df.starttime = df.starttime.apply(lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+        df.starttime = format_times(df.starttime)
     if 'endtime' in df.columns:
-        df.endtime = df.endtime.apply(UTCDateTime, precision=0) # no milliseconds
-        df.endtime = df.endtime.apply(lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+        df.endtime = format_times(df.endtime)
     if 'qualityFlag' in df.columns:
         df.qualityFlag = df.qualityFlag.astype(int)
 
@@ -111,16 +112,14 @@ def format_numeric_df(df, sigfigs=6):
     The following conversions take place:
     
     * Round the 'value' column to the specified number of significant figures.
-    * Convert 'starttime' and 'endtime' to python 'date' objects.
+    * Convert 'starttime' and 'endtime' to ISO 8601 strings without fractional seconds.
     """
     format_string = "." + str(sigfigs) + "g"
     for column in df.columns:
         if column == 'starttime':
-            df.starttime = df.starttime.apply(UTCDateTime, precision=0) # no milliseconds
-            df.starttime = df.starttime.apply(lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+            df.starttime = format_times(df.starttime)
         elif column == 'endtime':
-            df.endtime = df.endtime.apply(UTCDateTime, precision=0) # no milliseconds
-            df.endtime = df.endtime.apply(lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+            df.endtime = format_times(df.endtime)
         elif column == 'target':
             pass # 'target' is the SNCL Id
         else:
@@ -129,6 +128,21 @@ def format_numeric_df(df, sigfigs=6):
             
     return df   
 
+
+def format_times(times):
+    """
+    Format a column of times as ISO 8601 strings without fractional seconds.
+    :param times: pandas Series of datetime64 values.
+    :return: pandas Series of strings.
+
+    Metric results carry 'starttime' and 'endtime' as datetime64 columns so that
+    the only per-row work left at output time is this single strftime pass.
+    Columns of any other type (UTCDateTime or POSIXct seconds) are converted first.
+    """
+    if times.dtype.kind != 'M':
+        times = pd.to_datetime(times.apply(lambda x: UTCDateTime(x).datetime))
+    return times.dt.strftime("%Y-%m-%dT%H:%M:%S") # no milliseconds
+
     
 def get_slot(r_object, prop):
     """
@@ -221,7 +235,68 @@ def get_slot(r_object, prop):
     
     # Should never get here
     raise('"%s" is not a recognized slot name' % (prop))
-        
+
+
+def get_stream_slot(stream, prop):
+    """
+    Return a trace property from an R Stream or from a Waveform with local data.
+    :param stream: IRISSeismic Stream or :class:`~ispaq.concierge.Waveform`
+    :param prop: Name of a slot that is also an ObsPy trace stats attribute,
+        e.g. 'sampling_rate', 'npts' or 'channel'
+    :return: Value of the property for the first trace
+    """
+    from .concierge import Waveform
+    if isinstance(stream, Waveform):
+        return getattr(stream.py_stream[0].stats, prop)
+    return get_slot(stream, prop)
+
+
+def as_R_Stream(stream):
+    """
+    Return an R Stream for business logic that holds either R Streams or Waveforms.
+    :param stream: IRISSeismic Stream or :class:`~ispaq.concierge.Waveform`
+    :return: The IRISSeismic Stream itself or the one created by
+        :meth:`~ispaq.concierge.Waveform.R_Stream`
+    """
+    from .concierge import Waveform
+    if isinstance(stream, Waveform):
+        return stream.R_Stream()
+    return stream
+
+
+class EvalrespSource(object):
+    """
+    The concierge settings used by :func:`getSpectra` in a form that can be
+    passed to a worker process.
+    :param resp_dir: Directory of local RESP files.
+    :param logger_name: Name of the ISPAQ logger.
+    """
+    def __init__(self, resp_dir, logger_name):
+        self.resp_dir = resp_dir
+        self.logger_name = logger_name
+
+    @property
+    def logger(self):
+        # NOTE:  Loggers cannot be pickled but worker processes inherit their handlers
+        return logging.getLogger(self.logger_name)
+
+
+def finish_pass(business_logic):
+    """
+    Run a day or event pass generator such as
+    :func:`~ispaq.simple_metrics.simple_metrics_days` to the end.
+    :param business_logic: Generator yielding windows and finally its result.
+    :return: Dataframe of metrics or None.
+    """
+    result = None
+    for result in business_logic:
+        pass
+    # NOTE:  A pass that stops after a window has no result
+    if isinstance(result, tuple):
+        return None
+    return result
+
+
 def getSpectra(st, sampling_rate, concierge):
     # This function returns an evalresp fap response for trace st using sampling_rate 
     # to determine frequency limits
@@ -286,11 +361,17 @@ def getSpectra(st, sampling_rate, concierge):
     units = 'DEF'
     output = 'FAP'
 
-    network = get_slot(st,'network')
-    station = get_slot(st,'station')
-    location = get_slot(st,'location')
-    channel = get_slot(st,'channel')
-    starttime = get_slot(st,'starttime')
+    if hasattr(st, 'py_stream'):
+        # Waveform with local data used by the NumPy metrics
+        stats = st.py_stream[0].stats
+        (network, station, location, channel) = (stats.network, stats.station, stats.location, stats.channel)
+        starttime = stats.starttime
+    else:
+        network = get_slot(st,'network')
+        station = get_slot(st,'station')
+        location = get_slot(st,'location')
+        channel = get_slot(st,'channel')
+        starttime = get_slot(st,'starttime')
   
     # REC - invoke evalresp either programmatically from a RESP file or by invoking the web service 
 
@@ -326,6 +407,74 @@ def getSpectra(st, sampling_rate, concierge):
             raise
     return(evalResp)
 
+# Memory management ------------------------------------------------------------
+
+def resident_memory():
+    """
+    Resident memory of the current process.
+    :return: Resident set size in Mb.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1048576.0
+    except (IOError, IndexError, ValueError):
+        # Fall back to peak resident memory, reported in bytes on OS X and kilobytes elsewhere
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            maxrss = maxrss / 1024.0
+        return maxrss / 1024.0
+
+
+class MemoryManager(object):
+    """
+    Keep R and python heaps from growing without bound during long runs.
+
+    R objects created for each SNCL are only released once python no longer
+    references them and R garbage collection has run. Business logic calls
+    :meth:`tick` after each SNCL so that collection happens every
+    `gc_interval` SNCLs, and :meth:`log_usage` after each day so that heap
+    sizes appear in the log.
+
+    :param gc_interval: Number of SNCLs between garbage collections. Use 0 to
+        only collect when :meth:`collect` or :meth:`log_usage` are called.
+    :param logger: Logger used by :meth:`log_usage`.
+    """
+    def __init__(self, gc_interval=10, logger=None):
+        self.gc_interval = gc_interval
+        self.logger = logger
+        self.count = 0
+
+    def tick(self):
+        """
+        Count one SNCL and collect garbage every `gc_interval` SNCLs.
+        """
+        self.count += 1
+        if self.gc_interval and self.count % self.gc_interval == 0:
+            self.collect()
+
+    def collect(self):
+        """
+        Run python and then R garbage collection.
+        :return: Memory in use by R, in Mb, or 0 if R has not been started.
+        """
+        # Python first so that rpy2 releases the R objects it was holding
+        gc.collect()
+        # NOTE:  Runs that only use NumPy metric functions never start R
+        if not rsession.is_initialized():
+            return 0.0
+        return irisseismic.R_gc()
+
+    def log_usage(self, label):
+        """
+        Collect garbage and log R and python memory use.
+        :param label: Description of the work just finished, e.g. a date.
+        """
+        r_heap = self.collect()
+        self.logger.info('Memory use after %s: R heap %.1f Mb, %d python objects, process resident %.1f Mb' %
+                         (label, r_heap, len(gc.get_objects()), resident_memory()))
+
+
 # ------------------------------------------------------------------------------
 
 